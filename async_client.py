@@ -0,0 +1,352 @@
+"""
+Shopping App asyncio Client
+Non-blocking counterpart of client.ShoppingClient for async services and
+load generators: many requests can be pipelined on one connection, and
+AsyncShoppingClientPool fans requests out over several connections
+"""
+import json
+import asyncio
+import itertools
+import protocol
+import serialization
+from client import shrink_image
+
+
+class AsyncShoppingClient(object):
+    def __init__(self, ip, port, framing=protocol.FRAMING_BINARY, multiplex=True, compress=False,
+                 encoding=serialization.ENCODING_JSON):
+        """Prepare the client; call connect() (or use `async with`) before sending"""
+        self.ip = ip
+        self.port = port
+        self.framing = framing
+        self.multiplex = multiplex
+        self.compress = compress
+        self.encoding = encoding
+
+        self.reader = None
+        self.writer = None
+        self.connection = None
+        self.session_id = None
+        self.username = None
+
+        # Held while writing the frames of one request
+        self.write_lock = asyncio.Lock()
+        # Without multiplexing one request/response pair at a time may use the stream
+        self.request_lock = asyncio.Lock()
+
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.reader_task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def multiplexed(self):
+        return self.connection is not None and self.connection.multiplexed
+
+    async def connect(self):
+        """Open the connection and negotiate framing"""
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+        # Only used to track the negotiated framing and features
+        self.connection = protocol.Connection(None)
+
+        if self.framing != protocol.FRAMING_LEGACY:
+            command = f"PROTOCOL {self.framing}"
+            if self.multiplex:
+                command += f" {protocol.FEATURE_MUX}"
+            if self.compress:
+                command += f" {protocol.FEATURE_COMPRESS}"
+            if self.encoding in serialization.SUPPORTED_ENCODINGS and self.encoding != serialization.ENCODING_JSON:
+                command += f" {self.encoding}"
+            response = await self.send_command(command)
+
+            if response and response.get("status") == "success":
+                self.connection.framing = response.get("framing", self.framing)
+                self.connection.encoding = response.get("encoding", serialization.ENCODING_JSON)
+                self.connection.compression = protocol.FEATURE_COMPRESS in response.get("features", [])
+                if protocol.FEATURE_MUX in response.get("features", []):
+                    self.connection.multiplexed = True
+                    self.reader_task = asyncio.create_task(self.read_responses())
+
+    async def read_responses(self):
+        """Reader task: resolve the future of each request as its reply arrives"""
+        error = ConnectionError("Connection closed")
+        try:
+            while True:
+                request_id, payload = await protocol.AsyncProtocol.recv_frame(self.reader, self.connection)
+
+                if not payload:
+                    break
+
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+
+                try:
+                    future.set_result(serialization.decode(payload, self.connection.encoding))
+                except ValueError as msg:
+                    future.set_exception(msg)
+        except (ConnectionError, OSError) as msg:
+            error = msg
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    def write_frame(self, data, request_id=None):
+        """Queue one frame using the negotiated framing (caller holds write_lock)"""
+        encoded_msg = data.encode() if isinstance(data, str) else data
+        if self.connection.framing == protocol.FRAMING_BINARY:
+            flags, encoded_msg = protocol.compress_payload(self.connection, encoded_msg)
+            self.writer.write(protocol.binary_header(len(encoded_msg), flags, request_id))
+        else:
+            self.writer.write(protocol.legacy_header(len(encoded_msg)))
+        self.writer.write(encoded_msg)
+
+    async def request(self, frames):
+        """
+        Send the frames of one request and wait for its reply
+        frames: list of str/bytes sent as frames, or RawBytes sent as-is
+        (the image data after IMAGE_SEARCH)
+        Returns: parsed JSON response
+        """
+        if self.multiplexed:
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                async with self.write_lock:
+                    await self.write_frames(frames, request_id)
+            except Exception:
+                self.pending.pop(request_id, None)
+                raise
+            return await future
+
+        async with self.request_lock:
+            async with self.write_lock:
+                await self.write_frames(frames, None)
+            response = await protocol.AsyncProtocol.recv(self.reader, self.connection)
+
+        if not response:
+            raise ConnectionError("No response from server")
+        return serialization.decode(response, self.connection.encoding)
+
+    async def write_frames(self, frames, request_id):
+        """Write framed strings and raw byte payloads of one request, then drain"""
+        for frame in frames:
+            if isinstance(frame, RawBytes):
+                self.writer.write(frame.data)
+            else:
+                self.write_frame(frame, request_id)
+        await self.writer.drain()
+
+    async def send_command(self, command):
+        """
+        Send command to server and wait for the response
+        Returns: parsed JSON response or None
+        """
+        try:
+            return await self.request([command])
+        except (ConnectionError, OSError) as msg:
+            print(f"Socket error: {msg}")
+            return None
+        except ValueError as msg:
+            print(f"Invalid reply: {msg}")
+            return None
+
+    async def login(self, username, password):
+        """
+        Login to server
+        Returns: True if successful, False otherwise
+        """
+        response = await self.send_command(f"LOGIN {username} {password}")
+
+        if response and response.get("status") == "success":
+            self.session_id = response.get("session_id")
+            self.username = response.get("username")
+            return True
+        return False
+
+    async def search_product(self, query):
+        """
+        Search for products
+        Returns: list of products or None
+        """
+        if not self.session_id:
+            return None
+
+        response = await self.send_command(f"SEARCH_PRODUCT {self.session_id} {query}")
+
+        if response and response.get("status") == "success":
+            return response.get("products", [])
+        return None
+
+    async def search_many(self, queries):
+        """
+        Search for several products in one request
+        Returns: list of (products_list, error_message) tuples in the order
+        of `queries`, or None if the whole request failed
+        """
+        if not self.session_id:
+            return None
+
+        response = await self.send_command(f"SEARCH_MANY {self.session_id} {json.dumps(list(queries))}")
+
+        if not response or response.get("status") != "success":
+            return None
+
+        results = [(None, "No result")] * len(queries)
+        for result in response.get("results", []):
+            if result.get("status") == "success":
+                results[result["index"]] = (result.get("products", []), None)
+            else:
+                results[result["index"]] = (None, result.get("message", "Unknown error"))
+        return results
+
+    async def image_search(self, image_path=None, image_bytes=None, max_edge=None):
+        """
+        Search for products by uploading an image (from a path or bytes)
+        max_edge: shrink the file before uploading (needs Pillow)
+        Returns:
+            tuple: (products_list, search_terms_used) or (None, error_message)
+        """
+        if not self.session_id:
+            return None, "Not logged in"
+
+        loop = asyncio.get_running_loop()
+        try:
+            if image_bytes is None:
+                # File IO and resizing would block the loop
+                if max_edge:
+                    image_bytes = await loop.run_in_executor(None, shrink_image, image_path, max_edge)
+                if image_bytes is None:
+                    image_bytes = await loop.run_in_executor(None, read_file, image_path)
+
+            result = await self.request([
+                f"IMAGE_SEARCH {self.session_id}",
+                str(len(image_bytes)),
+                RawBytes(image_bytes)
+            ])
+        except FileNotFoundError:
+            return None, f"Image file not found: {image_path}"
+        except (ConnectionError, OSError) as msg:
+            return None, f"Socket error: {msg}"
+        except ValueError as msg:
+            return None, f"Error: {msg}"
+
+        if result.get("status") == "success":
+            return result.get("products", []), result.get("search_terms", "")
+        return None, result.get("message", "Unknown error")
+
+    async def logout(self):
+        """Logout from server"""
+        if not self.session_id:
+            return True
+
+        response = await self.send_command(f"LOGOUT {self.session_id}")
+
+        if response and response.get("status") == "success":
+            self.session_id = None
+            self.username = None
+            return True
+        return False
+
+    async def close(self):
+        """Close connection to server"""
+        if self.writer is None:
+            return
+        try:
+            await asyncio.wait_for(self.send_command("EXIT"), timeout=5)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        self.writer = None
+
+
+class RawBytes(object):
+    """Marks request data that is sent unframed (the image after IMAGE_SEARCH)"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class AsyncShoppingClientPool(object):
+    """
+    A few AsyncShoppingClient connections sharing one session
+    Each call goes to the connection with the fewest requests in flight
+    """
+
+    def __init__(self, ip, port, size=4, **client_options):
+        self.clients = [AsyncShoppingClient(ip, port, **client_options) for _ in range(size)]
+        self.in_flight = [0] * size
+        self.session_id = None
+        self.username = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        await asyncio.gather(*(client.connect() for client in self.clients))
+
+    async def login(self, username, password):
+        """Login once and share the session with every connection"""
+        if not await self.clients[0].login(username, password):
+            return False
+        self.session_id = self.clients[0].session_id
+        self.username = self.clients[0].username
+        for client in self.clients[1:]:
+            client.session_id = self.session_id
+            client.username = self.username
+        return True
+
+    async def call(self, method, *args, **kwargs):
+        """Run a client coroutine on the least busy connection"""
+        index = min(range(len(self.clients)), key=self.in_flight.__getitem__)
+        self.in_flight[index] += 1
+        try:
+            return await getattr(self.clients[index], method)(*args, **kwargs)
+        finally:
+            self.in_flight[index] -= 1
+
+    async def search_product(self, query):
+        return await self.call("search_product", query)
+
+    async def search_many(self, queries):
+        return await self.call("search_many", queries)
+
+    async def image_search(self, image_path=None, image_bytes=None, max_edge=None):
+        return await self.call("image_search", image_path, image_bytes, max_edge)
+
+    async def logout(self):
+        result = await self.clients[0].logout()
+        if result:
+            for client in self.clients:
+                client.session_id = None
+                client.username = None
+            self.session_id = None
+            self.username = None
+        return result
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients))
@@ -0,0 +1,256 @@
+"""
+Shopping App asyncio Server
+Alternative engine to ShoppingServer: one event loop holds every connection,
+the (blocking) Methods handlers run on the dispatcher's bounded pools and a
+small thread pool reads uploads
+"""
+import sys
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import methods
+import metrics
+import protocol
+import serialization
+from logs import get_logger, format_address
+from constants import ASYNC_BACKLOG, ASYNC_WORKER_THREADS, MUX_MAX_IN_FLIGHT, MUX_DRAIN_TIMEOUT
+
+
+EXIT = 1
+
+log = get_logger("async_server")
+
+
+class StreamConnection(object):
+    """
+    Socket-like view of an asyncio stream for handlers running in worker threads
+    Carries the negotiated framing like protocol.Connection does, so
+    protocol.Protocol.send/recv work on it unchanged (IMAGE_SEARCH relies on this)
+    """
+
+    def __init__(self, reader, writer, loop):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.framing = protocol.FRAMING_LEGACY
+        self.multiplexed = False
+        self.streaming = False
+        self.encoding = serialization.ENCODING_JSON
+        self.compression = False
+        self.pending_settings = None
+
+    def run(self, coro):
+        """Run a stream coroutine on the event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def recv(self, size):
+        return self.run(self.reader.read(size))
+
+    def recv_into(self, view):
+        data = self.run(self.reader.read(len(view)))
+        view[:len(data)] = data
+        return len(data)
+
+    def sendall(self, data):
+        self.run(self.write(data))
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write_frame(self, prefix, payload):
+        """Write header and payload in one loop step so no other frame gets in between"""
+        self.run(self._write_frame(prefix, payload))
+
+    async def _write_frame(self, prefix, payload):
+        self.writer.write(prefix)
+        self.writer.write(payload)
+        await self.writer.drain()
+
+
+class AsyncShoppingServer(object):
+    def __init__(self, ip, port, workers=ASYNC_WORKER_THREADS):
+        """Prepare the upload pool; the socket is bound when the loop starts"""
+        self.ip = ip
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shopping-upload")
+
+    def handle_clients(self):
+        """Run the event loop and serve clients until interrupted"""
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            log.info("Server shutting down...")
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def serve(self):
+        """Bind the listening socket and accept clients forever"""
+        try:
+            server = await asyncio.start_server(
+                self.handle_single_client, self.ip, self.port, backlog=ASYNC_BACKLOG
+            )
+        except OSError as msg:
+            log.critical("Connection failure: %s - terminating program", msg)
+            sys.exit(EXIT)
+
+        log.info("Shopping Server (asyncio) started on %s:%s", self.ip, self.port)
+        log.info("Waiting for clients...")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_single_client(self, reader, writer):
+        """Handle a single client connection"""
+        address = writer.get_extra_info('peername')
+        connection = StreamConnection(reader, writer, asyncio.get_running_loop())
+        metrics.connections.open()
+        log.info("Client connected", extra={"address": format_address(address)})
+
+        try:
+            request = None
+            while request != 'EXIT':
+                request, params = await self.receive_client_request(connection, address)
+
+                if not request:
+                    break
+
+                # Read any upload here so the handler never touches the stream
+                # and a rejected request leaves it in sync
+                channel = connection
+                if request in methods.UPLOAD_COMMANDS:
+                    channel = protocol.RequestChannel(connection, None)
+                    loop = asyncio.get_running_loop()
+                    channel.upload = await loop.run_in_executor(self.executor, methods.receive_image, connection)
+
+                response = await self.handle_client_request(request, params, channel, address)
+                await self.send_response_to_client(response, channel)
+
+                if connection.multiplexed:
+                    # Requests now carry IDs and may be processed concurrently
+                    await self.handle_multiplexed_client(connection, address)
+                    break
+
+        except (ConnectionError, OSError) as msg:
+            log.warning("Socket error: %s", msg, extra={"address": format_address(address)})
+        except Exception:
+            log.exception("Error handling client", extra={"address": format_address(address)})
+        finally:
+            metrics.connections.close()
+            log.info("Client disconnected", extra={"address": format_address(address)})
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def handle_multiplexed_client(self, connection, address):
+        """
+        Read requests from a multiplexed connection and run each as its own task
+        Uploads are read here, in order, before the next request frame
+        """
+        in_flight = asyncio.Semaphore(MUX_MAX_IN_FLIGHT)
+        tasks = set()
+        try:
+            request = None
+            while request != 'EXIT':
+                request_id, payload = await protocol.AsyncProtocol.recv_frame(connection.reader, connection)
+
+                if not payload:
+                    break
+
+                request, params = methods.parse_request(payload)
+
+                if not request:
+                    break
+
+                channel = protocol.RequestChannel(connection, request_id)
+                if request in methods.UPLOAD_COMMANDS:
+                    loop = asyncio.get_running_loop()
+                    channel.upload = await loop.run_in_executor(self.executor, methods.receive_image, channel)
+
+                await in_flight.acquire()
+                task = asyncio.create_task(self.run_multiplexed_request(request, params, channel, address))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda t: in_flight.release())
+        finally:
+            # Let outstanding requests answer before the connection is closed,
+            # but don't let a stuck handler hold the connection open forever
+            if tasks:
+                done, pending = await asyncio.wait(tasks, timeout=MUX_DRAIN_TIMEOUT)
+                if pending:
+                    log.warning("Closing with %d requests still running", len(pending),
+                                extra={"address": format_address(address)})
+
+    async def run_multiplexed_request(self, request, params, channel, address):
+        """Handle one request of a multiplexed connection and send its reply"""
+        response = await self.handle_client_request(request, params, channel, address)
+        await self.send_response_to_client(response, channel)
+
+    @staticmethod
+    async def receive_client_request(connection, address):
+        """
+        Receive request from client and parse command/parameters
+        Returns: (command, params_list)
+        """
+        try:
+            request = await protocol.AsyncProtocol.recv(connection.reader, connection)
+
+            if not request:
+                return None, None
+
+            return methods.parse_request(request)
+
+        except (ConnectionError, OSError) as msg:
+            log.warning("Socket error receiving: %s", msg, extra={"address": format_address(address)})
+            return None, None
+        except Exception as msg:
+            log.warning("Error receiving: %s", msg, extra={"address": format_address(address)})
+            return None, None
+
+    async def handle_client_request(self, request, params, connection, address):
+        """
+        Route request to its Methods handler through the dispatcher, which
+        may refuse it right away when the server is busy
+        Returns: response string (JSON)
+        """
+        try:
+            return await asyncio.wrap_future(methods.DISPATCHER.submit(request, params, connection, address))
+        except Exception as msg:
+            log.exception("Error handling request %s", request, extra={"command": request})
+            return json.dumps({
+                "status": "error",
+                "message": f"Server error: {str(msg)}"
+            })
+
+    @staticmethod
+    async def send_response_to_client(response, connection):
+        """Send response to client"""
+        request_id = getattr(connection, 'request_id', None)
+        try:
+            await protocol.AsyncProtocol.send(
+                connection.writer, connection, serialization.encode_reply(connection, response), request_id
+            )
+        except ValueError as msg:
+            # Response too large for the connection's framing
+            log.warning("Error sending response: %s", msg)
+            await protocol.AsyncProtocol.send(connection.writer, connection, protocol.oversized_reply(connection),
+                                              request_id)
+        except (ConnectionError, OSError) as msg:
+            log.warning("Socket error sending response: %s", msg)
+
+
+def raise_fd_limit():
+    """Raise the open-file soft limit to the hard limit so thousands of idle clients fit"""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
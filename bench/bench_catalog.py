@@ -0,0 +1,129 @@
+"""
+Load time, memory and query latency of the local product catalog
+Generates a synthetic catalog (brand, colour, material, product type, model
+number and a short description per product), loads it with catalog.Catalog,
+saves it as a .catalog file, opens that with catalog.MappedCatalog and times
+queries of three kinds on both:
+
+  specific  brand + product + model number, matching a handful of products
+  typical   two or three common words, e.g. "red leather jacket"
+  broad     one word found in a large share of the catalog, e.g. "shoes"
+
+Usage: python bench/bench_catalog.py [--rows N] [--queries N] [--catalog PATH]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog, MappedCatalog  # noqa: E402
+
+BRANDS = [f"brand{i}" for i in range(500)] + ["nike", "adidas", "sony", "apple", "ikea", "levis", "samsung"]
+COLOURS = ["red", "blue", "green", "black", "white", "grey", "navy", "pink", "beige", "orange"]
+MATERIALS = ["leather", "cotton", "wool", "steel", "wooden", "plastic", "glass", "denim", "canvas", "bamboo"]
+PRODUCTS = ["shoes", "jacket", "headphones", "backpack", "watch", "lamp", "mug", "chair", "sofa", "phone case",
+            "running shoes", "desk", "t-shirt", "jeans", "speaker", "kettle", "blender", "pillow", "rug", "sunglasses"]
+WORDS = ["comfortable", "durable", "lightweight", "premium", "classic", "modern", "waterproof", "wireless",
+         "ergonomic", "compact", "portable", "handmade", "slim", "vintage", "organic", "adjustable"]
+
+
+def make_row(rng, i):
+    brand = rng.choice(BRANDS)
+    product = rng.choice(PRODUCTS)
+    return {
+        "name": f"{brand.title()} {rng.choice(COLOURS)} {rng.choice(MATERIALS)} {product} M{i % 100000:05d}",
+        "brand": brand,
+        "category": product,
+        "description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))),
+        "price": round(rng.uniform(5, 500), 2),
+        "source": f"Store {rng.randint(1, 40)}",
+        "link": f"https://shop.example.com/p/{i}",
+        "thumbnail": f"https://img.example.com/{i}.jpg",
+        "rating": round(rng.uniform(2.5, 5.0), 1),
+        "reviews": rng.randint(0, 5000)
+    }
+
+
+def write_catalog(path, rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(rows):
+            f.write(json.dumps(make_row(rng, i)) + "\n")
+
+
+def rss_mb():
+    """Returns: this process's resident memory in MB (Linux), or None"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def queries_of(kind, rng, rows):
+    if kind == "specific":
+        return f"{rng.choice(BRANDS)} {rng.choice(PRODUCTS)} m{rng.randrange(min(rows, 100000)):05d}"
+    if kind == "typical":
+        return f"{rng.choice(COLOURS)} {rng.choice(MATERIALS)} {rng.choice(PRODUCTS)}"
+    return rng.choice(PRODUCTS).split()[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local product catalog")
+    parser.add_argument("--rows", type=int, default=500000, help="products to generate")
+    parser.add_argument("--queries", type=int, default=300, help="queries per kind")
+    parser.add_argument("--catalog", help="use this catalog file instead of generating one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.catalog
+        if not path:
+            path = os.path.join(directory, "catalog.jsonl")
+            started = time.perf_counter()
+            write_catalog(path, args.rows)
+            print(f"generated {args.rows} products ({os.path.getsize(path) / 2 ** 20:.0f} MB) "
+                  f"in {time.perf_counter() - started:.1f} s")
+
+        before = rss_mb()
+        catalog = Catalog.load(path)
+        after = rss_mb()
+        stats = catalog.stats()
+        print(f"loaded {stats['products']} products, {stats['terms']} terms, {stats['postings']} postings "
+              f"in {stats['load_seconds']:.1f} s" + (f", +{after - before:.0f} MB RSS" if before else ""))
+
+        mapped_path = os.path.join(directory, "products.catalog")
+        started = time.perf_counter()
+        catalog.save(mapped_path)
+        print(f"saved {os.path.getsize(mapped_path) / 2 ** 20:.0f} MB .catalog file "
+              f"in {time.perf_counter() - started:.1f} s")
+
+        before = rss_mb()
+        mapped = MappedCatalog(mapped_path)
+        after = rss_mb()
+        print(f"mapped in {mapped.load_seconds * 1000:.2f} ms" + (f", +{after - before:.0f} MB RSS" if before else ""))
+
+        for name, index in (("memory", catalog), ("mapped", mapped)):
+            rng = random.Random(1)
+            print(f"\n{name:>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+            for kind in ("specific", "typical", "broad"):
+                latencies = []
+                for _ in range(args.queries):
+                    query = queries_of(kind, rng, len(index))
+                    started = time.perf_counter()
+                    index.search(query)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                latencies.sort()
+                p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]  # noqa: E731
+                print(f"{kind:>9} {p(0.50):>8.2f} {p(0.95):>8.2f} {p(0.99):>8.2f} {latencies[-1]:>8.2f}")
+        if before:
+            print(f"\nmapped pages touched by the queries: +{rss_mb() - after:.0f} MB RSS")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Micro-benchmark for receiving image uploads on the server
+Compares the old `image_data += chunk` loop (4096-byte recv) with
+protocol.recv_upload (preallocated bytearray filled with recv_into)
+
+Each (method, size) pair runs in its own process so peak RSS is measured
+independently. Unix only (uses the resource module).
+
+Usage: python bench/bench_image_upload.py [--rounds N]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import protocol  # noqa: E402
+from constants import IMAGE_RECV_CHUNK_SIZE  # noqa: E402
+
+
+SIZES_MB = [1, 5, 10]
+
+
+def recv_concat(my_socket, image_size):
+    """The receive loop IMAGE_SEARCH used before recv_upload"""
+    image_data = b""
+    while len(image_data) < image_size:
+        chunk = my_socket.recv(min(4096, image_size - len(image_data)))
+        if not chunk:
+            break
+        image_data += chunk
+    return image_data
+
+
+def recv_preallocated(my_socket, image_size):
+    buffer, received = protocol.recv_upload(my_socket, image_size, IMAGE_RECV_CHUNK_SIZE)
+    return buffer
+
+
+METHODS = {
+    "concat": recv_concat,
+    "recv_into": recv_preallocated
+}
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def worker(method, size, rounds):
+    """Receive `rounds` uploads of `size` bytes and print a JSON result line"""
+    receive = METHODS[method]
+    left, right = socket.socketpair()
+    payload = os.urandom(size)
+
+    def sender():
+        view = memoryview(payload)
+        for _ in range(rounds):
+            left.sendall(view)
+
+    baseline = peak_rss_kb()
+    thread = threading.Thread(target=sender, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(rounds):
+        data = receive(right, size)
+        if len(data) != size:
+            raise RuntimeError(f"Short upload: expected {size}, got {len(data)}")
+        del data
+    elapsed = time.perf_counter() - start
+    thread.join()
+
+    print(json.dumps({
+        "method": method,
+        "size": size,
+        "mb_per_s": size * rounds / elapsed / (1024 * 1024),
+        "peak_rss_growth_kb": peak_rss_kb() - baseline
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image upload receive paths")
+    parser.add_argument("--rounds", type=int, default=5, help="uploads per measurement")
+    parser.add_argument("--worker", nargs=2, metavar=("METHOD", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker[0], int(args.worker[1]), args.rounds)
+        return
+
+    print(f"{'size':>6} {'method':>10} {'MB/s':>10} {'peak RSS growth':>16}")
+    for size_mb in SIZES_MB:
+        size = size_mb * 1024 * 1024
+        for method in METHODS:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "--rounds", str(args.rounds),
+                 "--worker", method, str(size)],
+                cwd=ROOT
+            )
+            result = json.loads(output)
+            print(f"{size_mb:>4}MB {method:>10} {result['mb_per_s']:>10.1f} "
+                  f"{result['peak_rss_growth_kb'] / 1024:>13.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
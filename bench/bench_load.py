@@ -0,0 +1,443 @@
+"""
+Load test for the shopping server
+Starts stub SerpAPI and Azure OpenAI endpoints (configurable latency and
+error rate), runs the server against them in a child process
+(load_server.py), and drives N concurrent ShoppingClients through a weighted
+mix of LOGIN / SEARCH_PRODUCT / IMAGE_SEARCH for a fixed time.
+
+Reports throughput, p50/p95/p99 latency and error rate per operation, plus
+the server process's RSS and CPU use, as JSON (--output) for tracking between
+releases. With --baseline, compares against an earlier report and exits
+with status 1 if throughput or p95/p99 got worse by more than --tolerance.
+
+Rate limits are off unless --rate-limits is given, and server logging is
+off unless --log-level is given, so neither caps what is measured.
+
+Usage: python bench/bench_load.py [--clients N] [--duration S] [--mix search=8,image=1,login=1]
+           [--serpapi-latency MS] [--azure-latency MS] [--error-rate F] [--engine threaded|async]
+           [--output report.json] [--baseline report.json]
+"""
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from PIL import Image  # noqa: E402
+from client import ShoppingClient, StreamCollector  # noqa: E402
+from constants import USERS  # noqa: E402
+from stub_upstreams import StubSerpApi, StubAzureOpenAI  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATIONS = ["login", "search", "image"]
+QUANTILES = [("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)]
+WORDS = ["red", "blue", "running", "leather", "wireless", "kids", "winter", "cotton",
+         "shoes", "jacket", "headphones", "backpack", "watch", "lamp", "mug", "chair"]
+
+
+def parse_mix(text):
+    """'search=8,image=1' -> {"search": 8.0, "image": 1.0}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {OPERATIONS}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def make_images(directory, count, size):
+    """Noise JPEGs, so each one is a different image to the server's caches; Returns: paths"""
+    rng = random.Random(0)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"image_{i}.jpg")
+        pixels = rng.randbytes(size[0] * size[1] * 3)
+        Image.frombytes("RGB", size, pixels).save(path, quality=85)
+        paths.append(path)
+    return paths
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def summarize(samples, seconds):
+    """Returns: count, throughput, error rate and latency percentiles for (latency_ms, error) samples"""
+    latencies = sorted(latency for latency, error in samples)
+    errors = {}
+    for latency, error in samples:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+    failed = sum(errors.values())
+    result = {
+        "count": len(samples),
+        "throughput_rps": round(len(samples) / seconds, 2) if seconds else 0.0,
+        "errors": failed,
+        "error_rate": round(failed / len(samples), 4) if samples else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0
+    }
+    for name, q in QUANTILES:
+        result[name] = round(percentile(latencies, q), 2)
+    result["max_ms"] = round(latencies[-1], 2) if latencies else 0.0
+    result["error_codes"] = errors
+    return result
+
+
+class ProcessSampler(object):
+    """Samples a process's RSS and CPU time in the background (psutil, or /proc on Linux)"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.process = psutil.Process(pid) if psutil else None
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def rss(self):
+        """Returns: resident set size in bytes, or None if it can't be read"""
+        if self.process is not None:
+            return self.process.memory_info().rss
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    def cpu_seconds(self):
+        """Returns: user + system CPU time in seconds, or None if it can't be read"""
+        if self.process is not None:
+            times = self.process.cpu_times()
+            return times.user + times.system
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat:
+                # Fields after the command name, which may contain spaces
+                fields = stat.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.cpu_at_start = self.cpu_seconds()
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss() or 0)
+
+    def stop(self):
+        """Returns: RSS and CPU use of the process while sampled"""
+        self.stopped.set()
+        self.thread.join()
+        elapsed = time.monotonic() - self.started
+        rss = self.rss()
+        cpu = self.cpu_seconds()
+        used = cpu - self.cpu_at_start if cpu is not None and self.cpu_at_start is not None else None
+        return {
+            "pid": self.pid,
+            "rss_mb_end": round(rss / 2 ** 20, 1) if rss else None,
+            "rss_mb_peak": round(max(self.peak_rss, rss or 0) / 2 ** 20, 1) if rss else None,
+            "cpu_seconds": round(used, 2) if used is not None else None,
+            "cpu_percent": round(used / elapsed * 100, 1) if used is not None else None
+        }
+
+
+class VirtualUser(object):
+    """One client connection running random operations from the mix until told to stop"""
+
+    def __init__(self, index, args, images, queries):
+        self.index = index
+        self.args = args
+        self.images = images
+        self.queries = queries
+        self.rng = random.Random(args.seed + index)
+        self.username, self.password = list(USERS.items())[index % len(USERS)]
+        self.operations = list(args.mix)
+        self.weights = [args.mix[name] for name in self.operations]
+        self.client = None
+        # (operation, started, latency_ms, error code or None)
+        self.samples = []
+
+    def connect(self):
+        self.client = ShoppingClient(self.args.ip, self.args.port, multiplex=self.args.multiplex,
+                                     stream=self.args.stream, compress=self.args.compress)
+
+    def timed(self, operation, fn):
+        started = time.monotonic()
+        try:
+            error = fn()
+        except Exception as msg:
+            error = type(msg).__name__
+        self.samples.append((operation, started, (time.monotonic() - started) * 1000, error))
+
+    def login(self):
+        if self.client.session_id:
+            self.client.logout()
+        return None if self.client.login(self.username, self.password) else "LOGIN_FAILED"
+
+    def search(self):
+        query = self.rng.choice(self.queries)
+        collector = StreamCollector()
+        reply = collector.complete(
+            self.client.send_command(f"SEARCH_PRODUCT {self.client.session_id} {query}", collector))
+        return reply_error(reply)
+
+    def image(self):
+        products, message = self.client.image_search(self.rng.choice(self.images))
+        # image_search only passes on the message of an error reply, not its code
+        return error_key(message) if products is None else None
+
+    def run(self, stop):
+        self.timed("login", self.login)
+        while not stop.is_set():
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            if not self.client.session_id and operation != "login":
+                operation = "login"
+            self.timed(operation, getattr(self, operation))
+            if self.args.think_time:
+                stop.wait(self.rng.expovariate(1000 / self.args.think_time))
+
+
+def reply_error(reply):
+    """Returns: None for a success reply, otherwise its error code (or a short description)"""
+    if reply is None:
+        return "NO_REPLY"
+    if reply.get("status") == "success":
+        return None
+    return reply.get("code") or error_key(reply.get("message"))
+
+
+def error_key(message):
+    """Error message shortened to group alike errors, e.g. 'SerpAPI is unavailable, retry after N ms'"""
+    return re.sub(r"\d+", "N", (message or "ERROR").split(":")[0])[:60]
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(ip, port, process, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            socket.create_connection((ip, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not listen on {ip}:{port} within {timeout} s")
+
+
+def start_server(args, serpapi, azure, directory):
+    env = dict(os.environ,
+               SERPAPI_URL=serpapi.url + "/search", SERPAPI_KEY="bench",
+               AZURE_OPENAI_ENDPOINT=azure.url, AZURE_OPENAI_API_KEY="bench")
+    command = [sys.executable, os.path.join(BENCH_DIR, "load_server.py"),
+               "--ip", args.ip, "--port", str(args.port), "--engine", args.engine, "--log-level", args.log_level]
+    if args.rate_limits:
+        command.append("--rate-limits")
+    if args.no_search_cache:
+        command.append("--no-search-cache")
+    if args.catalog:
+        command += ["--catalog", os.path.abspath(args.catalog)]
+    log = open(os.path.join(directory, "server.log"), "w")
+    process = subprocess.Popen(command, cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for_port(args.ip, args.port, process)
+    return process
+
+
+def server_stats(args):
+    """Returns: the server's STATS reply"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        client = ShoppingClient(args.ip, args.port, multiplex=False, stream=False)
+        try:
+            return client.send_command("STATS")
+        finally:
+            client.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    """Returns: the report (dict)"""
+    serpapi = StubSerpApi(latency=args.serpapi_latency / 1000, error_rate=args.error_rate).start()
+    azure = StubAzureOpenAI(latency=args.azure_latency / 1000, error_rate=args.error_rate).start()
+    rng = random.Random(args.seed)
+    queries = [f"{rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(args.queries)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_images(directory, args.images, args.image_size)
+        process = start_server(args, serpapi, azure, directory)
+        try:
+            users = [VirtualUser(i, args, images, queries) for i in range(args.clients)]
+            # ShoppingClient prints as it goes; keep that out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                for user in users:
+                    user.connect()
+
+                sampler = ProcessSampler(process.pid).start()
+                stop = threading.Event()
+                threads = [threading.Thread(target=user.run, args=(stop,), daemon=True) for user in users]
+                started = time.monotonic()
+                for thread in threads:
+                    thread.start()
+                time.sleep(args.warmup + args.duration)
+                stop.set()
+                for thread in threads:
+                    thread.join()
+                server = sampler.stop()
+                for user in users:
+                    user.client.close()
+
+            server["stats"] = server_stats(args)
+        finally:
+            process.terminate()
+            process.wait()
+            serpapi.stop()
+            azure.stop()
+
+    # Only operations started after the warm-up count
+    measured_from = started + args.warmup
+    by_operation = {}
+    for user in users:
+        for operation, began, latency, error in user.samples:
+            if began >= measured_from:
+                by_operation.setdefault(operation, []).append((latency, error))
+
+    return {
+        "benchmark": "shopping-load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+        "overall": summarize([sample for samples in by_operation.values() for sample in samples], args.duration),
+        "operations": {operation: summarize(by_operation[operation], args.duration)
+                       for operation in OPERATIONS if operation in by_operation},
+        "server": server,
+        "upstream_requests": {"serpapi": serpapi.requests, "azure_openai": azure.requests}
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns: descriptions of throughput drops and p95/p99 increases beyond tolerance"""
+    regressions = []
+    for operation, current in dict(report["operations"], overall=report["overall"]).items():
+        before = baseline["overall"] if operation == "overall" else baseline.get("operations", {}).get(operation)
+        if not before:
+            continue
+        if current["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{operation} throughput {before['throughput_rps']} -> {current['throughput_rps']} rps")
+        for name in ("p95_ms", "p99_ms"):
+            if current[name] > before[name] * (1 + tolerance):
+                regressions.append(f"{operation} {name} {before[name]} -> {current[name]}")
+    return regressions
+
+
+def print_summary(report, out):
+    print(f"{'operation':<10} {'count':>7} {'rps':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+          file=out)
+    rows = dict(report["operations"], overall=report["overall"])
+    for operation, row in rows.items():
+        print(f"{operation:<10} {row['count']:>7} {row['throughput_rps']:>8.1f} {row['error_rate']:>7.2%} "
+              f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f}", file=out)
+    server = report["server"]
+    print(f"server: rss peak {server['rss_mb_peak']} MB, cpu {server['cpu_percent']}% "
+          f"({server['cpu_seconds']} s); upstream requests {report['upstream_requests']}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the shopping server against stub upstreams")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent client connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds run before measuring")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("search=8,image=1,login=1"),
+                        help="operation weights, e.g. search=8,image=1,login=1")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean ms a client waits between operations")
+    parser.add_argument("--queries", type=int, default=200, help="distinct search queries")
+    parser.add_argument("--images", type=int, default=8, help="distinct images uploaded")
+    parser.add_argument("--image-size", type=lambda text: tuple(int(n) for n in text.split("x")),
+                        default=(640, 480), help="WIDTHxHEIGHT of the uploaded images")
+    parser.add_argument("--serpapi-latency", type=float, default=50.0, help="ms the SerpAPI stub takes")
+    parser.add_argument("--azure-latency", type=float, default=300.0, help="ms the Azure OpenAI stub takes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests answered 503")
+    parser.add_argument("--engine", choices=["threaded", "async"], default="threaded")
+    parser.add_argument("--multiplex", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--compress", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--rate-limits", action="store_true", help="keep the server's rate limits on")
+    parser.add_argument("--no-search-cache", action="store_true", help="send every search to the SerpAPI stub")
+    parser.add_argument("--catalog", help="search this local catalog file (providers.LocalCatalogProvider) "
+                                          "instead of the SerpAPI stub")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"], default="OFF",
+                        help="server log level (lines go to a temp file)")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="server port (default: a free one)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed fractional throughput drop / p95-p99 increase vs the baseline")
+    args = parser.parse_args()
+    args.port = args.port or free_port()
+
+    report = run(args)
+    print_summary(report, sys.stderr)
+
+    exit_status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        exit_status = 1 if regressions else 0
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(exit_status)
+
+
+if __name__ == '__main__':
+    main()
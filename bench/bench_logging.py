@@ -0,0 +1,127 @@
+"""
+Per-request cost of request logging
+Runs a trivial command through the Dispatcher (pool hand-off, metrics and the
+completion log line included) from 1 and 8 client threads, with:
+
+  off     logging disabled (--log-level OFF)
+  info    JSON lines at INFO through the queue (logs.setup_logging)
+  print   the old synchronous print() calls per request
+
+Each is run against a temp file, and against a "slow" stream that takes
+--write-ms per write, like a terminal or a pipe whose reader is behind:
+print() makes every request wait for it, the queue keeps it off the request.
+
+Usage: python bench/bench_logging.py [--requests N] [--write-ms MS]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logs  # noqa: E402
+import metrics  # noqa: E402
+from dispatcher import Dispatcher, WorkPool  # noqa: E402
+
+THREADS = [1, 8]
+ADDRESS = ("127.0.0.1", 50000)
+
+
+class Handlers(object):
+    """A command that does no work, so only the per-request overhead is left"""
+
+    output = None
+
+    @staticmethod
+    def PING(my_socket, params, address):
+        return json.dumps({"status": "success", "message": "pong"})
+
+    @staticmethod
+    def PING_PRINT(my_socket, params, address):
+        print(f"Client {address} sent command: PING_PRINT", file=Handlers.output, flush=True)
+        print(f"Client {address} sent params: {params}", file=Handlers.output, flush=True)
+        return json.dumps({"status": "success", "message": "pong"})
+
+
+class SlowStream(object):
+    """File wrapper whose every write takes `delay` seconds"""
+
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def run(dispatcher, command, threads, requests):
+    """Returns: microseconds per request, wall time over all threads"""
+    per_thread = requests // threads
+
+    def client():
+        for _ in range(per_thread):
+            dispatcher.submit(command, ["user", "shoes"], None, ADDRESS).result()
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (per_thread * threads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request logging overhead")
+    parser.add_argument("--requests", type=int, default=20000, help="requests per measurement")
+    parser.add_argument("--write-ms", type=float, default=1.0, help="time per write on the slow stream")
+    args = parser.parse_args()
+
+    dispatcher = Dispatcher(
+        Handlers,
+        {"PING", "PING_PRINT"},
+        WorkPool("cheap", 8, 1000),
+        WorkPool("expensive", 1, 1),
+        command_metrics=metrics.CommandMetrics()
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'stream':>6} {'mode':>6} {'threads':>8} {'us/request':>11} {'overhead us':>12}")
+        for slow in (False, True):
+            name = "slow" if slow else "file"
+            # The slow stream makes print() take ms per request, so it gets fewer
+            requests = max(200, args.requests // 50) if slow else args.requests
+            for threads in THREADS:
+                logs.setup_logging(None)
+                run(dispatcher, "PING", threads, requests // 10)
+                baseline = run(dispatcher, "PING", threads, requests)
+                print(f"{name:>6} {'off':>6} {threads:>8} {baseline:>11.1f} {0.0:>12.1f}")
+
+                with open(os.path.join(directory, "info.log"), "w") as stream:
+                    stream = SlowStream(stream, args.write_ms / 1000) if slow else stream
+                    pipeline = logs.setup_logging("INFO", sample_rates={}, stream=stream)
+                    took = run(dispatcher, "PING", threads, requests)
+                    pipeline.stop()
+                print(f"{name:>6} {'info':>6} {threads:>8} {took:>11.1f} {took - baseline:>12.1f}")
+
+                logs.setup_logging(None)
+                with open(os.path.join(directory, "print.log"), "w") as stream:
+                    Handlers.output = SlowStream(stream, args.write_ms / 1000) if slow else stream
+                    took = run(dispatcher, "PING_PRINT", threads, requests)
+                print(f"{name:>6} {'print':>6} {threads:>8} {took:>11.1f} {took - baseline:>12.1f}")
+
+                dropped = pipeline.stats()["dropped_queue_full"]
+                if dropped:
+                    print(f"{'':>6} ({dropped} records dropped with the log queue full)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Throughput benchmark for protocol framings
+Compares the legacy ASCII-prefix algorithm with BINARY framing over a socketpair
+
+The real legacy framing caps frames at 9999 bytes, so the legacy numbers
+use the same send/recv algorithm with a prefix wide enough for each size.
+
+Usage: python bench/bench_protocol.py [--rounds N]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol  # noqa: E402
+
+
+SIZES = [1024, 16 * 1024, 256 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+LEGACY_WIDTH = 10
+
+
+def legacy_send(my_socket, data):
+    """Legacy algorithm: ASCII length prefix, single send of prefix + payload"""
+    my_socket.sendall(str(len(data)).zfill(LEGACY_WIDTH).encode() + data)
+
+
+def legacy_recv(my_socket):
+    """Legacy algorithm: accumulate the payload with bytes concatenation"""
+    size = LEGACY_WIDTH
+    tot_data = b''
+    while size > 0:
+        data = my_socket.recv(size)
+        if not data:
+            return b''
+        size -= len(data)
+        tot_data += data
+
+    size = int(tot_data.decode())
+    tot_data = b''
+    while size > 0:
+        data = my_socket.recv(size)
+        if not data:
+            return b''
+        size -= len(data)
+        tot_data += data
+    return tot_data
+
+
+def binary_send(my_socket, data):
+    protocol.Protocol.send_binary(my_socket, data)
+
+
+def binary_recv(my_socket):
+    return protocol.Protocol.recv_binary(my_socket)
+
+
+def run(send, recv, size, rounds):
+    """
+    Send `rounds` frames of `size` bytes from one end of a socketpair to the other
+    Returns: throughput in MB/s
+    """
+    left, right = socket.socketpair()
+    payload = os.urandom(size)
+
+    def sender():
+        for _ in range(rounds):
+            send(left, payload)
+
+    thread = threading.Thread(target=sender, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(rounds):
+        frame = recv(right)
+        if len(frame) != size:
+            raise RuntimeError(f"Short frame: expected {size}, got {len(frame)}")
+    elapsed = time.perf_counter() - start
+    thread.join()
+
+    left.close()
+    right.close()
+    return size * rounds / elapsed / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark protocol framings")
+    parser.add_argument("--rounds", type=int, default=20, help="frames per size")
+    args = parser.parse_args()
+
+    print(f"{'size':>10} {'legacy MB/s':>12} {'binary MB/s':>12} {'speedup':>8}")
+    for size in SIZES:
+        rounds = max(2, args.rounds * 1024 * 1024 // max(size, 1024 * 1024))
+        legacy = run(legacy_send, legacy_recv, size, rounds)
+        binary = run(binary_send, binary_recv, size, rounds)
+        print(f"{size:>10} {legacy:>12.1f} {binary:>12.1f} {binary / legacy:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
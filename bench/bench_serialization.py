@@ -0,0 +1,94 @@
+"""
+Encode/decode benchmark for the reply encodings (JSON, COLUMNAR, MSGPACK)
+Uses SEARCH_PRODUCT-shaped replies with 10 to 100 products and reports the
+bytes on the wire next to the time to encode and decode one reply
+
+"server" is what one reply costs the server: the handler's json.dumps plus,
+for compact encodings, re-encoding that text (serialization.encode_reply).
+"client" is the time to decode it.
+
+Usage: python bench/bench_serialization.py [--rounds N]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialization  # noqa: E402
+
+
+COUNTS = [10, 25, 50, 100]
+
+
+def realistic_products(count):
+    """Products shaped like google_search results, with SerpAPI-length URLs"""
+    return [
+        {
+            "id": i + 1,
+            "name": f"Nike Air Zoom Pegasus 40 Men's Road Running Shoes - Size {7 + i % 8}",
+            "price": f"${89.99 + i * 3:.2f}",
+            "source": ["Nike", "Amazon.com", "Foot Locker", "Dick's Sporting Goods"][i % 4],
+            "link": f"https://www.google.com/url?url=https://www.store{i % 4}.com/product/"
+                    f"air-zoom-pegasus-40-{100000 + i}&rct=j&q=&esrc=s&opi=95576897&sa=U&ved=0ahUKEwi{i:06d}",
+            "product_link": f"https://www.google.com/shopping/product/{1234567890123456789 + i}"
+                            f"?gl=us&prds=pid:{9876543210 + i}",
+            "thumbnail": f"https://encrypted-tbn{i % 4}.gstatic.com/shopping?q=tbn:ANd9GcQ{i:08d}"
+                         f"xYzAbCdEfGhIjKlMnOpQrStUvWxYz0123456789&usqp=CAE",
+            "rating": round(3.5 + (i % 15) / 10, 1),
+            "reviews": 120 + i * 37
+        }
+        for i in range(count)
+    ]
+
+
+def reply_for(count):
+    return {
+        "status": "success",
+        "products": realistic_products(count),
+        "query": "running shoes",
+        "count": count
+    }
+
+
+def timed(fn, rounds):
+    """Returns: microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reply encodings")
+    parser.add_argument("--rounds", type=int, default=2000, help="encodes/decodes per measurement")
+    args = parser.parse_args()
+
+    encodings = serialization.SUPPORTED_ENCODINGS
+    if serialization.ENCODING_MSGPACK not in encodings:
+        print("msgpack is not installed; MSGPACK is skipped\n")
+
+    print(f"{'products':>8} {'encoding':>9} {'bytes':>8} {'saved':>7} {'server us':>10} {'client us':>10}")
+    for count in COUNTS:
+        reply = reply_for(count)
+        json_size = len(json.dumps(reply).encode())
+
+        for encoding in encodings:
+            connection = type("Connection", (), {"encoding": encoding})()
+            payload = serialization.encode_reply(connection, json.dumps(reply))
+            payload = payload.encode() if isinstance(payload, str) else payload
+
+            if serialization.decode(payload, encoding) != reply:
+                raise RuntimeError(f"{encoding} did not round-trip")
+
+            server = timed(lambda: serialization.encode_reply(connection, json.dumps(reply)), args.rounds)
+            client = timed(lambda: serialization.decode(payload, encoding), args.rounds)
+            saved = 1 - len(payload) / json_size
+            print(f"{count:>8} {encoding:>9} {len(payload):>8} {saved:>6.1%} {server:>10.1f} {client:>10.1f}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
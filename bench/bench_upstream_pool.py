@@ -0,0 +1,95 @@
+"""
+Per-request latency of fresh vs shared upstream clients
+Runs against local stub servers, so the difference is connection and
+client setup only (no TLS here - against the real HTTPS APIs the saving
+per request is larger)
+
+Usage: python bench/bench_upstream_pool.py [--requests N] [--threads N]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import requests  # noqa: E402
+from openai import AzureOpenAI  # noqa: E402
+import upstream_clients  # noqa: E402
+from stub_upstreams import StubSerpApi, StubAzureOpenAI  # noqa: E402
+
+
+PARAMS = {"engine": "google_shopping", "q": "laptop", "api_key": "bench", "num": 10}
+
+
+def serpapi_fresh(url):
+    """What serpapi.GoogleSearch does: a module-level requests.get per search"""
+    return requests.get(url, params=PARAMS, timeout=10).json()
+
+
+def azure_fresh(endpoint):
+    """What analyze_image_for_products used to do: a new client per call"""
+    client = AzureOpenAI(azure_endpoint=endpoint, api_key="bench", api_version="2024-02-15-preview",
+                         http_client=httpx.Client())
+    try:
+        return client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "hi"}])
+    finally:
+        client.close()
+
+
+def measure(fn, requests_count, threads):
+    """Returns: list of per-request latencies in ms"""
+    def timed(_):
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(timed, range(requests_count)))
+
+
+def report(name, latencies, stub):
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<22} mean {statistics.mean(latencies):7.2f} ms  p95 {p95:7.2f} ms  "
+          f"connections {stub.connections}")
+    stub.connections = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fresh vs pooled upstream clients")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    serpapi = StubSerpApi().start()
+    azure = StubAzureOpenAI().start()
+
+    pooled_serpapi = upstream_clients.SerpApiClient(url=serpapi.url + "/search")
+    os.environ["AZURE_OPENAI_ENDPOINT"] = azure.url
+    os.environ["AZURE_OPENAI_API_KEY"] = "bench"
+    pooled_azure = upstream_clients.AzureVisionClient()
+
+    def serpapi_pooled():
+        return pooled_serpapi.search(PARAMS)
+
+    def azure_pooled():
+        return pooled_azure.client.chat.completions.create(
+            model="gpt-4o", messages=[{"role": "user", "content": "hi"}]
+        )
+
+    report("serpapi fresh", measure(lambda: serpapi_fresh(serpapi.url + "/search"), args.requests, args.threads),
+           serpapi)
+    report("serpapi pooled", measure(serpapi_pooled, args.requests, args.threads), serpapi)
+    report("azure fresh client", measure(lambda: azure_fresh(azure.url), args.requests, args.threads), azure)
+    report("azure shared client", measure(azure_pooled, args.requests, args.threads), azure)
+
+    serpapi.stop()
+    azure.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Shopping server configured for load tests; started by bench_load.py
+Upstream URLs and keys come from the environment (SERPAPI_URL, SERPAPI_KEY,
+AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY), pointing at the stubs.
+Run from a scratch directory: the session and image cache databases are
+created in the working directory.
+
+Usage: python bench/load_server.py --port N [--engine threaded|async]
+           [--log-level OFF] [--rate-limits] [--no-search-cache] [--catalog PATH]
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logs  # noqa: E402
+import methods  # noqa: E402
+import ratelimit  # noqa: E402
+import providers  # noqa: E402
+import google_search  # noqa: E402
+import chatgpt_search  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shopping server for load tests")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--engine", choices=["threaded", "async"], default="threaded")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"], default="OFF")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the per-user and upstream rate limits (off by default, they would cap throughput)")
+    parser.add_argument("--no-search-cache", action="store_true", help="send every search to the SerpAPI stub")
+    parser.add_argument("--catalog", help="search this local catalog file instead of the SerpAPI stub")
+    args = parser.parse_args()
+
+    logs.setup_logging(None if args.log_level == "OFF" else args.log_level)
+    methods.open_stores()
+
+    if not args.rate_limits:
+        methods.USER_LIMITS = ratelimit.RateLimiter(rate=None, burst=0)
+        google_search.serpapi_limit = ratelimit.TokenBucket(rate=None, burst=0)
+        chatgpt_search.azure_limit = ratelimit.TokenBucket(rate=None, burst=0)
+    if args.no_search_cache:
+        google_search.set_search_cache(None)
+    if args.catalog:
+        providers.set_provider(providers.LocalCatalogProvider(args.catalog))
+    else:
+        providers.set_provider(providers.SerpApiProvider())
+
+    if args.engine == "async":
+        from async_server import AsyncShoppingServer
+        server = AsyncShoppingServer(args.ip, args.port)
+    else:
+        from server import ShoppingServer
+        server = ShoppingServer(args.ip, args.port)
+    server.handle_clients()
+
+
+if __name__ == '__main__':
+    main()
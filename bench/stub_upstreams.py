@@ -0,0 +1,165 @@
+"""
+Local stand-ins for the upstream APIs, for benchmarks and tests
+StubSerpApi answers like SerpAPI's Google Shopping engine with a
+configurable delay, on a plain HTTP/1.1 keep-alive server
+
+Faults can be injected per request: an HTTP status (e.g. 503) answers with
+that status, "hang" waits `hang` seconds before answering (to trip client
+timeouts) and "disconnect" closes the connection without an answer.
+error_rate answers that fraction of the remaining requests with
+`error_status`, for load tests against a flaky upstream
+"""
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_shopping_results(query, count=10):
+    """SerpAPI-shaped shopping results for a query"""
+    return [
+        {
+            "title": f"{query} - model {i + 1}",
+            "price": f"${19.99 + i * 10:.2f}",
+            "source": f"Store {i % 4 + 1}",
+            "link": f"https://store{i % 4 + 1}.example.com/item/{i + 1}",
+            "product_link": f"https://www.google.com/shopping/product/{1000 + i}",
+            "thumbnail": f"https://images.example.com/thumb/{1000 + i}.jpg",
+            "rating": 4.5,
+            "reviews": 100 + i
+        }
+        for i in range(count)
+    ]
+
+
+class StubServer(object):
+    """
+    Base class for stub upstreams: runs a ThreadingHTTPServer on a free
+    local port in a background thread
+    """
+
+    def __init__(self, latency=0.0, hang=5.0, error_rate=0.0, error_status=503, rng=random.random):
+        self.latency = latency
+        self.hang = hang
+        self.faults = []    # one-shot faults, used up in order
+        self.fault = None   # fault for every request once `faults` is empty
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = rng
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def take_fault(self):
+        with self.lock:
+            if self.faults:
+                return self.faults.pop(0)
+            if self.fault is None and self.error_rate and self.rng() < self.error_rate:
+                return self.error_status
+            return self.fault
+
+    def respond(self, handler, path, query, body):
+        """Override: return (status, payload dict)"""
+        raise NotImplementedError
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def setup(self):
+                super().setup()
+                stub.count_connection()
+
+            def handle_any(self):
+                stub.count_request()
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                parsed = urlparse(self.path)
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                fault = stub.take_fault()
+                if fault == "disconnect":
+                    self.close_connection = True
+                    return
+                if fault == "hang":
+                    time.sleep(stub.hang)
+
+                if isinstance(fault, int):
+                    status, payload = fault, {"error": f"Injected HTTP {fault}"}
+                else:
+                    status, payload = stub.respond(self, parsed.path, parse_qs(parsed.query), body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = handle_any
+            do_POST = handle_any
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class StubSerpApi(StubServer):
+    """Fake SerpAPI endpoint: GET /search?q=..."""
+
+    def respond(self, handler, path, query, body):
+        q = query.get("q", [""])[0]
+        return 200, {"shopping_results": fake_shopping_results(q)}
+
+
+class StubAzureOpenAI(StubServer):
+    """Fake Azure OpenAI endpoint: POST /openai/deployments/<name>/chat/completions"""
+
+    def __init__(self, latency=0.0, search_terms="red running shoes", **kwargs):
+        super().__init__(latency, **kwargs)
+        self.search_terms = search_terms
+
+    def respond(self, handler, path, query, body):
+        return 200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-4o",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": self.search_terms}
+            }],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        }
@@ -0,0 +1,147 @@
+"""
+In-memory result cache with TTL expiry and LRU eviction
+Used in front of slow upstream calls (product search, image analysis)
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(query, sort_words=False):
+    """
+    Build a cache key from a search query
+    Case and whitespace are ignored; with sort_words the word order is too
+    """
+    words = query.lower().split()
+    if sort_words:
+        words.sort()
+    return ' '.join(words)
+
+
+class ResultCache(object):
+    """
+    Thread-safe TTL + LRU cache
+
+    Entries expire `ttl` seconds after they are stored. When the cache holds
+    more than `max_entries` entries or `max_bytes` bytes (as measured by
+    `size_of`), the least recently used entries are evicted.
+
+    With a `stale_ttl`, expired entries are kept that much longer: get treats
+    them as misses, but get_stale still returns them, for serving something
+    while the upstream is down.
+
+    The lock is only held for dictionary operations, never while computing a
+    value, so the cache can also be used directly from an asyncio event loop.
+    """
+
+    def __init__(self, ttl=300, max_entries=1024, max_bytes=None, size_of=None, clock=time.monotonic, stale_ttl=0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_of = size_of or (lambda value: 0)
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        # key -> (expires_at, size, value), least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+
+    def get(self, key):
+        """
+        Look up a key
+        Returns: (found, value)
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            expires_at, size, value = entry
+            if expires_at <= now:
+                if expires_at + self.stale_ttl <= now:
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def get_stale(self, key):
+        """
+        Look up a key, accepting entries up to stale_ttl seconds past expiry
+        Returns: (found, value)
+        """
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] + self.stale_ttl <= now:
+                return False, None
+            self.stale_hits += 1
+            return True, entry[2]
+
+    def put(self, key, value):
+        """Store a value, evicting least recently used entries if over the limits"""
+        size = self.size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+
+        expires_at = self.clock() + self.ttl
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (expires_at, size, value)
+            self.total_bytes += size
+
+            while len(self.entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a single entry if present"""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        """Drop every entry (counters are kept)"""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Returns: dict with hit/miss/eviction counters and current size"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale_hits": self.stale_hits,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl
+            }
+
+    def _remove(self, key):
+        """Remove an entry; caller holds the lock"""
+        expires_at, size, value = self.entries.pop(key)
+        self.total_bytes -= size
@@ -0,0 +1,512 @@
+"""
+Product catalog with BM25 ranked search
+Loads a CSV or JSON-lines product file (optionally gzipped) into an inverted
+index: for every term, the ids of the products containing it and how often.
+A query scores only the products on its terms' lists, so it costs
+milliseconds even with millions of products.
+
+Products are stored by column rather than as a dict each: numbers (price,
+rating, reviews) in typed arrays, strings end to end in one buffer per column
+with an offset per product. A product dict is only built for the rows a
+search returns.
+
+Catalog.save writes the columns and the index to a .catalog file that
+MappedCatalog opens with mmap: nothing is parsed or copied at startup, pages
+are read in as searches touch them, and every process that opens the file
+shares them through the page cache. Build one with
+    python catalog.py products.jsonl products.catalog
+
+Terms on more than `candidate_limit` products (e.g. "shoe" in a shoe shop)
+are not scanned in full: they only add to the scores of products found
+through the query's rarer terms, or, when every query term is that common,
+contribute their `candidate_limit` best-scoring products (picked at build).
+"""
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import math
+import mmap
+import time
+import heapq
+import bisect
+import struct
+import argparse
+import functools
+from array import array
+from collections import Counter
+from constants import CATALOG_BM25_K1, CATALOG_BM25_B, CATALOG_CANDIDATE_LIMIT
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Columns searched, in addition to the product name
+TEXT_FIELDS = ("brand", "category", "description", "keywords")
+
+# Stored product columns: strings, and numbers with their array typecode
+STRING_COLUMNS = ("name", "price_text", "source", "link", "product_link", "thumbnail")
+NUMBER_COLUMNS = {"price": "d", "rating": "d", "reviews": "I"}
+
+# Largest values the compact arrays hold; longer products/more repeats/more reviews are capped
+MAX_TERM_FREQUENCY = 0xFFFF
+MAX_LENGTH = 0xFFFF
+MAX_REVIEWS = 0xFFFFFFFF
+
+# A binary search per candidate costs about this many steps of walking a postings list
+BISECT_COST = 20
+
+# .catalog file: a header (magic, offset and length of the table of contents),
+# the sections, each aligned to 8 bytes, then the table of contents as JSON
+CATALOG_FILE_SUFFIX = ".catalog"
+FILE_MAGIC = b"SHOPCAT1"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<8sQQ")
+SECTION_ALIGNMENT = 8
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def fold(token):
+    """Returns: token with a plural "s" removed, so "shoes" finds "shoe" """
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """Returns: the index terms of a text, in order"""
+    return [fold(token) for token in TOKEN_PATTERN.findall(text.lower())]
+
+
+def parse_price(price):
+    """
+    Returns: (number, "") for a numeric price, or (NaN, text) for text such as
+    "$19.99" or "From $5", which is shown as it is
+    """
+    if isinstance(price, (int, float)):
+        return float(price), ""
+    if not price:
+        return math.nan, ""
+    try:
+        return float(price), ""
+    except ValueError:
+        return math.nan, str(price)
+
+
+def to_number(value, kind):
+    try:
+        return kind(value) if value not in (None, "") else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def read_rows(path):
+    """Yields: one dict per product in a .csv or .jsonl file (either may end in .gz)"""
+    opener = gzip.open if path.endswith(".gz") else open
+    name = path[:-3] if path.endswith(".gz") else path
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        if name.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError as msg:
+                        raise ValueError(f"{path} line {number}: {msg}")
+
+
+class StringColumn(object):
+    """Strings end to end in one buffer: string i is data[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, data=None, offsets=None):
+        self.data = bytearray() if data is None else data
+        self.offsets = array("Q", [0]) if offsets is None else offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]], "utf-8")
+
+    def append(self, text):
+        self.data += text.encode()
+        self.offsets.append(len(self.data))
+
+    def find(self, text):
+        """Returns: the index of text in a sorted column, or -1"""
+        key = text.encode()
+        data, offsets = self.data, self.offsets
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            value = bytes(data[offsets[middle]:offsets[middle + 1]])
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    def sections(self, name):
+        """Returns: {section name: buffer} to save, with 32-bit offsets when the data allows"""
+        offsets = self.offsets
+        if len(self.data) <= 0xFFFFFFFF:
+            offsets = array("I", offsets)
+        return {f"{name}.data": self.data, f"{name}.offsets": offsets}
+
+
+class CatalogIndex(object):
+    """
+    BM25 search over products; subclasses provide the postings lists, the
+    per-product norms and the product columns
+    """
+
+    def __len__(self):
+        return len(self.norms)
+
+    def postings(self, term):
+        """Returns: (ids of the products containing term, ascending; its count in each), or None"""
+        raise NotImplementedError
+
+    def head(self, term):
+        """Returns: the postings of the candidate_limit best products of a very common term"""
+        raise NotImplementedError
+
+    def search(self, query, limit=10):
+        """
+        Returns: up to `limit` products for query, best first, each with its
+        rank as "id"
+        """
+        found = {}
+        for term in set(tokenize(query)):
+            postings = self.postings(term)
+            if postings is not None:
+                found[term] = postings
+        if not found:
+            return []
+
+        count = len(self)
+        scale = self.k1 + 1
+        norms = self.norms
+        scores = {}
+        get = scores.get
+        # Rarest first, so common terms have candidates to re-rank
+        for term in sorted(found, key=lambda term: len(found[term][0])):
+            ids, frequencies = found[term]
+            matches = len(ids)
+            weight = math.log(1 + (count - matches + 0.5) / (matches + 0.5)) * scale
+            if matches <= self.candidate_limit or not scores:
+                if matches > self.candidate_limit:
+                    ids, frequencies = self.head(term)
+                for doc_id, frequency in zip(ids, frequencies):
+                    scores[doc_id] = get(doc_id, 0.0) + weight * frequency / (frequency + norms[doc_id])
+            elif matches < len(scores) * BISECT_COST:
+                # Re-rank the candidates: walking the list is cheaper than a lookup per candidate
+                for doc_id, frequency in zip(ids, frequencies):
+                    if doc_id in scores:
+                        scores[doc_id] += weight * frequency / (frequency + norms[doc_id])
+            else:
+                for doc_id in scores:
+                    index = bisect.bisect_left(ids, doc_id)
+                    if index < matches and ids[index] == doc_id:
+                        frequency = frequencies[index]
+                        scores[doc_id] += weight * frequency / (frequency + norms[doc_id])
+
+        # Highest score first; equal scores in catalog order
+        best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [dict(id=rank, **self.product(doc_id)) for rank, (doc_id, score) in enumerate(best, 1)]
+
+    def product(self, doc_id):
+        """Returns: the product fields google_search returns ("id" is the rank, added per search)"""
+        columns = self.columns
+        price = columns["price"][doc_id]
+        link = columns["link"][doc_id]
+        return {
+            "name": columns["name"][doc_id],
+            # NaN (not equal to itself) means the price is text or missing
+            "price": f"${price:.2f}" if price == price else columns["price_text"][doc_id] or "Price not available",
+            "source": columns["source"][doc_id] or "Unknown",
+            "link": link or "#",
+            "product_link": columns["product_link"][doc_id] or link or "#",
+            "thumbnail": columns["thumbnail"][doc_id],
+            "rating": columns["rating"][doc_id],
+            "reviews": columns["reviews"][doc_id]
+        }
+
+
+class Catalog(CatalogIndex):
+    """
+    In-memory catalog; add() every product row, then finish() once
+    After finish() it is read-only and safe to search from any thread
+    """
+
+    def __init__(self, k1=CATALOG_BM25_K1, b=CATALOG_BM25_B, candidate_limit=CATALOG_CANDIDATE_LIMIT):
+        self.k1 = k1
+        self.b = b
+        self.candidate_limit = candidate_limit
+
+        # term -> product ids (ascending) and the term's count in each
+        self.doc_ids = {}
+        self.frequencies = {}
+        self.lengths = array("H")
+        self.columns = {name: StringColumn() for name in STRING_COLUMNS}
+        self.columns.update((name, array(typecode)) for name, typecode in NUMBER_COLUMNS.items())
+
+        # Set by finish()
+        self.norms = array("f")
+        self.heads = {}
+        self.posting_count = 0
+        self.average_length = 0.0
+        self.load_seconds = 0.0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, row):
+        """
+        Add a product row: "name" (or "title"), "price", "source" (or "store"),
+        "link", "product_link", "thumbnail", "rating" and "reviews", plus the
+        searched TEXT_FIELDS
+        Returns: False (skipping the row) if it has no name
+        """
+        name = row.get("name") or row.get("title")
+        if not name:
+            return False
+        doc_id = len(self.lengths)
+        terms = tokenize(" ".join([str(name)] + [str(row[field]) for field in TEXT_FIELDS if row.get(field)]))
+        for term, count in Counter(terms).items():
+            ids = self.doc_ids.get(term)
+            if ids is None:
+                ids = self.doc_ids[term] = array("I")
+                self.frequencies[term] = array("H")
+            ids.append(doc_id)
+            self.frequencies[term].append(count if count < MAX_TERM_FREQUENCY else MAX_TERM_FREQUENCY)
+        self.lengths.append(min(len(terms), MAX_LENGTH))
+
+        columns = self.columns
+        price, price_text = parse_price(row.get("price"))
+        link = str(row.get("link") or "")
+        product_link = str(row.get("product_link") or "")
+        columns["name"].append(str(name))
+        columns["price"].append(price)
+        columns["price_text"].append(price_text)
+        columns["source"].append(str(row.get("source") or row.get("store") or ""))
+        columns["link"].append(link)
+        # Usually the same as link, so only stored when it differs
+        columns["product_link"].append(product_link if product_link != link else "")
+        columns["thumbnail"].append(str(row.get("thumbnail") or ""))
+        columns["rating"].append(to_number(row.get("rating"), float))
+        columns["reviews"].append(min(max(to_number(row.get("reviews"), int), 0), MAX_REVIEWS))
+        return True
+
+    def finish(self):
+        """Precompute length normalization and the best products of very common terms"""
+        count = len(self.lengths)
+        self.average_length = sum(self.lengths) / count if count else 0.0
+        average = self.average_length or 1.0
+        # BM25's k1 * (1 - b + b * length / average length), per product
+        self.norms = array("f", (self.k1 * (1 - self.b + self.b * length / average) for length in self.lengths))
+
+        for term, ids in self.doc_ids.items():
+            self.posting_count += len(ids)
+            if len(ids) > self.candidate_limit:
+                frequencies = self.frequencies[term]
+                best = heapq.nlargest(self.candidate_limit, range(len(ids)),
+                                      key=lambda i: frequencies[i] / (frequencies[i] + self.norms[ids[i]]))
+                best.sort()
+                self.heads[term] = (array("I", (ids[i] for i in best)), array("H", (frequencies[i] for i in best)))
+        return self
+
+    def postings(self, term):
+        ids = self.doc_ids.get(term)
+        return None if ids is None else (ids, self.frequencies[term])
+
+    def head(self, term):
+        return self.heads[term]
+
+    def stats(self):
+        return {
+            "format": "memory",
+            "products": len(self.lengths),
+            "terms": len(self.doc_ids),
+            "postings": self.posting_count,
+            "common_terms": len(self.heads),
+            "average_length": round(self.average_length, 2),
+            "load_seconds": round(self.load_seconds, 3)
+        }
+
+    @classmethod
+    def load(cls, path, **options):
+        """
+        Build a catalog from a product file (see read_rows and add)
+        Returns: the finished Catalog
+        Raises: OSError if the file can't be read, ValueError if it can't be parsed
+        """
+        started = time.monotonic()
+        catalog = cls(**options)
+        for row in read_rows(path):
+            catalog.add(row)
+        catalog.finish()
+        catalog.load_seconds = time.monotonic() - started
+        return catalog
+
+    def save(self, path):
+        """Write the finished catalog to a .catalog file for MappedCatalog, replacing path atomically"""
+        terms = StringColumn()
+        term_offsets = array("Q", [0])
+        doc_ids = array("I")
+        frequencies = array("H")
+        head_terms = array("I")
+        head_offsets = array("Q", [0])
+        head_ids = array("I")
+        head_frequencies = array("H")
+        for index, term in enumerate(sorted(self.doc_ids, key=str.encode)):
+            terms.append(term)
+            doc_ids.extend(self.doc_ids[term])
+            frequencies.extend(self.frequencies[term])
+            term_offsets.append(len(doc_ids))
+            if term in self.heads:
+                ids, counts = self.heads[term]
+                head_terms.append(index)
+                head_ids.extend(ids)
+                head_frequencies.extend(counts)
+                head_offsets.append(len(head_ids))
+
+        sections = {"norms": self.norms}
+        for name in STRING_COLUMNS:
+            sections.update(self.columns[name].sections(name))
+        for name in NUMBER_COLUMNS:
+            sections[name] = self.columns[name]
+        sections.update(terms.sections("terms"))
+        sections.update(term_offsets=term_offsets, doc_ids=doc_ids, frequencies=frequencies, head_terms=head_terms,
+                        head_offsets=head_offsets, head_ids=head_ids, head_frequencies=head_frequencies)
+        write_catalog_file(path, sections, {
+            "products": len(self),
+            "k1": self.k1,
+            "b": self.b,
+            "candidate_limit": self.candidate_limit,
+            "average_length": self.average_length
+        })
+
+
+def write_catalog_file(path, sections, meta):
+    """Write named buffers (arrays or bytes) and meta as a .catalog file"""
+    contents = dict(meta, version=FILE_VERSION, byteorder=sys.byteorder, sections={})
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(FILE_HEADER.pack(FILE_MAGIC, 0, 0))
+        for name, values in sections.items():
+            f.write(b"\0" * (-f.tell() % SECTION_ALIGNMENT))
+            offset = f.tell()
+            f.write(values)
+            typecode = values.typecode if isinstance(values, array) else "B"
+            contents["sections"][name] = [offset, f.tell() - offset, typecode, array(typecode).itemsize]
+        table = json.dumps(contents).encode()
+        table_offset = f.tell()
+        f.write(table)
+        f.seek(0)
+        f.write(FILE_HEADER.pack(FILE_MAGIC, table_offset, len(table)))
+    os.replace(temporary, path)
+
+
+class MappedCatalog(CatalogIndex):
+    """
+    A .catalog file opened with mmap; columns and postings are read-only
+    views of the mapping, so opening takes the same time for any size
+    """
+
+    def __init__(self, path):
+        started = time.monotonic()
+        self.path = path
+        with open(path, "rb") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mapping) < FILE_HEADER.size or self.mapping[:len(FILE_MAGIC)] != FILE_MAGIC:
+            raise ValueError(f"{path} is not a product catalog file")
+        magic, table_offset, table_length = FILE_HEADER.unpack_from(self.mapping)
+        contents = json.loads(self.mapping[table_offset:table_offset + table_length])
+        if contents["version"] != FILE_VERSION or contents["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} is catalog format {contents['version']} ({contents['byteorder']} endian), "
+                             f"expected {FILE_VERSION} ({sys.byteorder}); rebuild it with catalog.py")
+
+        self.k1 = contents["k1"]
+        self.b = contents["b"]
+        self.candidate_limit = contents["candidate_limit"]
+        self.average_length = contents["average_length"]
+
+        view = memoryview(self.mapping)
+        sections = {}
+        for name, (offset, length, typecode, itemsize) in contents["sections"].items():
+            if array(typecode).itemsize != itemsize:
+                raise ValueError(f"{path}: {name} has {itemsize} byte items, expected {array(typecode).itemsize}")
+            sections[name] = view[offset:offset + length].cast(typecode)
+
+        self.norms = sections["norms"]
+        self.columns = {name: StringColumn(sections[f"{name}.data"], sections[f"{name}.offsets"])
+                        for name in STRING_COLUMNS}
+        self.columns.update((name, sections[name]) for name in NUMBER_COLUMNS)
+        self.terms = StringColumn(sections["terms.data"], sections["terms.offsets"])
+        self.term_offsets = sections["term_offsets"]
+        self.doc_ids = sections["doc_ids"]
+        self.frequencies = sections["frequencies"]
+        self.head_terms = sections["head_terms"]
+        self.head_offsets = sections["head_offsets"]
+        self.head_ids = sections["head_ids"]
+        self.head_frequencies = sections["head_frequencies"]
+        self.load_seconds = time.monotonic() - started
+
+    def postings(self, term):
+        index = self.terms.find(term)
+        if index < 0:
+            return None
+        start, end = self.term_offsets[index], self.term_offsets[index + 1]
+        return self.doc_ids[start:end], self.frequencies[start:end]
+
+    def head(self, term):
+        position = bisect.bisect_left(self.head_terms, self.terms.find(term))
+        start, end = self.head_offsets[position], self.head_offsets[position + 1]
+        return self.head_ids[start:end], self.head_frequencies[start:end]
+
+    def stats(self):
+        return {
+            "format": "mapped",
+            "products": len(self.norms),
+            "terms": len(self.terms),
+            "postings": len(self.doc_ids),
+            "common_terms": len(self.head_terms),
+            "average_length": round(self.average_length, 2),
+            "file_bytes": len(self.mapping),
+            "load_seconds": round(self.load_seconds, 3)
+        }
+
+
+def open_catalog(path, **options):
+    """
+    Returns: a MappedCatalog for a .catalog file (built with the options it
+    was saved with), otherwise a Catalog loaded from the CSV/JSONL file
+    Raises: OSError if the file can't be read, ValueError if it can't be parsed
+    """
+    if path.endswith(CATALOG_FILE_SUFFIX):
+        return MappedCatalog(path)
+    return Catalog.load(path, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a .catalog file from a CSV or JSONL product file")
+    parser.add_argument("source", help="products as .csv or .jsonl, optionally .gz")
+    parser.add_argument("output", help=f"file to write, e.g. products{CATALOG_FILE_SUFFIX}")
+    parser.add_argument("--k1", type=float, default=CATALOG_BM25_K1)
+    parser.add_argument("--b", type=float, default=CATALOG_BM25_B)
+    parser.add_argument("--candidate-limit", type=int, default=CATALOG_CANDIDATE_LIMIT)
+    args = parser.parse_args()
+
+    catalog = Catalog.load(args.source, k1=args.k1, b=args.b, candidate_limit=args.candidate_limit)
+    started = time.monotonic()
+    catalog.save(args.output)
+    print(f"{len(catalog)} products: loaded in {catalog.load_seconds:.1f} s, written in "
+          f"{time.monotonic() - started:.1f} s ({os.path.getsize(args.output) / 2 ** 20:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
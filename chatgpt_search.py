@@ -4,12 +4,64 @@ Uses Azure OpenAI GPT-4 Vision API to analyze images and extract search terms
 """
 import os
 import base64
-from openai import AzureOpenAI
+import hashlib
+import openai
 from dotenv import load_dotenv
+from upstream_clients import get_azure_client
+import singleflight
+import ratelimit
+import resilience
+from image_cache import ImageResultCache
+from image_hash import NearDuplicateIndex
+from image_preprocess import ImagePreprocessor
+from logs import get_logger
+from constants import IMAGE_CACHE_TTL, IMAGE_CACHE_MAX_ENTRIES, IMAGE_CACHE_DB_TTL
+from constants import PHASH_THRESHOLD, PHASH_MAX_ENTRIES
+from constants import RATE_LIMIT_AZURE_RATE, RATE_LIMIT_AZURE_BURST
+from constants import BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT
+from constants import IMAGE_MAX_EDGE, IMAGE_OUTPUT_FORMAT, IMAGE_OUTPUT_QUALITY, IMAGE_PREPROCESS_WORKERS
+from constants import IMAGE_PREPROCESS_START
 
 # Load environment variables
 load_dotenv()
 
+log = get_logger("chatgpt_search")
+
+# Concurrent analyses of the same image share one Azure OpenAI call
+analyze_flight = singleflight.SingleFlight()
+
+# Calls that actually reach Azure OpenAI, across all users
+azure_limit = ratelimit.TokenBucket(RATE_LIMIT_AZURE_RATE, RATE_LIMIT_AZURE_BURST)
+
+# Circuit breaker for Azure OpenAI; retries are left to the openai SDK
+# (AZURE_OPENAI_MAX_RETRIES), which already backs off with jitter
+azure_upstream = resilience.Upstream(
+    "Azure OpenAI",
+    failures=(openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError),
+    breaker=resilience.CircuitBreaker("Azure OpenAI", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+)
+
+# Search terms of previously analyzed images keyed by content digest
+# In memory until the server attaches IMAGE_CACHE_DB (methods.open_stores)
+image_cache = ImageResultCache(
+    memory_ttl=IMAGE_CACHE_TTL,
+    max_entries=IMAGE_CACHE_MAX_ENTRIES,
+    disk_ttl=IMAGE_CACHE_DB_TTL
+)
+
+# Search terms of previously analyzed images keyed by perceptual hash,
+# for re-encoded or resized copies that miss the exact digest cache
+near_duplicates = NearDuplicateIndex(threshold=PHASH_THRESHOLD, max_entries=PHASH_MAX_ENTRIES)
+
+# Shrinks and re-encodes uploads before they are sent for analysis
+preprocessor = ImagePreprocessor(
+    max_edge=IMAGE_MAX_EDGE,
+    output_format=IMAGE_OUTPUT_FORMAT,
+    quality=IMAGE_OUTPUT_QUALITY,
+    workers=IMAGE_PREPROCESS_WORKERS,
+    start_method=IMAGE_PREPROCESS_START
+)
+
 
 def encode_image_to_base64(image_path):
     """
@@ -34,38 +86,32 @@ def encode_image_bytes_to_base64(image_bytes):
     return base64.b64encode(image_bytes).decode('utf-8')
 
 
-def analyze_image_for_products(image_path=None, image_bytes=None):
+def analyze_image_for_products(image_path=None, image_bytes=None, mime_type="image/jpeg"):
     """
     Analyze image using Azure OpenAI GPT-4 Vision and extract product search terms
     
     Args:
         image_path: Path to the image file (optional)
         image_bytes: Image data as bytes (optional)
+        mime_type: MIME type of the image data
     
     Returns:
         tuple: (search_terms, error_message)
             - search_terms: String with extracted search terms or None if error
             - error_message: Error message or None if successful
+    
+    Raises:
+        resilience.CircuitOpen if Azure OpenAI's circuit breaker is open
     """
     try:
-        # Get Azure OpenAI configuration from environment
-        azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-        deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")
+        # Shared Azure OpenAI client, configured once from the environment
+        azure = get_azure_client()
         
-        if not azure_endpoint:
-            return None, "AZURE_OPENAI_ENDPOINT not found in environment variables. Please add it to .env file"
+        if azure.error:
+            return None, azure.error
         
-        if not api_key:
-            return None, "AZURE_OPENAI_API_KEY not found in environment variables. Please add it to .env file"
-        
-        # Initialize Azure OpenAI client
-        client = AzureOpenAI(
-            azure_endpoint=azure_endpoint,
-            api_key=api_key,
-            api_version=api_version
-        )
+        client = azure.client
+        deployment_name = azure.deployment_name
         
         # Encode image to base64
         if image_path:
@@ -94,7 +140,8 @@ Examples:
 Return only the search query, no explanation."""
 
         # Call Azure OpenAI GPT-4 Vision API
-        response = client.chat.completions.create(
+        response = azure_upstream.call(
+            client.chat.completions.create,
             model=deployment_name,  # Using Azure deployment name
             messages=[
                 {
@@ -107,7 +154,7 @@ Return only the search query, no explanation."""
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": f"data:{mime_type};base64,{base64_image}"
                             }
                         }
                     ]
@@ -125,12 +172,58 @@ Return only the search query, no explanation."""
         
         return search_terms, None
         
+    except resilience.CircuitOpen:
+        raise
     except Exception as e:
         error_msg = f"Error analyzing image: {str(e)}"
-        print(error_msg)
+        log.warning(error_msg)
         return None, error_msg
 
 
+def image_digest(image_bytes):
+    """Content digest used to recognize identical uploads"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def cached_analyze_image(image_bytes):
+    """
+    analyze_image_for_products for uploaded bytes with the image caches in front
+    A repeat upload (or a near-duplicate within PHASH_THRESHOLD bits) is
+    answered without any network call, and concurrent requests for the same
+    new image share one upstream call
+    Returns: (search_terms, error_message)
+    Raises: ratelimit.RateLimited if a miss would exceed the Azure OpenAI rate limit,
+    resilience.CircuitOpen if Azure OpenAI's circuit breaker is open
+    """
+    digest = image_digest(image_bytes)
+
+    found, search_terms = image_cache.get(digest)
+    if found:
+        return search_terms, None
+
+    phash = near_duplicates.compute(image_bytes)
+    if phash is not None:
+        found, search_terms = near_duplicates.lookup(phash)
+        if found:
+            image_cache.put(digest, search_terms)
+            return search_terms, None
+
+    def analyze_and_store():
+        azure_upstream.breaker.check()
+        azure_limit.acquire("Azure OpenAI")
+        prepared, mime_type, sizes = preprocessor.run(image_bytes)
+        log.debug("Image prepared for analysis: %s -> %s bytes (%s)",
+                  sizes['bytes_before'], sizes['bytes_after'], mime_type)
+        search_terms, error = analyze_image_for_products(image_bytes=prepared, mime_type=mime_type)
+        if not error and search_terms:
+            image_cache.put(digest, search_terms)
+            if phash is not None:
+                near_duplicates.add(phash, search_terms)
+        return search_terms, error
+
+    return analyze_flight.do(digest, analyze_and_store)
+
+
 def test_image_analysis():
     """Test function to verify image analysis works"""
     # Test with a sample image
@@ -2,22 +2,101 @@
 Shopping App Socket Client
 Communicates with server using custom socket protocol
 """
+import io
+import os
 import socket
 import sys
 import json
+import threading
+from concurrent.futures import Future
 import protocol
+import serialization
 from constants import IP, PORT
 
 
 EXIT = 1
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class StreamCollector(object):
+    """
+    Event callback for one streamed request: forwards each partial event to
+    `on_event` and rebuilds the complete reply from them, so callers that do
+    not care about streaming see the same reply as without it
+    """
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.products = []
+        self.results = []
+        self.search_terms = None
+
+    def __call__(self, event):
+        if event.get("event") == "products":
+            self.products.extend(event.get("products", []))
+        elif event.get("event") == "result":
+            self.results.append({key: value for key, value in event.items() if key != "event"})
+        elif event.get("event") == "search_terms":
+            self.search_terms = event.get("search_terms")
+
+        if self.on_event:
+            try:
+                self.on_event(event)
+            except Exception as msg:
+                print(f"Error in event callback: {msg}")
+
+    def complete(self, response):
+        """Returns: the final reply with the streamed products (or SEARCH_MANY results) filled back in"""
+        if response and response.get("event") == "done":
+            if self.results:
+                response.setdefault("results", self.results)
+            else:
+                response.setdefault("products", self.products)
+            if self.search_terms is not None:
+                response.setdefault("search_terms", self.search_terms)
+        return response
+
+
+def shrink_image(image_path, max_edge, quality=85):
+    """
+    Downscale an image so its longest edge is at most max_edge and re-encode it as JPEG
+    Returns: encoded bytes, or None if the original file is already as small
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        if max(img.size) <= max_edge and img.format == "JPEG":
+            return None
+        img.draft('RGB', (max_edge, max_edge))
+        img = img.convert('RGB')
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=quality)
+
+    data = output.getvalue()
+    if len(data) >= os.path.getsize(image_path):
+        return None
+    return data
 
 
 class ShoppingClient(object):
-    def __init__(self, ip, port):
-        """Initialize client socket and connect to server"""
+    def __init__(self, ip, port, framing=protocol.FRAMING_BINARY, multiplex=True, stream=True,
+                 compress=True, encoding=serialization.ENCODING_JSON):
+        """
+        Initialize client socket and connect to server
+        framing: preferred framing; falls back to LEGACY if the server refuses it
+        multiplex: ask for request IDs so several requests can be outstanding
+            on this connection at once (BINARY framing only)
+        stream: ask for searches to stream partial results (BINARY framing only)
+        compress: ask for large frames to be zlib-compressed (BINARY framing only)
+        encoding: reply encoding to ask for, e.g. COLUMNAR or MSGPACK (BINARY
+            framing only); the server may answer with JSON instead
+        """
         try:
-            self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.my_socket = protocol.Connection(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
             self.my_socket.connect((ip, port))
+            # Commands are small frames sent back to back; don't hold them back for ACKs
+            self.my_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.session_id = None
             self.username = None
             print(f"Connected to server at {ip}:{port}")
@@ -25,23 +104,154 @@ class ShoppingClient(object):
             print(f'Connection failure: {msg}\nTerminating program')
             sys.exit(EXIT)
 
-    def send_command(self, command):
+        # Without multiplexing one request/response pair at a time may use the socket
+        self.request_lock = threading.RLock()
+
+        # Multiplexed requests waiting for their reply: {request_id: Future}
+        self.multiplexed = False
+        self.pending = {}
+        # Partial event callbacks of multiplexed requests: {request_id: callable}
+        self.event_handlers = {}
+        self.streaming = False
+        self.pending_lock = threading.Lock()
+        self.next_request_id = 1
+        self.reader_thread = None
+
+        if framing != protocol.FRAMING_LEGACY:
+            self.negotiate_protocol(framing, multiplex, stream, compress, encoding)
+
+    def negotiate_protocol(self, framing, multiplex=False, stream=False, compress=False,
+                           encoding=serialization.ENCODING_JSON):
+        """
+        Ask the server to switch framing (and optionally turn on multiplexing,
+        streamed replies, frame compression and a compact reply encoding)
+        Returns: True if the server accepted, False if we stay on the current framing
+        """
+        command = f"PROTOCOL {framing}"
+        if multiplex:
+            command += f" {protocol.FEATURE_MUX}"
+        if stream:
+            command += f" {protocol.FEATURE_STREAM}"
+        if compress:
+            command += f" {protocol.FEATURE_COMPRESS}"
+        if encoding != serialization.ENCODING_JSON:
+            if encoding in serialization.SUPPORTED_ENCODINGS:
+                command += f" {encoding}"
+            else:
+                print(f"Encoding {encoding} not available, using JSON")
+        response = self.send_command(command)
+
+        if response and response.get("status") == "success":
+            self.my_socket.framing = response.get("framing", framing)
+            self.streaming = protocol.FEATURE_STREAM in response.get("features", [])
+            self.my_socket.encoding = response.get("encoding", serialization.ENCODING_JSON)
+            self.my_socket.compression = protocol.FEATURE_COMPRESS in response.get("features", [])
+            if protocol.FEATURE_MUX in response.get("features", []):
+                self.start_multiplexing()
+            return True
+        return False
+
+    def start_multiplexing(self):
+        """Route replies to their requests from a background reader thread"""
+        self.multiplexed = True
+        self.reader_thread = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader_thread.start()
+
+    def read_responses(self):
+        """Reader thread: resolve the future of each request as its reply arrives"""
+        error = ConnectionError("Connection closed")
+        try:
+            while True:
+                request_id, payload = protocol.Protocol.recv_frame(self.my_socket)
+
+                if not payload:
+                    break
+
+                try:
+                    response = serialization.decode(payload, self.my_socket.encoding)
+                except ValueError as msg:
+                    response, parse_error = None, msg
+
+                if response is not None and response.get("event") in protocol.PARTIAL_EVENTS:
+                    with self.pending_lock:
+                        on_event = self.event_handlers.get(request_id)
+                    if on_event:
+                        on_event(response)
+                    continue
+
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                    self.event_handlers.pop(request_id, None)
+
+                if future is None:
+                    print(f"Reply for unknown request #{request_id}")
+                    continue
+
+                if response is None:
+                    future.set_exception(parse_error)
+                else:
+                    future.set_result(response)
+        except socket.error as msg:
+            error = msg
+        finally:
+            # Nothing more will arrive for requests still waiting
+            with self.pending_lock:
+                waiting = list(self.pending.values())
+                self.pending.clear()
+                self.event_handlers.clear()
+            for future in waiting:
+                future.set_exception(error)
+
+    def open_request(self, on_event=None):
+        """
+        Register a new multiplexed request
+        on_event: called (from the reader thread) with each partial event
+        Returns: (channel to send its frames through, future for its reply)
+        """
+        future = Future()
+        with self.pending_lock:
+            request_id = self.next_request_id
+            self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+            self.pending[request_id] = future
+            if on_event:
+                self.event_handlers[request_id] = on_event
+        return protocol.RequestChannel(self.my_socket, request_id), future
+
+    def abandon_request(self, channel):
+        """Forget a request whose frames could not be sent"""
+        with self.pending_lock:
+            self.pending.pop(channel.request_id, None)
+            self.event_handlers.pop(channel.request_id, None)
+
+    def submit_command(self, command, on_event=None):
+        """
+        Send command without waiting for the reply (multiplexed connections only)
+        Returns: Future resolving to the parsed JSON response
+        """
+        channel, future = self.open_request(on_event)
+        try:
+            protocol.Protocol.send(channel, command)
+        except Exception as msg:
+            self.abandon_request(channel)
+            future.set_exception(msg)
+        return future
+
+    def send_command(self, command, on_event=None):
         """
         Send command to server and receive response
-        Returns: parsed JSON response or None
+        on_event: called with each partial event of a streamed reply
+        Returns: parsed JSON response (the final one if streamed) or None
         """
         try:
-            # Send command
-            protocol.Protocol.send(self.my_socket, command)
-            
-            # Receive response
-            response = protocol.Protocol.recv(self.my_socket)
-            
-            if not response:
-                return None
-            
-            # Parse JSON response
-            return json.loads(response.decode())
+            if self.multiplexed:
+                return self.submit_command(command, on_event).result()
+
+            with self.request_lock:
+                # Send command
+                protocol.Protocol.send(self.my_socket, command)
+
+                # Receive response
+                return self.receive_reply(on_event)
             
         except socket.error as msg:
             print(f"Socket error: {msg}")
@@ -53,6 +263,25 @@ class ShoppingClient(object):
             print(f"Error: {msg}")
             return None
 
+    def receive_reply(self, on_event=None):
+        """
+        Receive the reply to the request just sent, passing any partial
+        events that come before it to on_event
+        Returns: parsed final JSON response or None if the connection closed
+        """
+        while True:
+            response = protocol.Protocol.recv(self.my_socket)
+
+            if not response:
+                return None
+
+            # Parse response
+            response = serialization.decode(response, self.my_socket.encoding)
+            if response.get("event") not in protocol.PARTIAL_EVENTS:
+                return response
+            if on_event:
+                on_event(response)
+
     def login(self, username, password):
         """
         Login to server
@@ -67,9 +296,11 @@ class ShoppingClient(object):
             return True
         return False
 
-    def search_product(self, query):
+    def search_product(self, query, on_event=None):
         """
         Search for products
+        on_event: optional callable(event) called with each batch of products
+            ({"event": "products", "products": [...]}) as it arrives
         Returns: list of products or None
         """
         if not self.session_id:
@@ -77,19 +308,87 @@ class ShoppingClient(object):
             return None
         
         command = f"SEARCH_PRODUCT {self.session_id} {query}"
-        response = self.send_command(command)
+        collector = StreamCollector(on_event)
+        response = collector.complete(self.send_command(command, collector))
         
         if response and response.get("status") == "success":
             return response.get("products", [])
         return None
 
-    def image_search(self, image_path):
+    def submit_search(self, query):
+        """
+        Start a product search without waiting for it
+        On a multiplexed connection other requests can run meanwhile;
+        otherwise the search runs before this returns
+        Returns: Future resolving to the list of products or None
+        """
+        future = Future()
+
+        if not self.multiplexed or not self.session_id:
+            future.set_result(self.search_product(query))
+            return future
+
+        collector = StreamCollector()
+
+        def on_reply(reply):
+            try:
+                response = collector.complete(reply.result())
+            except Exception as msg:
+                print(f"Error: {msg}")
+                response = None
+
+            if response and response.get("status") == "success":
+                future.set_result(response.get("products", []))
+            else:
+                future.set_result(None)
+
+        self.submit_command(f"SEARCH_PRODUCT {self.session_id} {query}", collector).add_done_callback(on_reply)
+        return future
+
+    def search_many(self, queries, on_event=None):
+        """
+        Search for several products in one round trip
+        The server runs the searches in parallel
+        on_event: optional callable(event) called with each query's result
+            ({"event": "result", "index": ..., "products": [...]}) as it completes
+        Returns: list of (products_list, error_message) tuples in the order
+        of `queries`, or None if the whole request failed
+        """
+        if not self.session_id:
+            print("Not logged in")
+            return None
+
+        command = f"SEARCH_MANY {self.session_id} {json.dumps(list(queries))}"
+        collector = StreamCollector(on_event)
+        response = collector.complete(self.send_command(command, collector))
+
+        if not response or response.get("status") != "success":
+            if response:
+                print(f"Error: {response.get('message')}")
+            return None
+
+        results = [(None, "No result")] * len(queries)
+        for result in response.get("results", []):
+            if result.get("status") == "success":
+                results[result["index"]] = (result.get("products", []), None)
+            else:
+                results[result["index"]] = (None, result.get("message", "Unknown error"))
+        return results
+
+    def image_search(self, image_path, max_edge=None, progress_callback=None, on_event=None):
         """
         Search for products by uploading an image
         Image is analyzed by GPT-4 Vision to extract search terms
         
         Args:
             image_path: Path to the image file
+            max_edge: If set, shrink the image so its longest edge is at most
+                this many pixels before uploading (needs Pillow)
+            progress_callback: Optional callable(bytes_sent, total_bytes)
+                called as the upload progresses
+            on_event: Optional callable(event) called with the search terms
+                ({"event": "search_terms"}) as soon as the image is analyzed,
+                then with each batch of products ({"event": "products"})
             
         Returns: 
             tuple: (products_list, search_terms_used) or (None, error_message)
@@ -99,32 +398,40 @@ class ShoppingClient(object):
             return None, "Not logged in"
         
         try:
-            # Read image file
+            # Shrink the image first if requested, otherwise stream the file as is
+            image_data = None
+            if max_edge:
+                try:
+                    image_data = shrink_image(image_path, max_edge)
+                except FileNotFoundError:
+                    raise
+                except Exception as msg:
+                    print(f"Could not shrink image, uploading original: {msg}")
+            image_size = len(image_data) if image_data is not None else os.path.getsize(image_path)
+            collector = StreamCollector(on_event)
+
             with open(image_path, 'rb') as f:
-                image_data = f.read()
-            
-            # Send IMAGE_SEARCH command with session ID
-            command = f"IMAGE_SEARCH {self.session_id}"
-            protocol.Protocol.send(self.my_socket, command)
-            
-            # Send image size first
-            image_size = len(image_data)
-            protocol.Protocol.send(self.my_socket, str(image_size))
-            
-            # Send image data in chunks
-            chunk_size = 4096
-            for i in range(0, len(image_data), chunk_size):
-                chunk = image_data[i:i + chunk_size]
-                self.my_socket.sendall(chunk)
-            
-            # Receive response with search terms and products
-            response = protocol.Protocol.recv(self.my_socket)
-            
-            if not response:
-                return None, "No response from server"
-            
-            # Parse JSON response
-            result = json.loads(response.decode())
+                if self.multiplexed:
+                    # The command, size and image bytes must reach the server back to back
+                    with self.my_socket.send_lock:
+                        channel, future = self.open_request(collector)
+                        try:
+                            self.send_image(channel, f, image_data, image_size, progress_callback)
+                        except Exception:
+                            self.abandon_request(channel)
+                            raise
+                    result = future.result()
+                else:
+                    with self.request_lock:
+                        self.send_image(self.my_socket, f, image_data, image_size, progress_callback)
+
+                        # Receive response with search terms and products
+                        result = self.receive_reply(collector)
+
+                    if not result:
+                        return None, "No response from server"
+
+            result = collector.complete(result)
             
             if result.get("status") == "success":
                 products = result.get("products", [])
@@ -147,6 +454,41 @@ class ShoppingClient(object):
             print(error_msg)
             return None, error_msg
 
+    def send_image(self, channel, f, image_data, image_size, progress_callback=None):
+        """Send the IMAGE_SEARCH command, the image size and the image bytes"""
+        # Send IMAGE_SEARCH command with session ID
+        command = f"IMAGE_SEARCH {self.session_id}"
+        protocol.Protocol.send(channel, command)
+
+        # Send image size first
+        protocol.Protocol.send(channel, str(image_size))
+
+        # Send image data in chunks
+        if image_data is not None:
+            self.send_bytes(image_data, progress_callback)
+        else:
+            self.send_file(f, image_size, progress_callback)
+
+    def send_bytes(self, data, progress_callback=None):
+        """Send in-memory data in chunks without copying it"""
+        view = memoryview(data)
+        total = len(view)
+        for offset in range(0, total, UPLOAD_CHUNK_SIZE):
+            self.my_socket.sendall(view[offset:offset + UPLOAD_CHUNK_SIZE])
+            if progress_callback:
+                progress_callback(min(offset + UPLOAD_CHUNK_SIZE, total), total)
+
+    def send_file(self, f, total, progress_callback=None):
+        """Stream an open file to the server with socket.sendfile"""
+        sent = 0
+        while sent < total:
+            count = self.my_socket.sendfile(f, sent, min(UPLOAD_CHUNK_SIZE, total - sent))
+            if not count:
+                raise socket.error("Connection closed during upload")
+            sent += count
+            if progress_callback:
+                progress_callback(sent, total)
+
     def logout(self):
         """Logout from server"""
         if not self.session_id:
@@ -6,6 +6,35 @@ Constants for shopping app client/server
 IP = "127.0.0.1"
 PORT = 8765
 
+# Multiplexed connections (PROTOCOL BINARY MUX)
+MUX_MAX_IN_FLIGHT = 16      # max concurrent requests per connection
+MUX_DRAIN_TIMEOUT = 30      # seconds a closing connection waits for its outstanding replies
+
+# Request dispatcher (see dispatcher.py)
+CHEAP_COMMANDS = ["PROTOCOL", "LOGIN", "LOGOUT", "GET_SESSIONS", "CACHE_STATS", "STATS", "EXIT"]
+DISPATCH_CHEAP_WORKERS = 8          # threads for commands that don't call upstream APIs
+DISPATCH_CHEAP_QUEUE = 256          # cheap requests that may wait before new ones are refused
+DISPATCH_EXPENSIVE_WORKERS = 32     # max concurrent SEARCH_PRODUCT/SEARCH_MANY/IMAGE_SEARCH
+DISPATCH_EXPENSIVE_QUEUE = 64       # expensive requests that may wait before new ones are refused
+DISPATCH_MIN_RETRY_AFTER_MS = 100   # smallest retry-after hint in "server busy" replies
+
+# Logging (see logs.py)
+LOG_LEVEL = "INFO"          # minimum level written as JSON lines to stdout, None to turn logging off
+LOG_QUEUE_SIZE = 10000      # records waiting for the writer thread; further ones are dropped and counted
+LOG_SAMPLE_RATES = {        # fraction of INFO records kept per command; warnings and errors are always kept
+    "STATS": 0.01,          # polled by monitoring
+    "CACHE_STATS": 0.01,
+    "GET_SESSIONS": 0.1
+}
+
+# Metrics (see metrics.py)
+METRICS_PORT = None         # port for Prometheus text at http://IP:METRICS_PORT/metrics, e.g. 9100; None = off
+                            # (or pass server --metrics-port)
+
+# asyncio engine configuration
+ASYNC_BACKLOG = 1024        # pending accepts queued by the kernel
+ASYNC_WORKER_THREADS = 16   # threads reading uploads off the event loop
+
 # User storage (in-memory database)
 # Format: {username: password}
 USERS = {
@@ -14,13 +43,84 @@ USERS = {
     "demo": "demo"
 }
 
-# Session storage (in-memory)
-# Format: {session_id: {"username": str, "login_time": timestamp}}
-SESSIONS = {}
+# Session storage (see methods.SESSIONS)
+SESSION_TTL = 3600              # seconds of inactivity before a session expires
+SESSION_SHARDS = 16             # independently locked shards
+SESSION_DB = "sessions.db"      # sqlite file so sessions survive restarts, None for memory only
+SESSION_PAGE_SIZE = 100         # max session IDs returned per GET_SESSIONS call
+
+# Streaming replies (PROTOCOL BINARY STREAM)
+STREAM_PRODUCT_BATCH = 5        # products per "products" event
+
+# Rate limits (see ratelimit.py); a rate of None disables the limit
+RATE_LIMIT_USER_RATE = 2.0      # search requests per second per user
+RATE_LIMIT_USER_BURST = 10
+RATE_LIMIT_SERPAPI_RATE = 5.0   # SerpAPI calls per second, shared by everyone (cache hits are free)
+RATE_LIMIT_SERPAPI_BURST = 20
+RATE_LIMIT_AZURE_RATE = 2.0     # Azure OpenAI calls per second, shared by everyone
+RATE_LIMIT_AZURE_BURST = 10
+
+# Batch search (SEARCH_MANY)
+SEARCH_MANY_MAX_QUERIES = 100   # max queries per batch
+SEARCH_MANY_CONCURRENCY = 8     # max upstream searches in flight per batch
+SEARCH_MANY_WORKERS = 32        # threads shared by all batches
+SEARCH_MANY_RATE_WAIT = 45      # seconds a batch's queries may wait for the user's rate limit before
+                                # coming back RATE_LIMITED (45 fits a full batch at the default user rate)
+
+# Upstream HTTP clients (SerpAPI, Azure OpenAI)
+UPSTREAM_POOL_SIZE = 32         # keep-alive connections per upstream
+SERPAPI_CONNECT_TIMEOUT = 3     # seconds to establish a connection
+SERPAPI_TIMEOUT = 10            # seconds to wait for the response
+AZURE_OPENAI_CONNECT_TIMEOUT = 5
+AZURE_OPENAI_TIMEOUT = 30
+AZURE_OPENAI_MAX_RETRIES = 2    # retried by the openai SDK itself
+
+# Upstream resilience (see resilience.py)
+SERPAPI_RETRIES = 2                 # extra attempts after a timeout/connection error/5xx (searches are idempotent)
+SERPAPI_RETRY_BASE_DELAY = 0.2      # seconds before the first retry, doubling for each further one (jittered)
+SERPAPI_RETRY_MAX_DELAY = 2.0
+SERPAPI_RETRY_DEADLINE = 15         # seconds after the first attempt when no new retry is started
+BREAKER_FAILURE_THRESHOLD = 5       # consecutive failed calls that open an upstream's circuit breaker
+BREAKER_RESET_TIMEOUT = 30          # seconds an open breaker fails fast before a trial call is let through
+
+# Product search backend (see providers.py)
+PRODUCT_PROVIDER = "serpapi"        # "serpapi": Google Shopping via SerpAPI, "local": the catalog file below
+CATALOG_PATH = "catalog.jsonl"      # products as .csv or .jsonl (may be .gz), indexed at startup, or a
+                                    # .catalog file built with "python catalog.py SOURCE OUT.catalog", mmapped
+CATALOG_MAX_RESULTS = 10            # products returned per search, as from SerpAPI
+CATALOG_BM25_K1 = 1.2               # BM25 term frequency saturation
+CATALOG_BM25_B = 0.75               # BM25 length normalization
+CATALOG_CANDIDATE_LIMIT = 10000     # products scanned per query term; more common terms only re-rank
+
+# Product search result cache
+SEARCH_CACHE_TTL = 300                     # seconds a result stays fresh
+SEARCH_CACHE_MAX_ENTRIES = 1024
+SEARCH_CACHE_MAX_BYTES = 16 * 1024 * 1024  # 16MB of serialized results
+SEARCH_CACHE_SORT_WORDS = False            # treat "red shoes" and "shoes red" as the same query
+SEARCH_CACHE_STALE_TTL = 3600              # seconds past expiry a result may still be served while SerpAPI is down
+
+# Image analysis result cache (keyed by image content digest)
+IMAGE_CACHE_TTL = 3600                  # seconds an entry stays in memory
+IMAGE_CACHE_MAX_ENTRIES = 4096
+IMAGE_CACHE_DB = "image_cache.db"       # sqlite file for the persistent tier, None for memory only
+IMAGE_CACHE_DB_TTL = 30 * 24 * 3600     # seconds an entry stays on disk
+
+# Near-duplicate image lookup (perceptual hash)
+PHASH_THRESHOLD = 6             # max Hamming distance (of 64 bits) to reuse search terms
+PHASH_MAX_ENTRIES = 500000
+
+# Image preprocessing before vision analysis
+IMAGE_MAX_EDGE = 1024           # longest edge in pixels after downscaling
+IMAGE_OUTPUT_FORMAT = "JPEG"    # "JPEG" or "WEBP"
+IMAGE_OUTPUT_QUALITY = 85
+IMAGE_PREPROCESS_WORKERS = 2    # processes in the preprocessing pool
+IMAGE_PREPROCESS_START = "spawn"  # how workers start: "spawn" or "forkserver" (never fork a threaded server)
 
 # EOF marker for file transfers
 EOF = b'EOF'
 
 # Image transfer settings
 MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB max image size
+IMAGE_RECV_CHUNK_SIZE = 256 * 1024  # max bytes requested per recv_into while receiving an image
 SUPPORTED_IMAGE_FORMATS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+UPLOAD_MAX_EDGE = 1024  # GUI shrinks images to this longest edge before uploading
@@ -0,0 +1,196 @@
+"""
+Admission control between the servers and the Methods handlers
+Commands are split into cheap ones (sessions, stats) and expensive ones that
+call the upstream APIs. Each class runs on its own bounded pool with a
+bounded queue, so a surge of clients cannot turn into an unbounded surge of
+SerpAPI/Azure OpenAI calls, and a slow upstream cannot hold up logins.
+When a queue is full the request is rejected at once with a "server busy"
+reply carrying a retry-after hint instead of waiting.
+Every request's latency (queue wait included) and outcome is recorded in
+metrics.CommandMetrics when one is given, and logged as one line.
+"""
+import json
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from metrics import UNKNOWN_COMMAND
+from logs import get_logger, should_log, log_request, format_address
+
+log = get_logger("dispatcher")
+
+# Replies from the handlers start with their status, e.g. '{"status": "success", ...'
+SUCCESS_PREFIX = json.dumps({"status": "success"})[:-1]
+
+
+class WorkPool(object):
+    """
+    Thread pool running at most `workers` jobs with at most `max_queue` more
+    waiting; further jobs are refused
+    """
+
+    def __init__(self, name, workers, max_queue, min_retry_after_ms=100, clock=time.monotonic):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.min_retry_after_ms = min_retry_after_ms
+        self.clock = clock
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"dispatch-{name}")
+
+        self.lock = threading.Lock()
+        self.pending = 0  # queued + running
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Moving average of how long a job runs, for retry-after hints
+        self.service_time = 0.1
+
+    def try_submit(self, fn, *args):
+        """
+        Queue fn(*args) unless the queue is full
+        Returns: Future of its result, or None if the job was refused
+        """
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                return None
+            self.pending += 1
+            self.submitted += 1
+
+        return self.executor.submit(self.run, self.clock(), fn, args)
+
+    def run(self, queued_at, fn, args):
+        started = self.clock()
+        try:
+            return fn(*args)
+        finally:
+            finished = self.clock()
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                wait = started - queued_at
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.service_time += 0.2 * ((finished - started) - self.service_time)
+
+    def retry_after_ms(self):
+        """Returns: rough time in ms until a queue slot frees up"""
+        with self.lock:
+            ahead = max(1, self.pending - self.workers + 1)
+            estimate = self.service_time * ahead / self.workers
+        return max(self.min_retry_after_ms, int(estimate * 1000))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "running": min(self.pending, self.workers),
+                "queue_depth": max(0, self.pending - self.workers),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "wait_ms_avg": round(self.wait_total / self.completed * 1000, 2) if self.completed else 0.0,
+                "wait_ms_max": round(self.wait_max * 1000, 2),
+                "service_ms_avg": round(self.service_time * 1000, 2)
+            }
+
+
+class Dispatcher(object):
+    """
+    Routes each command to the pool for its cost class and runs the handler there
+    handlers: class with a static method per command (methods.Methods)
+    """
+
+    def __init__(self, handlers, cheap_commands, cheap_pool, expensive_pool, command_metrics=None):
+        self.handlers = handlers
+        self.cheap_commands = set(cheap_commands)
+        self.cheap_pool = cheap_pool
+        self.expensive_pool = expensive_pool
+        self.command_metrics = command_metrics
+        # Server-wide request numbers for the log (next() on a count is atomic)
+        self.request_ids = itertools.count(1)
+
+    def pool_for(self, request):
+        """Commands not listed as cheap are treated as expensive"""
+        return self.cheap_pool if request in self.cheap_commands else self.expensive_pool
+
+    def submit(self, request, params, my_socket, address):
+        """
+        Queue a request for its handler
+        Returns: Future resolving to the response string (JSON); already
+        resolved for unknown commands and for requests refused because the
+        server is busy
+        """
+        started = time.monotonic()
+        if not hasattr(self.handlers, request):
+            return self.record(UNKNOWN_COMMAND, started, resolved(json.dumps({
+                "status": "error",
+                "message": f"Unknown command: {request}"
+            })), [request], my_socket, address)
+
+        pool = self.pool_for(request)
+        future = pool.try_submit(self.run_handler, request, params, my_socket, address)
+        if future is None:
+            retry_after_ms = pool.retry_after_ms()
+            future = resolved(json.dumps({
+                "status": "error",
+                "code": "BUSY",
+                "message": f"Server busy, retry after {retry_after_ms} ms",
+                "retry_after_ms": retry_after_ms
+            }))
+            log.warning("%s refused, %s pool is full", request, pool.name,
+                        extra={"command": request, "address": format_address(address),
+                               "retry_after_ms": retry_after_ms})
+        return self.record(request, started, future, params, my_socket, address)
+
+    def record(self, command, started, future, params, my_socket, address):
+        """Once future resolves, record the command's latency and outcome and log it; Returns: future"""
+        request_id = next(self.request_ids)
+
+        def done(finished):
+            duration = time.monotonic() - started
+            ok = not finished.exception() and finished.result().startswith(SUCCESS_PREFIX)
+            if self.command_metrics is not None:
+                self.command_metrics.record(command, duration, ok)
+            # Sampled before anything is built; the writer thread redacts the params
+            sample_rate = should_log(log, command)
+            if sample_rate:
+                status = "success" if ok else "error"
+                log_request(log, f"{command} {status}", {
+                    "request_id": request_id,
+                    "client_request_id": getattr(my_socket, 'request_id', None),
+                    "command": command,
+                    "params": params,
+                    "address": address,
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 3)
+                }, sample_rate)
+        future.add_done_callback(done)
+        return future
+
+    def run_handler(self, request, params, my_socket, address):
+        """Call the handler; errors become error replies like in the servers"""
+        try:
+            return getattr(self.handlers, request)(my_socket, params, address)
+        except Exception as msg:
+            log.exception("Error handling request %s", request, extra={"command": request})
+            return json.dumps({
+                "status": "error",
+                "message": f"Server error: {str(msg)}"
+            })
+
+    def stats(self):
+        return {
+            "cheap": self.cheap_pool.stats(),
+            "expensive": self.expensive_pool.stats()
+        }
+
+
+def resolved(result):
+    """Returns: a Future that already holds result"""
+    future = Future()
+    future.set_result(result)
+    return future
@@ -1,9 +1,61 @@
 import os
-from serpapi import GoogleSearch
+import json
+import requests
+import cache
+import singleflight
+import ratelimit
+import resilience
+from upstream_clients import get_serpapi_client
+from constants import SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_SORT_WORDS
+from constants import SEARCH_CACHE_STALE_TTL
+from constants import RATE_LIMIT_SERPAPI_RATE, RATE_LIMIT_SERPAPI_BURST
+from constants import SERPAPI_RETRIES, SERPAPI_RETRY_BASE_DELAY, SERPAPI_RETRY_MAX_DELAY, SERPAPI_RETRY_DEADLINE
+from constants import BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT
 
 SERPAPI_KEY = os.getenv("SERPAPI_KEY")
 
+# Recent search results keyed by normalized query; None disables caching
+search_cache = cache.ResultCache(
+    ttl=SEARCH_CACHE_TTL,
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    max_bytes=SEARCH_CACHE_MAX_BYTES,
+    size_of=lambda products: len(json.dumps(products)),
+    stale_ttl=SEARCH_CACHE_STALE_TTL
+)
+
+# Concurrent identical searches share one upstream call
+search_flight = singleflight.SingleFlight()
+
+# Calls that actually reach SerpAPI, across all users
+serpapi_limit = ratelimit.TokenBucket(RATE_LIMIT_SERPAPI_RATE, RATE_LIMIT_SERPAPI_BURST)
+
+# Retries and circuit breaker for SerpAPI; searches are idempotent, so
+# timeouts, connection errors and 429/5xx replies are retried
+serpapi_upstream = resilience.Upstream(
+    "SerpAPI",
+    failures=(requests.ConnectionError, requests.Timeout, resilience.TransientError),
+    breaker=resilience.CircuitBreaker("SerpAPI", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+    retry=resilience.RetryPolicy(
+        retries=SERPAPI_RETRIES,
+        base_delay=SERPAPI_RETRY_BASE_DELAY,
+        max_delay=SERPAPI_RETRY_MAX_DELAY,
+        deadline=SERPAPI_RETRY_DEADLINE
+    )
+)
+
+
+def set_search_cache(new_cache):
+    """Replace the search cache (any object with get/get_stale/put/stats), or pass None to disable it"""
+    global search_cache
+    search_cache = new_cache
+
+
 def google_search_for_product(product_name):
+    """
+    Search Google Shopping through SerpAPI
+    Returns: (products, error_message)
+    Raises: resilience.CircuitOpen if SerpAPI's circuit breaker is open
+    """
     products = []
     error_message = ""
     
@@ -17,8 +69,7 @@ def google_search_for_product(product_name):
                 "num": 10  # Limit to 10 results
             }
             
-            search = GoogleSearch(params)
-            results = search.get_dict()
+            results = serpapi_upstream.call(get_serpapi_client().search, params)
             
             if "shopping_results" in results:
                 for idx, item in enumerate(results["shopping_results"][:10]):
@@ -37,9 +88,51 @@ def google_search_for_product(product_name):
             else:
                 error_message = "No shopping results found."
                 
+        except resilience.CircuitOpen:
+            raise
         except Exception as e:
             error_message = f"Search error: {str(e)}"
     elif not SERPAPI_KEY:
         error_message = "SerpAPI key not configured. Please add SERPAPI_KEY to your .env file."    
 
-    return products, error_message
\ No newline at end of file
+    return products, error_message
+
+
+def cached_google_search_for_product(product_name):
+    """
+    google_search_for_product with the result cache in front of it
+    Concurrent misses for the same query are coalesced into one upstream call
+    Only successful searches are cached, errors always go to the upstream again
+    While SerpAPI's circuit breaker is open, misses are answered with expired
+    results (up to SEARCH_CACHE_STALE_TTL old) when there are any
+    Raises: ratelimit.RateLimited if a miss would exceed the SerpAPI rate limit,
+    resilience.CircuitOpen if SerpAPI is unavailable and there is no stale result
+    """
+    if not product_name:
+        return google_search_for_product(product_name)
+
+    key = cache.normalize_query(product_name, sort_words=SEARCH_CACHE_SORT_WORDS)
+    current_cache = search_cache
+
+    if current_cache is not None:
+        found, products = current_cache.get(key)
+        if found:
+            return products, ""
+
+    def search_and_store():
+        try:
+            # Fail fast before spending a rate limit token on a call that won't happen
+            serpapi_upstream.breaker.check()
+            serpapi_limit.acquire("SerpAPI")
+            products, error_message = google_search_for_product(product_name)
+        except resilience.CircuitOpen:
+            if current_cache is not None:
+                found, products = current_cache.get_stale(key)
+                if found:
+                    return products, ""
+            raise
+        if not error_message and current_cache is not None:
+            current_cache.put(key, products)
+        return products, error_message
+
+    return search_flight.do(key, search_and_store)
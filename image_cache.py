@@ -0,0 +1,113 @@
+"""
+Cache of image analysis results keyed by a content digest of the image
+Two tiers: an in-memory LRU and an optional sqlite file that survives restarts
+"""
+import time
+import sqlite3
+import threading
+import cache
+
+
+class ImageResultCache(object):
+    """
+    Maps image digests to the search terms extracted from the image
+
+    Lookups try the memory tier first, then the sqlite tier (if a db_path was
+    given); disk hits are promoted into memory. Stores go to both tiers.
+    """
+
+    def __init__(self, memory_ttl=3600, max_entries=4096, db_path=None, disk_ttl=30 * 24 * 3600, clock=time.time):
+        self.memory = cache.ResultCache(
+            ttl=memory_ttl,
+            max_entries=max_entries,
+            size_of=lambda search_terms: len(search_terms)
+        )
+        self.db_path = None
+        self.disk_ttl = disk_ttl
+        # Wall clock: sqlite timestamps have to mean the same thing after a restart
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self.db = None
+        if db_path:
+            self.open(db_path)
+
+    def open(self, db_path):
+        """Add the sqlite tier, kept in db_path (created if needed)"""
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS image_results ("
+            "digest TEXT PRIMARY KEY, search_terms TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+        db.commit()
+        with self.lock:
+            self.db_path = db_path
+            self.db = db
+
+    def get(self, digest):
+        """
+        Look up the search terms for an image digest
+        Returns: (found, search_terms)
+        """
+        found, search_terms = self.memory.get(digest)
+        if not found and self.db is not None:
+            search_terms = self._disk_get(digest)
+            if search_terms is not None:
+                found = True
+                self.memory.put(digest, search_terms)
+                with self.lock:
+                    self.disk_hits += 1
+
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, search_terms
+
+    def put(self, digest, search_terms):
+        """Remember the search terms extracted for an image digest"""
+        self.memory.put(digest, search_terms)
+        if self.db is not None:
+            with self.lock:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO image_results (digest, search_terms, stored_at) VALUES (?, ?, ?)",
+                    (digest, search_terms, self.clock())
+                )
+                self.db.commit()
+
+    def stats(self):
+        """Returns: dict with overall hit ratio and per-tier counters"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            result = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "disk_hits": self.disk_hits,
+                "memory": self.memory.stats(),
+                "disk_path": self.db_path
+            }
+            if self.db is not None:
+                result["disk_entries"] = self.db.execute("SELECT COUNT(*) FROM image_results").fetchone()[0]
+        return result
+
+    def _disk_get(self, digest):
+        """Read one entry from sqlite, dropping it if older than disk_ttl"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT search_terms, stored_at FROM image_results WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            search_terms, stored_at = row
+            if self.disk_ttl is not None and stored_at + self.disk_ttl <= self.clock():
+                self.db.execute("DELETE FROM image_results WHERE digest = ?", (digest,))
+                self.db.commit()
+                return None
+            return search_terms
@@ -0,0 +1,176 @@
+"""
+Perceptual hashing and near-duplicate lookup for uploaded images
+Re-encoded or resized copies of the same photo get hashes within a small
+Hamming distance of each other, so they can reuse earlier analysis results
+"""
+import io
+import threading
+from itertools import combinations
+from collections import deque
+from PIL import Image
+
+
+HASH_BITS = 64
+
+
+def dhash(image_bytes, hash_size=8):
+    """
+    Difference hash of an image
+    The image is shrunk to (hash_size + 1) x hash_size grayscale pixels and
+    each bit records whether a pixel is brighter than its right neighbour
+    Returns: int with hash_size * hash_size bits
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft('L', (hash_size * 8, hash_size * 8))  # fast JPEG downscale on decode
+        pixels = list(img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class HammingIndex(object):
+    """
+    Multi-index hash table for radius queries over 64-bit hashes
+
+    Each hash is split into `chunks` 16-bit substrings, each with its own
+    table. Two hashes within distance r share at least one substring within
+    distance r // chunks, so a query only probes the few substrings near its
+    own and checks the exact distance of those candidates.
+
+    Holds up to `max_entries` hashes; the oldest are dropped beyond that.
+    """
+
+    def __init__(self, chunks=4, max_entries=500000):
+        self.chunks = chunks
+        self.chunk_bits = HASH_BITS // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.tables = [{} for _ in range(chunks)]
+        self.values = {}       # hash -> value
+        self.order = deque()   # insertion order for eviction
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, hash_value, value):
+        """Index a hash with the value to return for its near-duplicates"""
+        with self.lock:
+            if hash_value not in self.values:
+                for table, part in zip(self.tables, self._split(hash_value)):
+                    table.setdefault(part, []).append(hash_value)
+                self.order.append(hash_value)
+            self.values[hash_value] = value
+
+            while len(self.values) > self.max_entries:
+                self._remove(self.order.popleft())
+
+    def nearest(self, hash_value, radius):
+        """
+        Find the closest indexed hash within `radius` bits
+        Returns: (distance, value) or (None, None) if nothing is close enough
+        """
+        with self.lock:
+            if hash_value in self.values:
+                return 0, self.values[hash_value]
+
+            best_distance = radius + 1
+            best = None
+            sub_radius = radius // self.chunks
+            for table, part in zip(self.tables, self._split(hash_value)):
+                for probe in self._neighbours(part, sub_radius):
+                    for candidate in table.get(probe, ()):
+                        distance = hamming_distance(hash_value, candidate)
+                        if distance < best_distance:
+                            best_distance = distance
+                            best = candidate
+
+            if best is None:
+                return None, None
+            return best_distance, self.values[best]
+
+    def _split(self, hash_value):
+        return [(hash_value >> (i * self.chunk_bits)) & self.chunk_mask for i in range(self.chunks)]
+
+    def _neighbours(self, part, sub_radius):
+        """Every substring within sub_radius bit flips of part"""
+        yield part
+        for flips in range(1, sub_radius + 1):
+            for positions in combinations(range(self.chunk_bits), flips):
+                probe = part
+                for position in positions:
+                    probe ^= 1 << position
+                yield probe
+
+    def _remove(self, hash_value):
+        """Drop a hash from every table; caller holds the lock"""
+        del self.values[hash_value]
+        for table, part in zip(self.tables, self._split(hash_value)):
+            bucket = table[part]
+            bucket.remove(hash_value)
+            if not bucket:
+                del table[part]
+
+
+class NearDuplicateIndex(object):
+    """
+    Perceptual-hash lookup of search terms for images similar to earlier uploads
+    """
+
+    def __init__(self, threshold=6, max_entries=500000):
+        self.threshold = threshold
+        self.index = HammingIndex(max_entries=max_entries)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hash_errors = 0
+
+    def compute(self, image_bytes):
+        """
+        Perceptual hash of an image
+        Returns: int hash, or None if the image could not be decoded
+        """
+        try:
+            return dhash(image_bytes)
+        except Exception:
+            with self.lock:
+                self.hash_errors += 1
+            return None
+
+    def lookup(self, hash_value):
+        """
+        Find search terms of a near-duplicate image
+        Returns: (found, search_terms)
+        """
+        distance, search_terms = self.index.nearest(hash_value, self.threshold)
+        with self.lock:
+            if distance is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, search_terms
+
+    def add(self, hash_value, search_terms):
+        self.index.add(hash_value, search_terms)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "hash_errors": self.hash_errors,
+                "entries": len(self.index),
+                "threshold": self.threshold
+            }
@@ -0,0 +1,165 @@
+"""
+Image preprocessing before vision analysis
+Uploads are decoded once, shrunk to a maximum edge, stripped of metadata and
+re-encoded, so far fewer bytes are base64-encoded and sent to Azure OpenAI
+"""
+import io
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from logs import get_logger
+
+log = get_logger("image_preprocess")
+
+
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png",
+    "GIF": "image/gif",
+    "BMP": "image/bmp"
+}
+
+
+def guess_mime_type(image_bytes):
+    """Guess the MIME type of encoded image bytes from their magic number"""
+    header = bytes(image_bytes[:12])
+    if header.startswith(b'\x89PNG'):
+        return "image/png"
+    if header.startswith(b'GIF8'):
+        return "image/gif"
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return "image/webp"
+    if header.startswith(b'BM'):
+        return "image/bmp"
+    return "image/jpeg"
+
+
+def preprocess_image(image_bytes, max_edge=1024, output_format="JPEG", quality=85):
+    """
+    Downscale and re-encode an image (runs in a worker process)
+    Metadata (EXIF, ICC, comments) is not carried over to the output
+    Returns: (encoded_bytes, mime_type)
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Let the JPEG decoder skip detail we are about to throw away
+        img.draft('RGB', (max_edge, max_edge))
+        img = img.convert('RGB')
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        img.save(output, format=output_format, quality=quality)
+    return output.getvalue(), MIME_TYPES[output_format]
+
+
+class ImagePreprocessor(object):
+    """
+    Runs preprocess_image in a process pool so decoding and resizing never
+    hold the GIL on the serving threads, and keeps before/after byte counters
+
+    Workers are started with `start_method` ("spawn" by default): forking
+    the already multi-threaded server could copy a lock some other thread
+    holds into the child. Spawned workers import the program's main module,
+    so scripts that embed the server need an `if __name__ == '__main__':`
+    guard. A pool broken by a dying worker is replaced.
+    """
+
+    def __init__(self, max_edge=1024, output_format="JPEG", quality=85, workers=2, start_method="spawn"):
+        self.max_edge = max_edge
+        self.output_format = output_format
+        self.quality = quality
+        self.workers = workers
+        self.start_method = start_method
+
+        self.lock = threading.Lock()
+        self.pool = None
+
+        self.images = 0
+        self.failures = 0
+        self.restarts = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def get_pool(self):
+        """Create the process pool on first use"""
+        with self.lock:
+            if self.pool is None:
+                context = multiprocessing.get_context(self.start_method)
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self.pool
+
+    def replace_pool(self, broken):
+        """Drop a pool whose worker died, so get_pool starts a new one"""
+        with self.lock:
+            if self.pool is broken:
+                self.pool = None
+                self.restarts += 1
+        broken.shutdown(wait=False)
+
+    def submit(self, image_bytes):
+        """
+        Preprocess in the pool, retrying once on a fresh pool if the current
+        one is broken (a worker crashed or was killed)
+        Returns: (encoded_bytes, mime_type)
+        """
+        for attempt in range(2):
+            pool = self.get_pool()
+            try:
+                return pool.submit(
+                    preprocess_image, image_bytes, self.max_edge, self.output_format, self.quality
+                ).result()
+            except BrokenProcessPool:
+                log.warning("Image preprocessing pool broken, starting a new one")
+                self.replace_pool(pool)
+                if attempt:
+                    raise
+
+    def run(self, image_bytes):
+        """
+        Preprocess an uploaded image
+        Falls back to the original bytes if the image cannot be decoded or
+        re-encoding would make it larger
+        Returns: (image_bytes, mime_type, stats) where stats has the
+        before/after byte counts for this request
+        """
+        before = len(image_bytes)
+        try:
+            output, mime_type = self.submit(image_bytes)
+        except Exception as e:
+            log.warning("Image preprocessing failed, sending original: %s", e)
+            with self.lock:
+                self.failures += 1
+            output, mime_type = image_bytes, guess_mime_type(image_bytes)
+
+        if len(output) >= before:
+            output, mime_type = image_bytes, guess_mime_type(image_bytes)
+
+        after = len(output)
+        with self.lock:
+            self.images += 1
+            self.bytes_in += before
+            self.bytes_out += after
+
+        return output, mime_type, {"bytes_before": before, "bytes_after": after}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "images": self.images,
+                "failures": self.failures,
+                "pool_restarts": self.restarts,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "saved_ratio": round(1 - self.bytes_out / self.bytes_in, 4) if self.bytes_in else 0.0,
+                "max_edge": self.max_edge,
+                "format": self.output_format,
+                "quality": self.quality
+            }
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
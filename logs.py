@@ -0,0 +1,372 @@
+"""
+Structured logging for the server
+Threads that log only put the record on a queue (QueueHandler); one
+background thread (LogWriter) formats it as a JSON line and writes it,
+so no request waits for stdout or for other threads writing to it.
+The writer lets records gather for WRITE_INTERVAL (unless it is behind
+already) and writes whatever has queued up with a single write and flush,
+so a busy server doesn't pay a thread switch and a syscall per line.
+
+INFO records of busy commands can be sampled (LOG_SAMPLE_RATES); warnings
+and errors are always kept. Passwords, API keys and session IDs are masked
+by the writer thread too, so the request pays for none of it.
+
+The per-request line skips even the LogRecord: log_request queues its raw
+fields and the writer builds the line, after should_log has decided up
+front whether the line will be kept at all.
+
+Usage: logs.setup_logging() once at startup, then
+logs.get_logger("server").info("Client connected", extra={"address": ...})
+"""
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler
+from constants import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES
+
+LOGGER_NAME = "shopping"
+
+# Parameter positions holding secrets, per command
+SECRET_PARAMS = {"LOGIN": [1]}
+
+# Commands whose first parameter is a session ID, which works like a password
+SESSION_COMMANDS = {"SEARCH_PRODUCT", "SEARCH_MANY", "IMAGE_SEARCH", "LOGOUT"}
+
+MAX_PARAM_LENGTH = 100
+
+# Most records the writer formats before writing them out
+WRITE_BATCH = 500
+
+# Seconds the writer lets records gather after the first one arrives, so it
+# wakes once per batch rather than once per record
+WRITE_INTERVAL = 0.05
+
+# key=value / key: value pairs whose value is a secret, e.g. api_key=... in an upstream URL
+SECRET_PATTERN = re.compile(r"((?:api[_-]?key|password|token|secret)[\"']?\s*[=:]\s*[\"']?)[^&\s\"',;]+", re.I)
+
+# LogRecord attributes that are not extra fields
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def get_logger(name):
+    """Returns: the logger for a server component, e.g. get_logger("server")"""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def redact_text(text):
+    """Returns: text with the values of secret-looking key=value pairs masked"""
+    if "=" not in text and ":" not in text:
+        # Nothing SECRET_PATTERN could match, skip the regex
+        return text
+    return SECRET_PATTERN.sub(r"\1***", text)
+
+
+def redact_params(command, params):
+    """Returns: a command's params safe to log - secrets masked, session IDs shortened, long values cut"""
+    if not params:
+        return []
+    safe = [param if len(param) <= MAX_PARAM_LENGTH else param[:MAX_PARAM_LENGTH] + "..." for param in params]
+    for index in SECRET_PARAMS.get(command, ()):
+        if index < len(safe):
+            safe[index] = "***"
+    if command in SESSION_COMMANDS:
+        safe[0] = safe[0][:8] + "..."
+    return safe
+
+
+def format_address(address):
+    """Returns: "ip:port" for a socket address tuple"""
+    if isinstance(address, tuple) and len(address) >= 2:
+        return f"{address[0]}:{address[1]}"
+    return str(address)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the INFO (and lower) records of some commands
+    rates: {command: fraction to keep}; records without a command are kept
+    """
+
+    def __init__(self, rates, rng=random.random):
+        super().__init__()
+        self.rates = rates
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def sample(self, command):
+        """
+        Decide whether to keep one INFO record of command
+        Returns: the fraction of its records kept (1.0 when not sampled), or 0.0 to drop this one
+        """
+        rate = self.rates.get(command, 1.0)
+        if rate >= 1.0 or self.rng() < rate:
+            return rate
+        with self.lock:
+            self.dropped += 1
+        return 0.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.sample(getattr(record, "command", None))
+        if 0.0 < rate < 1.0:
+            record.sample_rate = rate
+        return rate > 0.0
+
+
+class AsyncHandler(QueueHandler):
+    """
+    QueueHandler that resolves the message now but leaves redaction and JSON
+    formatting to the writer thread, and drops records (counting them) when
+    the queue holds max_size records instead of blocking the request
+
+    records is a SimpleQueue, whose put is a single C call where
+    Queue.put takes a lock and notifies a condition; the size check before
+    it is not atomic, so a burst may overshoot max_size by a few records
+    """
+
+    def __init__(self, records, max_size):
+        super().__init__(records)
+        self.max_size = max_size
+        self.drop_lock = threading.Lock()
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The only handler on the logger (propagate is off), so the record can be changed in place.
+        # The message and traceback are resolved now, while the arguments and frames still hold
+        # what they did when the call was made
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() < self.max_size:
+            self.queue.put(record)
+        else:
+            with self.drop_lock:
+                self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message and any extra fields
+    Secrets in the message and traceback are masked, and "params" are passed
+    through redact_params for the record's "command"
+    """
+
+    # Entries are fresh flat dicts, so the check for reference cycles is wasted
+    encoder = json.JSONEncoder(default=str, check_circular=False)
+
+    def __init__(self):
+        super().__init__()
+        # Records come in time order, so the seconds part rarely changes,
+        # and under load many records share a millisecond
+        self.last_second = None
+        self.last_prefix = ""
+        self.last_millis = None
+        self.last_stamp = ""
+
+    def timestamp(self, created):
+        millis = int(created * 1000)
+        if millis != self.last_millis:
+            second = millis // 1000
+            if second != self.last_second:
+                self.last_second = second
+                self.last_prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self.last_millis = millis
+            self.last_stamp = f"{self.last_prefix}.{millis % 1000:03d}Z"
+        return self.last_stamp
+
+    def format(self, record):
+        entry = {
+            "ts": self.timestamp(record.created),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact_text(record.getMessage())
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_ATTRIBUTES:
+                entry[name] = value
+        if "params" in entry:
+            entry["params"] = redact_params(entry.get("command"), entry["params"])
+        if record.exc_text:
+            entry["exc"] = redact_text(record.exc_text)
+        return self.encoder.encode(entry)
+
+    def format_request(self, name, created, message, fields):
+        """Format a line queued by log_request, like an INFO record with fields as its extras"""
+        entry = {"ts": self.timestamp(created), "level": "INFO", "logger": name, "msg": redact_text(message), **fields}
+        if "params" in entry:
+            entry["params"] = redact_params(entry.get("command"), entry["params"])
+        if "address" in entry:
+            entry["address"] = format_address(entry["address"])
+        return self.encoder.encode(entry)
+
+
+class LogWriter(object):
+    """Background thread writing queued records to a stream, a batch at a time"""
+
+    STOP = None
+
+    def __init__(self, records, stream, formatter):
+        self.records = records
+        self.stream = stream
+        self.formatter = formatter
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True, name="log-writer")
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        behind = False
+        while True:
+            batch = [self.records.get()]
+            # Waiting for more to gather only helps when the queue is short;
+            # after a full batch there is more waiting already
+            if batch[0] is not self.STOP and not behind:
+                time.sleep(WRITE_INTERVAL)
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            behind = len(batch) == WRITE_BATCH
+            stopping = self.STOP in batch
+            lines = []
+            for record in batch:
+                if record is self.STOP:
+                    continue
+                try:
+                    if type(record) is tuple:
+                        lines.append(self.formatter.format_request(*record))
+                    else:
+                        lines.append(self.formatter.format(record))
+                except Exception:
+                    lines.append(self.fallback_line(record))
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass
+                self.written += len(lines)
+            if stopping:
+                return
+
+    def fallback_line(self, record):
+        """A line for a record the formatter choked on, so it isn't lost silently"""
+        if type(record) is tuple:
+            return json.dumps({"level": "INFO", "logger": record[0], "msg": redact_text(str(record[2]))})
+        return json.dumps({"level": record.levelname, "logger": record.name, "msg": redact_text(str(record.msg))})
+
+    def stop(self):
+        """Write out what is queued, then end the thread"""
+        self.records.put(self.STOP)
+        self.thread.join()
+
+
+class LogPipeline(object):
+    """The queue handler and writer thread installed by setup_logging"""
+
+    def __init__(self, handler, sampler, writer):
+        self.handler = handler
+        self.sampler = sampler
+        self.writer = writer
+        self.stopped = False
+
+    def stop(self):
+        """Write out queued records and stop the writer thread"""
+        if not self.stopped:
+            self.stopped = True
+            self.writer.stop()
+
+    def stats(self):
+        return {
+            "queued": self.handler.queue.qsize(),
+            "written": self.writer.written,
+            "dropped_queue_full": self.handler.dropped,
+            "sampled_out": self.sampler.dropped
+        }
+
+
+_lock = threading.Lock()
+pipeline = None
+
+
+def setup_logging(level=LOG_LEVEL, sample_rates=LOG_SAMPLE_RATES, stream=None, queue_size=LOG_QUEUE_SIZE):
+    """
+    Send the server's log records through a queue to a JSON-lines writer thread
+    level: minimum level name ("DEBUG", "INFO", ...), or None to turn logging off
+    stream: where lines are written (default: stdout)
+    Returns: the LogPipeline, or None when logging is off
+    """
+    global pipeline
+    with _lock:
+        if pipeline is not None:
+            pipeline.stop()
+            pipeline = None
+
+        logger = logging.getLogger(LOGGER_NAME)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.propagate = False
+
+        if level is None:
+            logger.setLevel(logging.CRITICAL + 1)
+            logger.addHandler(logging.NullHandler())
+            return None
+
+        logger.setLevel(level)
+        handler = AsyncHandler(queue.SimpleQueue(), queue_size)
+        sampler = SamplingFilter(sample_rates)
+        handler.addFilter(sampler)
+        writer = LogWriter(handler.queue, stream or sys.stdout, JsonFormatter())
+        writer.start()
+        logger.addHandler(handler)
+
+        pipeline = LogPipeline(handler, sampler, writer)
+        return pipeline
+
+
+def should_log(logger, command):
+    """
+    Decide before building it whether an INFO record of command will be
+    written, so nothing is spent on records that are off or sampled out
+    Returns: 0.0 to skip it, else the fraction of such records kept (pass it to log_request)
+    """
+    current = pipeline
+    if current is None or not logger.isEnabledFor(logging.INFO):
+        return 0.0
+    return current.sampler.sample(command)
+
+
+def log_request(logger, message, fields, sample_rate=1.0):
+    """
+    Queue one INFO line for the writer thread without building a LogRecord,
+    for the line logged per request; call should_log first
+    fields: the extra fields as they are - the writer redacts "params" and
+    formats "address" with format_address
+    """
+    current = pipeline
+    if current is None:
+        return
+    if sample_rate < 1.0:
+        fields["sample_rate"] = sample_rate
+    current.handler.enqueue((logger.name, time.time(), message, fields))
+
+
+@atexit.register
+def _flush_at_exit():
+    if pipeline is not None:
+        pipeline.stop()
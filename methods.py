@@ -2,17 +2,261 @@
 Server-side methods for shopping app
 Handles authentication, product search, and session management
 """
-import uuid
-import time
-from constants import USERS, SESSIONS, MAX_IMAGE_SIZE
-from google_search import google_search_for_product
-from chatgpt_search import analyze_image_for_products
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from constants import USERS, MAX_IMAGE_SIZE, IMAGE_RECV_CHUNK_SIZE
+from constants import SESSION_TTL, SESSION_SHARDS, SESSION_DB, SESSION_PAGE_SIZE, IMAGE_CACHE_DB
+from constants import STREAM_PRODUCT_BATCH
+from constants import CHEAP_COMMANDS, DISPATCH_MIN_RETRY_AFTER_MS
+from constants import DISPATCH_CHEAP_WORKERS, DISPATCH_CHEAP_QUEUE, DISPATCH_EXPENSIVE_WORKERS, DISPATCH_EXPENSIVE_QUEUE
+from constants import RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST
+from dispatcher import Dispatcher, WorkPool
+from ratelimit import RateLimiter, RateLimited
+from resilience import CircuitOpen
+from constants import SEARCH_MANY_MAX_QUERIES, SEARCH_MANY_CONCURRENCY, SEARCH_MANY_WORKERS, SEARCH_MANY_RATE_WAIT
+from sessions import SessionStore
+import google_search
+import providers
+import chatgpt_search
+from chatgpt_search import cached_analyze_image
 import json
+import time
+import logs
+import metrics
 import protocol
+import serialization
+
+
+# Commands followed by a raw upload that must be read before the next request
+UPLOAD_COMMANDS = ["IMAGE_SEARCH"]
+
+# Logged-in sessions: {session_id: {"username", "login_time", "last_seen", "address"}}
+# In memory until the server attaches SESSION_DB (see open_stores)
+SESSIONS = SessionStore(ttl=SESSION_TTL, shards=SESSION_SHARDS)
+
+# Search requests per user (all of a user's sessions share one bucket)
+USER_LIMITS = RateLimiter(RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST)
+
+# Threads running the individual searches of SEARCH_MANY batches
+SEARCH_MANY_POOL = ThreadPoolExecutor(max_workers=SEARCH_MANY_WORKERS, thread_name_prefix="search-many")
+
+
+def open_stores(session_db=SESSION_DB, image_cache_db=IMAGE_CACHE_DB):
+    """
+    Attach the sqlite files that keep sessions and image analysis results
+    across restarts; None keeps that store in memory only
+    Called by the server at startup rather than on import, so importing
+    this module (e.g. from tests) creates no files
+    """
+    if session_db:
+        SESSIONS.open(session_db)
+    if image_cache_db:
+        chatgpt_search.image_cache.open(image_cache_db)
+
+
+def parse_request(request):
+    """
+    Split a raw request into command and parameters
+    Returns: (command, params_list) or (None, None) for an empty request
+    """
+    request_str = request.decode().strip()
+
+    if not request_str:
+        return None, None
+
+    parts = request_str.split()
+
+    if len(parts) > 1:
+        return parts[0].upper(), parts[1:]
+    else:
+        return parts[0].upper(), None
+
+
+def receive_image(my_socket):
+    """
+    Receive the image that follows an IMAGE_SEARCH command: a frame with the
+    size, then the raw bytes. On a multiplexed connection the server reads
+    it ahead and leaves it on the request channel
+    Returns: (image_data, error_message)
+    """
+    upload = getattr(my_socket, 'upload', None)
+    if upload is not None:
+        return upload
+
+    size_data = protocol.Protocol.recv(my_socket)
+    if not size_data:
+        return None, "Failed to receive image size"
+
+    try:
+        image_size = int(size_data.decode())
+    except ValueError:
+        return None, "Invalid image size"
+
+    if image_size < 0:
+        return None, "Invalid image size"
+
+    # Check image size limit
+    if image_size > MAX_IMAGE_SIZE:
+        # Discard the bytes so the next request is read correctly
+        scratch = memoryview(bytearray(IMAGE_RECV_CHUNK_SIZE))
+        remaining = image_size
+        while remaining > 0:
+            count = my_socket.recv_into(scratch[:min(remaining, IMAGE_RECV_CHUNK_SIZE)])
+            if not count:
+                break
+            remaining -= count
+        metrics.traffic.received(image_size - remaining, frames=0)
+        return None, f"Image too large. Max size is {MAX_IMAGE_SIZE / (1024*1024)}MB"
+
+    # Receive image data straight into a preallocated buffer
+    image_data, received = protocol.recv_upload(my_socket, image_size, IMAGE_RECV_CHUNK_SIZE)
+
+    if received != image_size:
+        return None, f"Incomplete image data. Expected {image_size}, got {received}"
+
+    return image_data, None
+
+
+def send_event(my_socket, event, **fields):
+    """Push a partial result ahead of the final reply (STREAM connections only)"""
+    if getattr(my_socket, 'streaming', False):
+        fields["event"] = event
+        encoding = getattr(my_socket, 'encoding', serialization.ENCODING_JSON)
+        protocol.Protocol.send(my_socket, serialization.encode(fields, encoding))
+
+
+def stream_products(my_socket, products):
+    """
+    Push products as "products" events of STREAM_PRODUCT_BATCH each
+    Returns: True if they were streamed and can be left out of the final reply
+    """
+    if not getattr(my_socket, 'streaming', False):
+        return False
+    for offset in range(0, len(products), STREAM_PRODUCT_BATCH):
+        send_event(my_socket, "products", offset=offset,
+                   products=products[offset:offset + STREAM_PRODUCT_BATCH])
+    return True
+
+
+# Errors that mean "not now": over a rate limit, or the upstream's circuit breaker is open
+RETRY_LATER = (RateLimited, CircuitOpen)
+
+
+def retry_later_error(error):
+    """Returns: reply fields for a RETRY_LATER exception (its code and retry-after hint)"""
+    return {
+        "status": "error",
+        "code": error.code,
+        "message": str(error),
+        "retry_after_ms": error.retry_after_ms
+    }
+
+
+def retry_later_reply(error, **fields):
+    """Returns: JSON error reply for a RETRY_LATER exception"""
+    return json.dumps(dict(retry_later_error(error), **fields))
+
+
+def user_limit_reply(session):
+    """Returns: a RATE_LIMITED reply if the session's user is over their request rate, else None"""
+    retry_after = USER_LIMITS.try_acquire(session["username"])
+    if retry_after:
+        return retry_later_reply(RateLimited("Request", retry_after))
+    return None
+
+
+def search_many(queries, concurrency=SEARCH_MANY_CONCURRENCY, on_result=None, username=None,
+                max_wait=SEARCH_MANY_RATE_WAIT):
+    """
+    Run several product searches in parallel, at most `concurrency` at a time
+    on_result: called with each result as soon as its query completes
+    username: charge each query to this user's rate limit, like a SEARCH_PRODUCT;
+    a query over it waits for its token, up to max_wait seconds after the
+    batch started
+    Returns: list of per-query results in the order they completed, each
+    {"index", "query", "status", "products"/"message"}; rate limited
+    queries and queries refused by an open circuit breaker also carry
+    "code" and "retry_after_ms"
+    """
+    limits = USER_LIMITS
+    deadline = limits.clock() + max_wait
+
+    def search(index, query):
+        try:
+            if username is not None:
+                limits.wait(username, "Request", deadline - limits.clock())
+            products, error_message = providers.get_provider().search(query)
+        except RETRY_LATER as error:
+            return dict(retry_later_error(error), index=index, query=query)
+        except Exception as msg:
+            products, error_message = None, f"Search failed: {msg}"
+
+        if error_message:
+            return {"index": index, "query": query, "status": "error", "message": error_message}
+        return {"index": index, "query": query, "status": "success", "products": products or []}
+
+    results = []
+    waiting = list(enumerate(queries))
+    running = set()
+    while waiting or running:
+        while waiting and len(running) < concurrency:
+            index, query = waiting.pop(0)
+            running.add(SEARCH_MANY_POOL.submit(search, index, query))
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            results.append(future.result())
+            if on_result:
+                on_result(results[-1])
+    return results
 
 
 class Methods(object):
     
+    @staticmethod
+    def PROTOCOL(my_socket, params, address):
+        """
+        Negotiate the framing and optional features for the rest of the connection
+        params: [framing, feature...] e.g. BINARY MUX STREAM COMPRESS MSGPACK
+        Returns: JSON with the accepted framing, features and encoding or error
+        Unknown features are left out of the reply rather than rejected
+        Of several encodings the first one this server supports is used
+        The switch takes effect after this reply has been sent
+        A multiplexed connection keeps its settings: other requests may be
+        in flight on it, so it can't switch safely
+        """
+        if not params or len(params) < 1:
+            return json.dumps({"status": "error", "message": "Framing required"})
+
+        if getattr(my_socket, 'multiplexed', False):
+            return json.dumps({
+                "status": "error",
+                "message": "Protocol can't be changed on a multiplexed connection. Open a new connection."
+            })
+
+        framing = params[0].upper()
+
+        if framing not in protocol.SUPPORTED_FRAMINGS:
+            return json.dumps({
+                "status": "error",
+                "message": f"Unsupported framing: {framing}",
+                "supported": protocol.SUPPORTED_FRAMINGS
+            })
+
+        features = []
+        encoding = serialization.ENCODING_JSON
+        if framing == protocol.FRAMING_BINARY:
+            requested = [f.upper() for f in params[1:]]
+            features = [f for f in requested if f in protocol.SUPPORTED_FEATURES]
+            encoding = next((f for f in requested if f in serialization.SUPPORTED_ENCODINGS), encoding)
+
+        my_socket.pending_settings = {
+            "framing": framing,
+            "multiplexed": protocol.FEATURE_MUX in features,
+            "streaming": protocol.FEATURE_STREAM in features,
+            "encoding": encoding,
+            "compression": protocol.FEATURE_COMPRESS in features
+        }
+        return json.dumps({"status": "success", "framing": framing, "features": features, "encoding": encoding})
+
     @staticmethod
     def LOGIN(my_socket, params, address):
         """
@@ -29,12 +273,7 @@ class Methods(object):
         # Check credentials
         if username in USERS and USERS[username] == password:
             # Create session
-            session_id = str(uuid.uuid4())
-            SESSIONS[session_id] = {
-                "username": username,
-                "login_time": time.time(),
-                "address": address
-            }
+            session_id = SESSIONS.create(username, address)
             
             return json.dumps({
                 "status": "success",
@@ -51,7 +290,7 @@ class Methods(object):
     @staticmethod
     def SEARCH_PRODUCT(my_socket, params, address):
         """
-        Search for products using Google Shopping API
+        Search for products with the configured provider (SerpAPI or the local catalog)
         params: [session_id, product_query]
         Returns: JSON with product list or error
         """
@@ -62,11 +301,19 @@ class Methods(object):
         product_query = ' '.join(params[1:])  # Join remaining params as query
         
         # Validate session
-        if session_id not in SESSIONS:
+        session = SESSIONS.get(session_id)
+        if session is None:
             return json.dumps({"status": "error", "message": "Invalid session. Please login again."})
         
+        limited = user_limit_reply(session)
+        if limited:
+            return limited
+        
         # Search for products
-        products, error_message = google_search_for_product(product_query)
+        try:
+            products, error_message = providers.get_provider().search(product_query)
+        except RETRY_LATER as error:
+            return retry_later_reply(error)
         
         if error_message:
             return json.dumps({
@@ -81,6 +328,14 @@ class Methods(object):
                 "message": f"No products found for '{product_query}'"
             })
         
+        if stream_products(my_socket, products):
+            return json.dumps({
+                "status": "success",
+                "event": "done",
+                "query": product_query,
+                "count": len(products)
+            })
+        
         return json.dumps({
             "status": "success",
             "products": products,
@@ -88,6 +343,68 @@ class Methods(object):
             "count": len(products)
         })
     
+    @staticmethod
+    def SEARCH_MANY(my_socket, params, address):
+        """
+        Search for several products in one request
+        params: [session_id, JSON list of queries] e.g. ["red shoes", "usb cable"]
+        Returns: JSON with one result per query, in completion order; each
+        carries the query's index and its own status so one failing query
+        does not fail the batch
+        Every query counts against the user's rate limit; queries over it
+        wait for it, and only those that would still be waiting
+        SEARCH_MANY_RATE_WAIT seconds into the batch come back RATE_LIMITED
+        in their own result
+        On STREAM connections each result is sent as a "result" event as
+        soon as its query completes, and the reply is a summary without them
+        """
+        if not params or len(params) < 2:
+            return json.dumps({"status": "error", "message": "Session ID and query list required"})
+
+        session_id = params[0]
+
+        try:
+            queries = json.loads(' '.join(params[1:]))
+        except ValueError:
+            return json.dumps({"status": "error", "message": "Queries must be a JSON list of strings"})
+
+        if not isinstance(queries, list) or not all(isinstance(q, str) and q.strip() for q in queries):
+            return json.dumps({"status": "error", "message": "Queries must be a JSON list of strings"})
+
+        if not queries or len(queries) > SEARCH_MANY_MAX_QUERIES:
+            return json.dumps({
+                "status": "error",
+                "message": f"Between 1 and {SEARCH_MANY_MAX_QUERIES} queries required"
+            })
+
+        # Validate session once for the whole batch
+        session = SESSIONS.get(session_id)
+        if session is None:
+            return json.dumps({"status": "error", "message": "Invalid session. Please login again."})
+
+        on_result = None
+        if getattr(my_socket, 'streaming', False):
+            def on_result(result):
+                send_event(my_socket, "result", **result)
+
+        results = search_many(queries, on_result=on_result, username=session["username"])
+        failed = sum(1 for result in results if result["status"] != "success")
+
+        if on_result:
+            return json.dumps({
+                "status": "success",
+                "event": "done",
+                "count": len(results),
+                "failed": failed
+            })
+
+        return json.dumps({
+            "status": "success",
+            "results": results,
+            "count": len(results),
+            "failed": failed
+        })
+
     @staticmethod
     def LOGOUT(my_socket, params, address):
         """
@@ -100,9 +417,9 @@ class Methods(object):
         
         session_id = params[0]
         
-        if session_id in SESSIONS:
-            username = SESSIONS[session_id]["username"]
-            del SESSIONS[session_id]
+        session = SESSIONS.delete(session_id)
+        if session is not None:
+            username = session["username"]
             return json.dumps({
                 "status": "success",
                 "message": f"Goodbye, {username}!"
@@ -116,13 +433,23 @@ class Methods(object):
     @staticmethod
     def GET_SESSIONS(my_socket, params, address):
         """
-        Get active sessions (for debugging)
-        Returns: JSON with session count
+        Get active sessions (for debugging), one page at a time
+        params: [limit] [cursor] - cursor is the next_cursor of the previous page
+        Returns: JSON with session count and a page of session IDs
         """
+        try:
+            limit = int(params[0]) if params else SESSION_PAGE_SIZE
+        except ValueError:
+            return json.dumps({"status": "error", "message": "Limit must be a number"})
+        cursor = params[1] if params and len(params) > 1 else None
+
+        session_ids, next_cursor = SESSIONS.page(cursor, max(1, min(limit, SESSION_PAGE_SIZE)))
+
         return json.dumps({
             "status": "success",
             "active_sessions": len(SESSIONS),
-            "sessions": list(SESSIONS.keys())
+            "sessions": session_ids,
+            "next_cursor": next_cursor
         })
     
     @staticmethod
@@ -136,46 +463,31 @@ class Methods(object):
         params: [session_id]
         Returns: JSON with search terms and product list or error
         """
+        # Always consume the upload first so the connection stays in sync
+        # even when the request is rejected
+        image_data, upload_error = receive_image(my_socket)
+
         if not params or len(params) < 1:
             return json.dumps({"status": "error", "message": "Session ID required"})
         
         session_id = params[0]
         
         # Validate session
-        if session_id not in SESSIONS:
+        session = SESSIONS.get(session_id)
+        if session is None:
             return json.dumps({"status": "error", "message": "Invalid session. Please login again."})
         
+        if upload_error:
+            return json.dumps({"status": "error", "message": upload_error})
+        
+        limited = user_limit_reply(session)
+        if limited:
+            return limited
+        
+        search_terms = None
         try:
-            # Receive image size
-            size_data = protocol.Protocol.recv(my_socket)
-            if not size_data:
-                return json.dumps({"status": "error", "message": "Failed to receive image size"})
-            
-            image_size = int(size_data.decode())
-            
-            # Check image size limit
-            if image_size > MAX_IMAGE_SIZE:
-                return json.dumps({
-                    "status": "error", 
-                    "message": f"Image too large. Max size is {MAX_IMAGE_SIZE / (1024*1024)}MB"
-                })
-            
-            # Receive image data
-            image_data = b""
-            while len(image_data) < image_size:
-                chunk = my_socket.recv(min(4096, image_size - len(image_data)))
-                if not chunk:
-                    break
-                image_data += chunk
-            
-            if len(image_data) != image_size:
-                return json.dumps({
-                    "status": "error", 
-                    "message": f"Incomplete image data. Expected {image_size}, got {len(image_data)}"
-                })
-            
             # Analyze image with GPT-4 Vision
-            search_terms, error = analyze_image_for_products(image_bytes=image_data)
+            search_terms, error = cached_analyze_image(image_data)
             
             if error:
                 return json.dumps({
@@ -189,8 +501,11 @@ class Methods(object):
                     "message": "Could not extract search terms from image"
                 })
             
+            # Let a streaming client show the terms while products are fetched
+            send_event(my_socket, "search_terms", search_terms=search_terms)
+            
             # Search for products using extracted terms
-            products, search_error = google_search_for_product(search_terms)
+            products, search_error = providers.get_provider().search(search_terms)
             
             if search_error:
                 return json.dumps({
@@ -207,6 +522,16 @@ class Methods(object):
                     "message": f"No products found for '{search_terms}'"
                 })
             
+            if stream_products(my_socket, products):
+                return json.dumps({
+                    "status": "success",
+                    "event": "done",
+                    "search_terms": search_terms,
+                    "query": search_terms,
+                    "count": len(products),
+                    "message": f"Found {len(products)} products for '{search_terms}'"
+                })
+            
             return json.dumps({
                 "status": "success",
                 "products": products,
@@ -216,13 +541,111 @@ class Methods(object):
                 "message": f"Found {len(products)} products for '{search_terms}'"
             })
             
+        except RETRY_LATER as error:
+            if search_terms:
+                return retry_later_reply(error, search_terms=search_terms)
+            return retry_later_reply(error)
         except Exception as e:
             return json.dumps({
                 "status": "error",
                 "message": f"Error processing image: {str(e)}"
             })
     
+    @staticmethod
+    def CACHE_STATS(my_socket, params, address):
+        """
+        Get result cache, request coalescing, frame compression, rate limit,
+        upstream breaker and dispatcher counters (for monitoring)
+        Returns: JSON with hit/miss/eviction counters per cache,
+        collapsed-call counters per upstream, bytes saved by compression,
+        allowed/limited counts per rate limit, retries and circuit breaker
+        state (with recent state changes) per upstream and queue depth/wait
+        time per dispatcher pool
+        """
+        caches = {}
+        if google_search.search_cache is not None:
+            caches["search"] = google_search.search_cache.stats()
+        caches["image_analysis"] = chatgpt_search.image_cache.stats()
+        caches["image_near_duplicates"] = chatgpt_search.near_duplicates.stats()
+
+        return json.dumps({
+            "status": "success",
+            "caches": caches,
+            "image_preprocess": chatgpt_search.preprocessor.stats(),
+            "coalescing": {
+                "search": google_search.search_flight.stats(),
+                "image_analysis": chatgpt_search.analyze_flight.stats()
+            },
+            "compression": protocol.compression_stats.stats(),
+            "rate_limits": {
+                "users": USER_LIMITS.stats(),
+                "serpapi": google_search.serpapi_limit.stats(),
+                "azure_openai": chatgpt_search.azure_limit.stats()
+            },
+            "upstreams": {
+                "serpapi": google_search.serpapi_upstream.stats(),
+                "azure_openai": chatgpt_search.azure_upstream.stats()
+            },
+            "dispatcher": DISPATCHER.stats()
+        })
+
+    @staticmethod
+    def STATS(my_socket, params, address):
+        """
+        Get server metrics (for monitoring; also served in Prometheus format with server --metrics-port)
+        Returns: JSON with count, error count and latency percentiles per
+        command, latency per upstream API call, the product provider, bytes
+        and frames in/out, connection counts and log records dropped by
+        sampling or a full queue
+        """
+        return json.dumps({
+            "status": "success",
+            "uptime_seconds": round(time.monotonic() - metrics.started_at, 1),
+            "commands": metrics.commands.stats(),
+            "upstreams": {
+                "serpapi": google_search.serpapi_upstream.latency.stats(),
+                "azure_openai": chatgpt_search.azure_upstream.latency.stats()
+            },
+            "provider": providers.get_provider().stats(),
+            "traffic": metrics.traffic.stats(),
+            "connections": metrics.connections.stats(),
+            "logging": logs.pipeline.stats() if logs.pipeline is not None else None
+        })
+
     @staticmethod
     def EXIT(my_socket, params, address):
         """Close client connection"""
         return json.dumps({"status": "success", "message": "EXIT"})
+
+
+# Runs the handlers for both server engines on bounded pools (see dispatcher.py)
+DISPATCHER = Dispatcher(
+    Methods,
+    CHEAP_COMMANDS,
+    WorkPool("cheap", DISPATCH_CHEAP_WORKERS, DISPATCH_CHEAP_QUEUE, DISPATCH_MIN_RETRY_AFTER_MS),
+    WorkPool("expensive", DISPATCH_EXPENSIVE_WORKERS, DISPATCH_EXPENSIVE_QUEUE, DISPATCH_MIN_RETRY_AFTER_MS),
+    command_metrics=metrics.commands
+)
+
+
+def metric_families():
+    """Returns: every server metric as (name, type, help, samples) for metrics.render"""
+    upstream_calls = {"serpapi": google_search.serpapi_upstream, "azure_openai": chatgpt_search.azure_upstream}
+    upstreams = {name: upstream.stats() for name, upstream in upstream_calls.items()}
+    pools = DISPATCHER.stats()
+
+    return metrics.commands.families() + [
+        ("shopping_upstream_request_duration_seconds", "histogram",
+         "Duration of each call to an upstream API, retries counted separately",
+         [sample for name, upstream in upstream_calls.items()
+          for sample in upstream.latency.samples({"upstream": name})]),
+        ("shopping_upstream_retries_total", "counter", "Upstream calls retried after a failure",
+         [("", {"upstream": name}, stats["retries"]) for name, stats in upstreams.items()]),
+        ("shopping_upstream_breaker_state", "gauge", "1 for the current circuit breaker state of each upstream",
+         [("", {"upstream": name, "state": state}, int(stats["breaker"]["state"] == state))
+          for name, stats in upstreams.items() for state in ("closed", "open", "half_open")]),
+        ("shopping_dispatch_queue_depth", "gauge", "Requests waiting for a dispatcher worker",
+         [("", {"pool": name}, stats["queue_depth"]) for name, stats in pools.items()]),
+        ("shopping_dispatch_rejected_total", "counter", "Requests refused because a dispatcher queue was full",
+         [("", {"pool": name}, stats["rejected"]) for name, stats in pools.items()])
+    ] + metrics.traffic.families() + metrics.connections.families()
@@ -0,0 +1,260 @@
+"""
+Server metrics: per-command counts and latency histograms, upstream call
+timings, bytes in/out and connection counts
+Latencies go into fixed log-scale buckets, so recording one is a bisect and
+a few additions under a short lock - cheap enough to leave on in production.
+Read through the STATS command, or in Prometheus text format over HTTP when
+the server is given a metrics port (see serve_http)
+"""
+import time
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from logs import get_logger
+
+log = get_logger("metrics")
+
+# Bucket upper bounds in seconds: 0.5 ms doubling up to ~65 s, plus one for anything slower
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** i for i in range(18))
+
+# Label for commands the server doesn't know, so clients can't create unbounded label values
+UNKNOWN_COMMAND = "UNKNOWN"
+
+
+class Histogram(object):
+    """Thread-safe latency histogram over fixed bucket bounds (seconds)"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.bounds, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        """Returns: (bucket counts, sum of observations, largest observation)"""
+        with self.lock:
+            return list(self.counts), self.total, self.max
+
+    def quantile(self, counts, q, largest):
+        """Returns: upper bound of the bucket holding the q-quantile, capped at the largest value seen"""
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[index], largest) if index < len(self.bounds) else largest
+        return 0.0
+
+    def stats(self):
+        counts, total, largest = self.snapshot()
+        count = sum(counts)
+        return {
+            "count": count,
+            "avg_ms": round(total / count * 1000, 2) if count else 0.0,
+            "p50_ms": round(self.quantile(counts, 0.50, largest) * 1000, 2),
+            "p95_ms": round(self.quantile(counts, 0.95, largest) * 1000, 2),
+            "p99_ms": round(self.quantile(counts, 0.99, largest) * 1000, 2),
+            "max_ms": round(largest * 1000, 2)
+        }
+
+    def samples(self, labels):
+        """Returns: Prometheus (suffix, labels, value) samples - cumulative buckets, sum and count"""
+        counts, total, largest = self.snapshot()
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            result.append(("_bucket", dict(labels, le=f"{bound:g}"), cumulative))
+        cumulative += counts[-1]
+        result.append(("_bucket", dict(labels, le="+Inf"), cumulative))
+        result.append(("_sum", labels, total))
+        result.append(("_count", labels, cumulative))
+        return result
+
+
+class CommandMetrics(object):
+    """Latency histogram and error count per command"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+
+    def record(self, command, seconds, ok):
+        histogram = self.latency.get(command)
+        if histogram is None:
+            with self.lock:
+                histogram = self.latency.setdefault(command, Histogram())
+                self.errors.setdefault(command, 0)
+        histogram.observe(seconds)
+        if not ok:
+            with self.lock:
+                self.errors[command] += 1
+
+    def stats(self):
+        with self.lock:
+            latency = dict(self.latency)
+            errors = dict(self.errors)
+        return {
+            command: dict(histogram.stats(), errors=errors[command])
+            for command, histogram in sorted(latency.items())
+        }
+
+    def families(self):
+        with self.lock:
+            latency = sorted(self.latency.items())
+            errors = sorted(self.errors.items())
+        return [
+            ("shopping_command_duration_seconds", "histogram",
+             "Time from receiving a command to its reply being ready, queueing included",
+             [sample for command, histogram in latency for sample in histogram.samples({"command": command})]),
+            ("shopping_command_errors_total", "counter", "Commands answered with an error",
+             [("", {"command": command}, count) for command, count in errors])
+        ]
+
+
+class TrafficStats(object):
+    """Frames and bytes read from and written to clients (headers included)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def received(self, size, frames=1):
+        with self.lock:
+            self.frames_in += frames
+            self.bytes_in += size
+
+    def sent(self, size):
+        with self.lock:
+            self.frames_out += 1
+            self.bytes_out += size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "frames_in": self.frames_in,
+                "frames_out": self.frames_out,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out
+            }
+
+    def families(self):
+        stats = self.stats()
+        return [
+            ("shopping_received_bytes_total", "counter", "Bytes read from clients",
+             [("", {}, stats["bytes_in"])]),
+            ("shopping_sent_bytes_total", "counter", "Bytes written to clients",
+             [("", {}, stats["bytes_out"])]),
+            ("shopping_received_frames_total", "counter", "Frames read from clients",
+             [("", {}, stats["frames_in"])]),
+            ("shopping_sent_frames_total", "counter", "Frames written to clients",
+             [("", {}, stats["frames_out"])])
+        ]
+
+
+class ConnectionStats(object):
+    """Client connections opened so far and currently open"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+
+    def open(self):
+        with self.lock:
+            self.opened += 1
+
+    def close(self):
+        with self.lock:
+            self.closed += 1
+
+    def stats(self):
+        with self.lock:
+            return {"active": self.opened - self.closed, "total": self.opened}
+
+    def families(self):
+        stats = self.stats()
+        return [
+            ("shopping_connections_active", "gauge", "Client connections currently open",
+             [("", {}, stats["active"])]),
+            ("shopping_connections_total", "counter", "Client connections accepted",
+             [("", {}, stats["total"])])
+        ]
+
+
+commands = CommandMetrics()
+traffic = TrafficStats()
+connections = ConnectionStats()
+started_at = time.monotonic()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def render(families):
+    """
+    Format metric families in the Prometheus text exposition format
+    families: iterable of (name, type, help, [(suffix, labels, value), ...])
+    Returns: the text (str)
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{format_labels(labels)} {value}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def serve_http(ip, port, collect):
+    """
+    Serve GET /metrics in Prometheus text format from a background thread
+    collect: function returning the metric families (see render)
+    Returns: the HTTP server (call shutdown() to stop it), or None if the
+    port can't be bound; the shopping server keeps running without it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            data = render(collect()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        httpd = ThreadingHTTPServer((ip, port), Handler)
+    except OSError as msg:
+        log.warning("Metrics not served, can't listen on %s:%s: %s", ip, port, msg)
+        return None
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True, name="metrics-http").start()
+    log.info("Metrics available at http://%s:%s/metrics", ip, port)
+    return httpd
@@ -1,27 +1,329 @@
 """
 Protocol for socket communication
 Handles sending and receiving messages with length prefixing
+
+Two framings are supported on the same port:
+- LEGACY: 4 ASCII digits with the payload length, then the payload (max 9999 bytes)
+- BINARY: 1 version byte, 1 flags byte, 4-byte big-endian payload length, then the payload
+
+Every connection starts in LEGACY framing. A client that wants BINARY framing
+sends "PROTOCOL BINARY" as its first command; both sides switch right after
+the server's (legacy framed) reply. Old clients never send it and old servers
+answer with an error, so either side can be upgraded independently.
+
+"PROTOCOL BINARY MUX" also turns on multiplexing: every frame then has
+FLAG_REQUEST_ID set and a 4-byte request ID after the header, replies carry
+the ID of their request, and a client may have many requests outstanding
+and receive the replies out of order. A multiplexed connection can't be
+renegotiated: a later PROTOCOL request gets an error.
+
+"PROTOCOL BINARY STREAM" lets SEARCH_PRODUCT, SEARCH_MANY and IMAGE_SEARCH
+answer with several frames: partial events ({"event": "search_terms"},
+{"event": "products"} and, per SEARCH_MANY query, {"event": "result"}) as
+results become available, then the final reply.
+Any frame that is not a partial event is the final reply; after streamed
+products it is a summary ({"event": "done", "count": ...}) without them.
+
+Replies are JSON unless a compact encoding is negotiated as well, e.g.
+"PROTOCOL BINARY MUX MSGPACK" (see serialization.py).
+
+"PROTOCOL BINARY COMPRESS" lets both sides zlib-compress frames of at least
+COMPRESS_THRESHOLD bytes; such frames have FLAG_COMPRESSED set and the
+header length is the compressed length. Each frame is compressed on its
+own, so frames can still be sent in any order.
 """
-import socket
 import json
+import zlib
+import socket
+import struct
+import asyncio
+import threading
+import metrics
+from serialization import ENCODING_JSON
 
 MAX = 4
 DATA_SIZE = 0
+LEGACY_MAX_LENGTH = 10 ** MAX - 1
+
+FRAMING_LEGACY = "LEGACY"
+FRAMING_BINARY = "BINARY"
+SUPPORTED_FRAMINGS = [FRAMING_LEGACY, FRAMING_BINARY]
+
+# Binary frame header: version, flags, payload length
+BINARY_VERSION = 1
+HEADER = struct.Struct('!BBI')
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64MB max payload per frame
+
+# Header flags
+FLAG_REQUEST_ID = 0x01  # a 4-byte request ID follows the header
+FLAG_COMPRESSED = 0x02  # the payload is zlib-compressed
+REQUEST_ID = struct.Struct('!I')
+
+# Frame compression (COMPRESS feature)
+COMPRESS_THRESHOLD = 1024  # smaller payloads are sent as they are
+COMPRESS_LEVEL = 6
+
+# Optional features negotiated with PROTOCOL (BINARY framing only)
+FEATURE_MUX = "MUX"
+FEATURE_STREAM = "STREAM"
+FEATURE_COMPRESS = "COMPRESS"
+SUPPORTED_FEATURES = [FEATURE_MUX, FEATURE_STREAM, FEATURE_COMPRESS]
+
+# Events sent ahead of the final reply on STREAM connections
+PARTIAL_EVENTS = ["search_terms", "products", "result"]
+
+
+class Connection(object):
+    """
+    Wraps a connected socket and remembers the framing negotiated for it
+    Any other attribute (recv, sendall, close, ...) is forwarded to the socket
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.framing = FRAMING_LEGACY
+        self.multiplexed = False
+        self.streaming = False
+        self.encoding = ENCODING_JSON
+        self.compression = False
+        # Settings to apply once the current reply has been sent
+        self.pending_settings = None
+        # Held while writing a frame so concurrent senders never interleave
+        self.send_lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class RequestChannel(object):
+    """
+    One request on a multiplexed connection
+    Frames sent through it carry its request ID; anything else is forwarded
+    to the connection. `upload` holds image data the server read ahead
+    """
+
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+        self.framing = connection.framing
+        self.pending_settings = None
+        self.upload = None
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class CompressionStats(object):
+    """Counts frames sent on COMPRESS connections and the bytes compression saved"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames_compressed = 0
+        self.frames_raw = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def record(self, before, after, compressed):
+        with self.lock:
+            if compressed:
+                self.frames_compressed += 1
+            else:
+                self.frames_raw += 1
+            self.bytes_before += before
+            self.bytes_after += after
+
+    def stats(self):
+        with self.lock:
+            return {
+                "frames_compressed": self.frames_compressed,
+                "frames_raw": self.frames_raw,
+                "bytes_before": self.bytes_before,
+                "bytes_after": self.bytes_after,
+                "ratio": round(self.bytes_after / self.bytes_before, 3) if self.bytes_before else None
+            }
+
+
+compression_stats = CompressionStats()
+
+
+def compress_payload(my_socket, encoded_msg):
+    """
+    Compress a payload for a COMPRESS connection when it is large enough and
+    actually gets smaller. Call before taking the send lock: this is the slow part
+    Returns: (flags, payload) - FLAG_COMPRESSED or 0, and the bytes to send
+    """
+    if not getattr(my_socket, 'compression', False):
+        return 0, encoded_msg
+
+    if len(encoded_msg) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(encoded_msg, COMPRESS_LEVEL)
+        if len(compressed) < len(encoded_msg):
+            compression_stats.record(len(encoded_msg), len(compressed), True)
+            return FLAG_COMPRESSED, compressed
+
+    compression_stats.record(len(encoded_msg), len(encoded_msg), False)
+    return 0, encoded_msg
+
+
+def decompress_payload(payload):
+    """
+    Inflate a FLAG_COMPRESSED payload, refusing to grow past MAX_FRAME_SIZE
+    Returns: the original bytes
+    """
+    try:
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as msg:
+        raise socket.error(f"Corrupt compressed frame: {msg}")
+    if inflater.unconsumed_tail:
+        raise socket.error("Compressed frame exceeds MAX_FRAME_SIZE")
+    return data
+
+
+def legacy_header(length):
+    """Build the zero-filled ASCII length prefix for a legacy frame"""
+    if length > LEGACY_MAX_LENGTH:
+        raise ValueError(f"Message of {length} bytes does not fit legacy framing "
+                         f"(max {LEGACY_MAX_LENGTH})")
+    return str(length).zfill(MAX).encode()
+
+
+def binary_header(length, flags=0, request_id=None):
+    """Build the fixed-width header (plus request ID, if any) for a binary frame"""
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds MAX_FRAME_SIZE ({MAX_FRAME_SIZE})")
+    if request_id is None:
+        return HEADER.pack(BINARY_VERSION, flags, length)
+    return HEADER.pack(BINARY_VERSION, flags | FLAG_REQUEST_ID, length) + REQUEST_ID.pack(request_id)
+
+
+def check_binary_header(header):
+    """
+    Validate a received binary header
+    Returns: (flags, length)
+    """
+    version, flags, length = HEADER.unpack(header)
+    if version != BINARY_VERSION:
+        raise socket.error(f"Unsupported frame version: {version}")
+    if length > MAX_FRAME_SIZE:
+        raise socket.error(f"Frame of {length} bytes exceeds MAX_FRAME_SIZE")
+    return flags, length
+
+
+def oversized_reply(my_socket):
+    """Returns: JSON error reply sent instead of a response too large for the connection's framing"""
+    if getattr(my_socket, 'framing', FRAMING_LEGACY) == FRAMING_BINARY:
+        message = f"Response exceeds the maximum frame size of {MAX_FRAME_SIZE} bytes."
+    else:
+        message = "Response too large for legacy framing. Negotiate with PROTOCOL BINARY."
+    return json.dumps({"status": "error", "message": message})
+
+
+def apply_pending_settings(my_socket):
+    """Switch to the framing/features agreed on during the request that was just answered"""
+    pending = getattr(my_socket, 'pending_settings', None)
+    if pending:
+        for name, value in pending.items():
+            setattr(my_socket, name, value)
+        my_socket.pending_settings = None
+
+
+def write_frame(my_socket, prefix, payload):
+    """
+    Write a frame header and payload without letting other frames in between
+    Sockets that know how to do this atomically provide write_frame themselves
+    """
+    writer = getattr(my_socket, 'write_frame', None)
+    if writer is not None:
+        writer(prefix, payload)
+        metrics.traffic.sent(len(prefix) + len(payload))
+        return
+
+    lock = getattr(my_socket, 'send_lock', None)
+    if lock is not None:
+        lock.acquire()
+    try:
+        if len(payload) < 64 * 1024:
+            # One syscall for small frames
+            my_socket.sendall(prefix + payload)
+        else:
+            # Avoid copying large payloads just to prepend the header
+            my_socket.sendall(prefix)
+            my_socket.sendall(payload)
+    finally:
+        if lock is not None:
+            lock.release()
+    metrics.traffic.sent(len(prefix) + len(payload))
+
+
+def recv_exact_into(my_socket, view, chunk_size=None):
+    """
+    Fill a writable memoryview completely from the socket
+    chunk_size caps how much is requested per recv_into call
+    Returns: True when the view was filled, False if the peer closed first
+    """
+    received = 0
+    total = len(view)
+    while received < total:
+        end = total if chunk_size is None else min(total, received + chunk_size)
+        count = my_socket.recv_into(view[received:end])
+        if not count:
+            return False
+        received += count
+    return True
+
+
+def recv_upload(my_socket, size, chunk_size=256 * 1024):
+    """
+    Receive a raw (unframed) upload of a known size, such as image data
+    The buffer is allocated once and filled in place, so no intermediate
+    bytes objects are created
+    Returns: (buffer, received) - a bytearray of `size` bytes and how many
+    of them arrived before the peer closed
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = my_socket.recv_into(view[received:min(size, received + chunk_size)])
+        if not count:
+            break
+        received += count
+    view.release()
+    metrics.traffic.received(received, frames=0)
+    return buffer, received
 
 
 class Protocol(object):
 
     @staticmethod
     def send(my_socket, data):
-        """Send string data over socket with length prefix"""
-        encoded_msg = data.encode()
-        length = len(encoded_msg)
-        length_str = str(length).zfill(MAX)
-        length_bytes = length_str.encode()
-        my_socket.send(length_bytes + encoded_msg)
+        """Send string (or bytes) data over socket using the connection's framing"""
+        encoded_msg = data.encode() if isinstance(data, str) else data
+        framing = getattr(my_socket, 'framing', FRAMING_LEGACY)
+
+        if framing == FRAMING_BINARY:
+            flags, encoded_msg = compress_payload(my_socket, encoded_msg)
+            Protocol.send_binary(my_socket, encoded_msg, flags, getattr(my_socket, 'request_id', None))
+        else:
+            Protocol.send_legacy(my_socket, encoded_msg)
+
+        apply_pending_settings(my_socket)
 
     @staticmethod
     def recv(my_socket):
+        """Receive data from socket using the connection's framing"""
+        if getattr(my_socket, 'framing', FRAMING_LEGACY) == FRAMING_BINARY:
+            return Protocol.recv_binary(my_socket)
+        return Protocol.recv_legacy(my_socket)
+
+    @staticmethod
+    def send_legacy(my_socket, encoded_msg):
+        """Send bytes with a zero-filled ASCII length prefix"""
+        write_frame(my_socket, legacy_header(len(encoded_msg)), encoded_msg)
+
+    @staticmethod
+    def recv_legacy(my_socket):
         """Receive string data from socket using length prefix"""
         size = MAX
         tot_data = b''
@@ -33,11 +335,11 @@ class Protocol(object):
                 return b''
             size -= len(data)
             tot_data += data
-        
+
         # Parse length
         size = int(tot_data.decode())
         tot_data = b''
-        
+
         # Read actual data
         while size > DATA_SIZE:
             data = my_socket.recv(size)
@@ -45,5 +347,108 @@ class Protocol(object):
                 return b''
             size -= len(data)
             tot_data += data
-        
+
+        metrics.traffic.received(MAX + len(tot_data))
         return tot_data
+
+    @staticmethod
+    def send_binary(my_socket, encoded_msg, flags=0, request_id=None):
+        """Send bytes with a fixed-width binary header"""
+        write_frame(my_socket, binary_header(len(encoded_msg), flags, request_id), encoded_msg)
+
+    @staticmethod
+    def recv_binary(my_socket):
+        """
+        Receive one binary frame into a preallocated buffer
+        Returns: bytearray with the payload, or b'' if the connection closed
+        """
+        request_id, payload = Protocol.recv_frame(my_socket)
+        return payload
+
+    @staticmethod
+    def recv_frame(my_socket):
+        """
+        Receive one binary frame and its request ID
+        Returns: (request_id or None, payload); payload is b'' if the connection closed
+        """
+        header = bytearray(HEADER.size)
+        if not recv_exact_into(my_socket, memoryview(header)):
+            return None, b''
+
+        flags, length = check_binary_header(header)
+
+        request_id = None
+        if flags & FLAG_REQUEST_ID:
+            request_id_bytes = bytearray(REQUEST_ID.size)
+            if not recv_exact_into(my_socket, memoryview(request_id_bytes)):
+                return None, b''
+            request_id = REQUEST_ID.unpack(request_id_bytes)[0]
+
+        payload = bytearray(length)
+        if not recv_exact_into(my_socket, memoryview(payload)):
+            return None, b''
+        metrics.traffic.received(HEADER.size + (REQUEST_ID.size if request_id is not None else 0) + length)
+        if flags & FLAG_COMPRESSED:
+            payload = decompress_payload(payload)
+        return request_id, payload
+
+
+class AsyncProtocol(object):
+    """Same framings as Protocol, over asyncio streams"""
+
+    @staticmethod
+    async def send(writer, connection, data, request_id=None):
+        """Send string (or bytes) data using the connection's framing"""
+        encoded_msg = data.encode() if isinstance(data, str) else data
+
+        if connection.framing == FRAMING_BINARY:
+            if getattr(connection, 'compression', False) and len(encoded_msg) >= COMPRESS_THRESHOLD:
+                # Keep the event loop free while compressing
+                loop = asyncio.get_running_loop()
+                flags, encoded_msg = await loop.run_in_executor(None, compress_payload, connection, encoded_msg)
+            else:
+                flags, encoded_msg = compress_payload(connection, encoded_msg)
+            header = binary_header(len(encoded_msg), flags, request_id)
+        else:
+            header = legacy_header(len(encoded_msg))
+        writer.write(header)
+        writer.write(encoded_msg)
+        await writer.drain()
+        metrics.traffic.sent(len(header) + len(encoded_msg))
+
+        apply_pending_settings(connection)
+
+    @staticmethod
+    async def recv(reader, connection):
+        """
+        Receive one frame using the connection's framing
+        Returns: payload bytes, or b'' if the connection closed
+        """
+        request_id, payload = await AsyncProtocol.recv_frame(reader, connection)
+        return payload
+
+    @staticmethod
+    async def recv_frame(reader, connection):
+        """
+        Receive one frame and its request ID (None for legacy or unflagged frames)
+        Returns: (request_id, payload); payload is b'' if the connection closed
+        """
+        try:
+            request_id = None
+            flags = 0
+            if connection.framing == FRAMING_BINARY:
+                flags, length = check_binary_header(await reader.readexactly(HEADER.size))
+                header_size = HEADER.size
+                if flags & FLAG_REQUEST_ID:
+                    request_id = REQUEST_ID.unpack(await reader.readexactly(REQUEST_ID.size))[0]
+                    header_size += REQUEST_ID.size
+            else:
+                length = int((await reader.readexactly(MAX)).decode())
+                header_size = MAX
+            payload = await reader.readexactly(length)
+            metrics.traffic.received(header_size + length)
+            if flags & FLAG_COMPRESSED:
+                payload = decompress_payload(payload)
+            return request_id, payload
+        except asyncio.IncompleteReadError:
+            return None, b''
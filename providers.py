@@ -0,0 +1,110 @@
+"""
+Where product searches get their products
+SEARCH_PRODUCT, SEARCH_MANY and IMAGE_SEARCH ask the ProductProvider chosen
+by PRODUCT_PROVIDER: Google Shopping through SerpAPI (with its cache, rate
+limit and circuit breaker), or a local catalog file (catalog.py), which
+needs no network or API key: a CSV/JSONL file is indexed in memory at
+startup, a prebuilt .catalog file is memory-mapped and opens at once.
+
+Every provider returns products shaped like google_search's:
+{"id", "name", "price", "source", "link", "product_link", "thumbnail", "rating", "reviews"}
+"""
+import threading
+import google_search
+from catalog import open_catalog
+from logs import get_logger
+from constants import PRODUCT_PROVIDER, CATALOG_PATH, CATALOG_MAX_RESULTS
+from constants import CATALOG_BM25_K1, CATALOG_BM25_B, CATALOG_CANDIDATE_LIMIT
+
+log = get_logger("providers")
+
+
+class ProductProvider(object):
+    """A source of products for a text query"""
+
+    name = None
+
+    def search(self, query):
+        """
+        Returns: (products, error_message)
+        Raises: ratelimit.RateLimited or resilience.CircuitOpen when the
+        search should be retried later
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {"name": self.name}
+
+
+class SerpApiProvider(ProductProvider):
+    """Google Shopping through SerpAPI, behind the search cache"""
+
+    name = "serpapi"
+
+    def search(self, query):
+        return google_search.cached_google_search_for_product(query)
+
+
+class LocalCatalogProvider(ProductProvider):
+    """Products from a catalog file (see catalog.open_catalog), ranked with BM25"""
+
+    name = "local"
+
+    def __init__(self, path=CATALOG_PATH, max_results=CATALOG_MAX_RESULTS, k1=CATALOG_BM25_K1,
+                 b=CATALOG_BM25_B, candidate_limit=CATALOG_CANDIDATE_LIMIT):
+        self.path = path
+        self.max_results = max_results
+        self.catalog = None
+        self.error = None
+        try:
+            self.catalog = open_catalog(path, k1=k1, b=b, candidate_limit=candidate_limit)
+            log.info("Loaded %s products from %s in %.3f s", len(self.catalog), path, self.catalog.load_seconds)
+        except (OSError, ValueError) as msg:
+            self.error = f"Product catalog not available: {msg}"
+            log.error("%s", self.error)
+
+    def search(self, query):
+        if self.catalog is None:
+            return [], self.error
+        if not query:
+            return [], ""
+        return self.catalog.search(query, self.max_results), ""
+
+    def stats(self):
+        result = {"name": self.name, "path": self.path}
+        if self.catalog is None:
+            result["error"] = self.error
+        else:
+            result.update(self.catalog.stats())
+        return result
+
+
+PROVIDERS = {
+    SerpApiProvider.name: SerpApiProvider,
+    LocalCatalogProvider.name: LocalCatalogProvider
+}
+
+_lock = threading.Lock()
+_provider = None
+
+
+def get_provider():
+    """
+    Returns: the process-wide ProductProvider, created on first use
+    Raises: ValueError if PRODUCT_PROVIDER names no provider
+    """
+    global _provider
+    if _provider is None:
+        with _lock:
+            if _provider is None:
+                if PRODUCT_PROVIDER not in PROVIDERS:
+                    raise ValueError(f"Unknown PRODUCT_PROVIDER {PRODUCT_PROVIDER!r}, expected one of {list(PROVIDERS)}")
+                _provider = PROVIDERS[PRODUCT_PROVIDER]()
+    return _provider
+
+
+def set_provider(provider):
+    """Replace the provider (any object with search/stats), e.g. a LocalCatalogProvider for another file"""
+    global _provider
+    with _lock:
+        _provider = provider
@@ -0,0 +1,202 @@
+"""
+Token-bucket rate limiting
+TokenBucket guards one shared resource (an upstream API); RateLimiter keeps
+a bucket per key (a username) in lock-sharded dictionaries so concurrent
+requests from different users rarely contend
+
+A bucket holds up to `burst` tokens and refills at `rate` tokens per second.
+Every check takes tokens or reports how long until enough are back.
+RateLimiter.wait may also borrow tokens from the coming refill and sleep
+until they are due, for callers that would rather queue than fail.
+A rate of None (or 0) disables the limit.
+"""
+import time
+import threading
+
+
+class RateLimited(Exception):
+    """Raised when a limit is reached; retry_after is in seconds"""
+
+    code = "RATE_LIMITED"
+
+    def __init__(self, scope, retry_after):
+        self.scope = scope
+        self.retry_after = retry_after
+        super().__init__(f"{scope} rate limit reached, retry after {self.retry_after_ms} ms")
+
+    @property
+    def retry_after_ms(self):
+        return max(1, int(self.retry_after * 1000 + 0.999))
+
+
+def take(state, rate, burst, now, tokens):
+    """
+    Refill a bucket state [tokens, last_refill] up to now and take tokens from it
+    Caller holds the lock guarding state
+    Returns: 0.0 if the tokens were taken, otherwise seconds until they would be available
+    """
+    available = min(burst, state[0] + (now - state[1]) * rate)
+    state[1] = now
+    if available >= tokens:
+        state[0] = available - tokens
+        return 0.0
+    state[0] = available
+    return (tokens - available) / rate
+
+
+def reserve(state, rate, burst, now, tokens, max_wait):
+    """
+    Like take, but tokens not there yet are borrowed from the next max_wait
+    seconds of refill; the bucket stays below zero until they are repaid
+    Caller holds the lock guarding state
+    Returns: seconds until the tokens are there (0.0 if they are now) - they
+    were only taken if that is at most max_wait
+    """
+    available = min(burst, state[0] + (now - state[1]) * rate)
+    state[1] = now
+    wait = max(0.0, (tokens - available) / rate)
+    if wait <= max_wait:
+        available -= tokens
+    state[0] = available
+    return wait
+
+
+class TokenBucket(object):
+    """One shared bucket, e.g. for all calls to an upstream API"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = [burst, clock()]
+        self.allowed = 0
+        self.limited = 0
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if available
+        Returns: 0.0 on success, otherwise seconds to wait before retrying
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            retry_after = take(self.state, self.rate, self.burst, self.clock(), tokens)
+            if retry_after:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        return retry_after
+
+    def acquire(self, scope, tokens=1):
+        """Take tokens or raise RateLimited(scope, retry_after)"""
+        retry_after = self.try_acquire(tokens)
+        if retry_after:
+            raise RateLimited(scope, retry_after)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "allowed": self.allowed,
+                "limited": self.limited
+            }
+
+
+class RateLimiter(object):
+    """
+    A token bucket per key, created on first use
+    Buckets that have refilled completely carry no state worth keeping, so
+    once a shard holds more than its share of max_keys those are dropped
+    """
+
+    def __init__(self, rate, burst, shards=16, max_keys=100000, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.max_keys_per_shard = max(1, max_keys // shards)
+        # Counted per shard under the shard's lock, so no lock is shared by all keys
+        self.allowed = [0] * shards
+        self.limited = [0] * shards
+
+    def try_acquire(self, key, tokens=1):
+        """
+        Take tokens from key's bucket if available
+        Returns: 0.0 on success, otherwise seconds to wait before retrying
+        """
+        if not self.rate:
+            return 0.0
+
+        index = hash(key) % len(self.shards)
+        now = self.clock()
+        with self.locks[index]:
+            state = self._bucket(index, key, now)
+            retry_after = take(state, self.rate, self.burst, now, tokens)
+            if retry_after:
+                self.limited[index] += 1
+            else:
+                self.allowed[index] += 1
+        return retry_after
+
+    def acquire(self, key, scope, tokens=1):
+        """Take tokens from key's bucket or raise RateLimited(scope, retry_after)"""
+        retry_after = self.try_acquire(key, tokens)
+        if retry_after:
+            raise RateLimited(scope, retry_after)
+
+    def wait(self, key, scope, max_wait, tokens=1):
+        """
+        Take tokens from key's bucket, sleeping until they are there if that
+        takes at most max_wait seconds, otherwise raise RateLimited(scope, retry_after)
+        Waiters are served in the order they called, each sleeping only as
+        long as its own tokens take to refill
+        """
+        if not self.rate:
+            return
+
+        max_wait = max(0.0, max_wait)
+        index = hash(key) % len(self.shards)
+        now = self.clock()
+        with self.locks[index]:
+            state = self._bucket(index, key, now)
+            wait = reserve(state, self.rate, self.burst, now, tokens, max_wait)
+            if wait > max_wait:
+                self.limited[index] += 1
+            else:
+                self.allowed[index] += 1
+
+        if wait > max_wait:
+            raise RateLimited(scope, wait)
+        if wait:
+            self.sleep(wait)
+
+    def _bucket(self, index, key, now):
+        """Returns: key's bucket state, created full if needed (caller holds the shard lock)"""
+        shard = self.shards[index]
+        state = shard.get(key)
+        if state is None:
+            if len(shard) >= self.max_keys_per_shard:
+                self._prune(shard, now)
+            state = shard[key] = [self.burst, now]
+        return state
+
+    def _prune(self, shard, now):
+        """Drop buckets that would be full by now (caller holds the shard lock)"""
+        for key in [k for k, (tokens, last) in shard.items() if tokens + (now - last) * self.rate >= self.burst]:
+            del shard[key]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "keys": len(self),
+            "allowed": sum(self.allowed),
+            "limited": sum(self.limited)
+        }
@@ -0,0 +1,225 @@
+"""
+Resilience for calls to the upstream APIs (SerpAPI, Azure OpenAI)
+Each upstream gets a circuit breaker and, for idempotent calls, retries with
+jittered exponential backoff.
+
+The breaker counts consecutive failed calls. After `failure_threshold` of
+them it opens: calls fail at once with CircuitOpen instead of each waiting
+for a timeout. After `reset_timeout` seconds it lets one trial call through
+(half-open); success closes it again, failure re-opens it.
+"""
+import time
+import random
+import threading
+from collections import deque
+from metrics import Histogram
+from logs import get_logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+log = get_logger("resilience")
+
+
+class TransientError(Exception):
+    """An upstream answered, but with an error worth retrying (HTTP 429/5xx)"""
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose breaker is open; retry_after is in seconds"""
+
+    code = "UPSTREAM_UNAVAILABLE"
+
+    def __init__(self, scope, retry_after):
+        self.scope = scope
+        self.retry_after = retry_after
+        super().__init__(f"{scope} is unavailable, retry after {self.retry_after_ms} ms")
+
+    @property
+    def retry_after_ms(self):
+        return max(1, int(self.retry_after * 1000 + 0.999))
+
+
+class CircuitBreaker(object):
+    """Thread-safe closed/open/half-open breaker for one upstream"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic, history=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.consecutive_failures = 0
+
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        # Most recent state changes, oldest first
+        self.transitions = deque(maxlen=history)
+
+    def check(self):
+        """
+        Fail fast if the breaker is open, without claiming the trial call
+        Raises: CircuitOpen
+        """
+        with self.lock:
+            if self.state == OPEN:
+                retry_after = self.opened_at + self.reset_timeout - self.clock()
+                if retry_after > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, retry_after)
+
+    def allow(self):
+        """
+        Claim permission for one call; must be followed by record_success or record_failure
+        Raises: CircuitOpen if the breaker is open, or half-open with its trial call running
+        """
+        with self.lock:
+            if self.state == OPEN:
+                retry_after = self.opened_at + self.reset_timeout - self.clock()
+                if retry_after > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, retry_after)
+                self._change(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self.trial_running:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self.reset_timeout)
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.trial_running = False
+            if self.state != CLOSED:
+                self._change(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.trial_running = False
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.opened_at = self.clock()
+                self.opened += 1
+                self._change(OPEN)
+
+    def _change(self, state):
+        """Switch state and remember the change; caller holds the lock"""
+        log.warning("Circuit breaker %s: %s -> %s", self.name, self.state, state,
+                    extra={"upstream": self.name, "from_state": self.state, "to_state": state})
+        self.transitions.append({"from": self.state, "to": state, "at": round(time.time(), 3)})
+        self.state = state
+
+    def stats(self):
+        with self.lock:
+            result = {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "successes": self.successes,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "opened": self.opened,
+                "transitions": list(self.transitions)
+            }
+            if self.state == OPEN:
+                result["retry_after_ms"] = max(0, int((self.opened_at + self.reset_timeout - self.clock()) * 1000))
+            return result
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter: the delay before retry n is random
+    between 0 and min(max_delay, base_delay * 2 ** (n - 1)), and no retry is
+    started once `deadline` seconds have passed since the first attempt
+    """
+
+    def __init__(self, retries=0, base_delay=0.2, max_delay=2.0, deadline=None, rng=random.random):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.rng = rng
+
+    def delay(self, retry):
+        """Returns: seconds to wait before retry number `retry` (1-based)"""
+        return self.rng() * min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+
+
+class Upstream(object):
+    """
+    Breaker plus retry policy for one upstream API
+    failures: exception types that mean the upstream failed (timeouts,
+    connection errors, TransientError); other exceptions are passed through
+    without counting against the breaker or being retried
+    """
+
+    def __init__(self, name, failures, breaker, retry=None, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.failures = failures
+        self.breaker = breaker
+        self.retry = retry or RetryPolicy()
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        # Duration of each attempt, whatever its outcome
+        self.latency = Histogram()
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs), retrying failures while the policy and breaker allow
+        Returns: fn's result
+        Raises: CircuitOpen if the breaker refused the call (or a retry), otherwise
+        the last failure once retries are used up
+        """
+        with self.lock:
+            self.calls += 1
+        started = self.clock()
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            attempt_started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except self.failures:
+                self.breaker.record_failure()
+                attempt += 1
+                if attempt > self.retry.retries:
+                    raise
+                delay = self.retry.delay(attempt)
+                if self.retry.deadline is not None and self.clock() - started + delay > self.retry.deadline:
+                    raise
+            except Exception:
+                # The upstream answered; whatever went wrong is not its availability
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                self.latency.observe(time.perf_counter() - attempt_started)
+
+            with self.lock:
+                self.retries += 1
+            self.sleep(delay)
+
+    def stats(self):
+        with self.lock:
+            result = {"calls": self.calls, "retries": self.retries}
+        result["latency"] = self.latency.stats()
+        result["breaker"] = self.breaker.stats()
+        return result
@@ -0,0 +1,111 @@
+"""
+Reply serialization
+JSON is the default. A connection can negotiate a more compact encoding with
+PROTOCOL (BINARY framing only), e.g. "PROTOCOL BINARY MUX COLUMNAR":
+- COLUMNAR: still JSON, but every list of records with the same fields (the
+  products) is sent as {"__columns__": [...], "__rows__": [[...], ...}, so
+  each field name goes over the wire once per list instead of once per record
+- MSGPACK: the COLUMNAR layout packed with MessagePack (needs the msgpack package)
+
+Replies are always objects, so the first byte tells the two formats apart:
+JSON replies start with "{" and MessagePack maps never do. Replies the
+server builds outside the handlers (errors) may therefore stay plain JSON.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    # Optional: MSGPACK is simply not offered without it
+    msgpack = None
+
+ENCODING_JSON = "JSON"
+ENCODING_COLUMNAR = "COLUMNAR"
+ENCODING_MSGPACK = "MSGPACK"
+
+SUPPORTED_ENCODINGS = [ENCODING_JSON, ENCODING_COLUMNAR]
+if msgpack is not None:
+    SUPPORTED_ENCODINGS.append(ENCODING_MSGPACK)
+
+COLUMNS = "__columns__"
+ROWS = "__rows__"
+
+CONTAINERS = (dict, list)
+
+
+def to_columns(obj):
+    """Returns: obj with every list of same-shaped dicts turned into columns and rows"""
+    if isinstance(obj, dict):
+        return {key: to_columns(value) if isinstance(value, CONTAINERS) else value for key, value in obj.items()}
+
+    if isinstance(obj, list):
+        if obj and all(isinstance(item, dict) for item in obj):
+            columns = list(obj[0])
+            if all(len(item) == len(columns) and all(key in item for key in columns) for item in obj):
+                return {
+                    COLUMNS: columns,
+                    ROWS: [
+                        [to_columns(v) if isinstance(v, CONTAINERS) else v for v in map(item.__getitem__, columns)]
+                        for item in obj
+                    ]
+                }
+        return [to_columns(item) if isinstance(item, CONTAINERS) else item for item in obj]
+
+    return obj
+
+
+def from_columns(obj):
+    """Returns: obj with every columns/rows table turned back into a list of dicts"""
+    if isinstance(obj, dict):
+        if len(obj) == 2 and COLUMNS in obj and ROWS in obj:
+            columns = obj[COLUMNS]
+            return [
+                dict(zip(columns, [from_columns(v) if isinstance(v, CONTAINERS) else v for v in row]))
+                for row in obj[ROWS]
+            ]
+        return {key: from_columns(value) if isinstance(value, CONTAINERS) else value for key, value in obj.items()}
+
+    if isinstance(obj, list):
+        return [from_columns(item) if isinstance(item, CONTAINERS) else item for item in obj]
+
+    return obj
+
+
+def encode(obj, encoding=ENCODING_JSON):
+    """Returns: obj serialized as bytes in the given encoding"""
+    if encoding == ENCODING_COLUMNAR:
+        return json.dumps(to_columns(obj), separators=(',', ':')).encode()
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(to_columns(obj), use_bin_type=True)
+    return json.dumps(obj).encode()
+
+
+def decode(payload, encoding=ENCODING_JSON):
+    """
+    Parse a reply sent with the given encoding (or plain JSON, see above)
+    Raises: ValueError if the payload is not a valid reply
+    """
+    if payload[:1] == b'{':
+        obj = json.loads(payload)
+    elif msgpack is not None:
+        try:
+            obj = msgpack.unpackb(payload, raw=False)
+        except Exception as msg:
+            raise ValueError(f"Invalid MessagePack reply: {msg}")
+    else:
+        raise ValueError("Reply is not JSON and msgpack is not installed")
+
+    if encoding != ENCODING_JSON:
+        obj = from_columns(obj)
+    return obj
+
+
+def encode_reply(my_socket, response):
+    """
+    Re-encode a handler's JSON reply for the connection's negotiated encoding
+    JSON connections get the text unchanged
+    """
+    encoding = getattr(my_socket, 'encoding', ENCODING_JSON)
+    if encoding == ENCODING_JSON:
+        return response
+    return encode(json.loads(response), encoding)
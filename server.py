@@ -3,18 +3,26 @@ Shopping App Socket Server
 Handles client connections and routes commands to appropriate methods
 """
 import sys
+import time
 import socket
+import argparse
 import threading
 import json
 import methods
+import metrics
 import protocol
-from constants import IP, PORT
+import providers
+import serialization
+from logs import get_logger, setup_logging, format_address
+from constants import IP, PORT, MUX_MAX_IN_FLIGHT, MUX_DRAIN_TIMEOUT, METRICS_PORT, LOG_LEVEL, SESSION_DB, IMAGE_CACHE_DB
 
 
 NUM_OF_LISTEN = 5
 REQUEST_PLACE = 0
 EXIT = 1
 
+log = get_logger("server")
+
 
 class ShoppingServer(object):
     def __init__(self, ip, port):
@@ -24,18 +32,21 @@ class ShoppingServer(object):
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((ip, port))
             self.server_socket.listen(NUM_OF_LISTEN)
-            print(f"Shopping Server started on {ip}:{port}")
+            log.info("Shopping Server started on %s:%s", ip, port)
         except socket.error as msg:
-            print(f'Connection failure: {msg}\nTerminating program')
+            log.critical("Connection failure: %s - terminating program", msg)
             sys.exit(EXIT)
 
     def handle_clients(self):
         """Accept and handle multiple client connections"""
         try:
-            print("Waiting for clients...")
+            log.info("Waiting for clients...")
             while True:
                 client_socket, address = self.server_socket.accept()
-                print(f"Client connected from {address}")
+                # Streamed replies are several small frames; don't hold them back for ACKs
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                client_socket = protocol.Connection(client_socket)
+                log.info("Client connected", extra={"address": format_address(address)})
                 
                 # Handle each client in a separate thread
                 client_thread = threading.Thread(
@@ -46,15 +57,16 @@ class ShoppingServer(object):
                 client_thread.start()
                 
         except KeyboardInterrupt:
-            print("\nServer shutting down...")
+            log.info("Server shutting down...")
             self.server_socket.close()
         except socket.error as msg:
-            print(f"Socket error: {msg}")
-        except Exception as msg:
-            print(f"General error: {msg}")
+            log.error("Socket error: %s", msg)
+        except Exception:
+            log.exception("General error")
 
     def handle_single_client(self, client_socket, address):
         """Handle a single client connection"""
+        metrics.connections.open()
         try:
             request = None
             while request != 'EXIT':
@@ -64,25 +76,88 @@ class ShoppingServer(object):
                 if not request:
                     break
                 
-                print(f"[{address}] Command: {request} {params if params else ''}")
+                # Read any upload here so the handler never touches the socket
+                # and a rejected request leaves the stream in sync
+                channel = client_socket
+                if request in methods.UPLOAD_COMMANDS:
+                    channel = protocol.RequestChannel(client_socket, None)
+                    channel.upload = methods.receive_image(client_socket)
                 
                 # Handle request and get response
-                response = self.handle_client_request(request, params, client_socket, address)
+                response = self.handle_client_request(request, params, channel, address)
                 
                 # Send response
-                self.send_response_to_client(response, client_socket)
+                self.send_response_to_client(response, channel)
                 
                 if request == 'EXIT':
                     break
+
+                if getattr(client_socket, 'multiplexed', False):
+                    # Requests now carry IDs and may be processed concurrently
+                    self.handle_multiplexed_client(client_socket, address)
+                    break
                     
         except socket.error as msg:
-            print(f"Socket error with {address}: {msg}")
-        except Exception as msg:
-            print(f"Error handling client {address}: {msg}")
+            log.warning("Socket error: %s", msg, extra={"address": format_address(address)})
+        except Exception:
+            log.exception("Error handling client", extra={"address": format_address(address)})
         finally:
-            print(f"Client {address} disconnected")
+            metrics.connections.close()
+            log.info("Client disconnected", extra={"address": format_address(address)})
             client_socket.close()
 
+    def handle_multiplexed_client(self, client_socket, address):
+        """
+        Read requests from a multiplexed connection and run them concurrently
+        Uploads are read here, in order, before the next request frame
+        """
+        in_flight = threading.Semaphore(MUX_MAX_IN_FLIGHT)
+        try:
+            request = None
+            while request != 'EXIT':
+                request_id, payload = protocol.Protocol.recv_frame(client_socket)
+
+                if not payload:
+                    break
+
+                request, params = methods.parse_request(payload)
+
+                if not request:
+                    break
+
+                channel = protocol.RequestChannel(client_socket, request_id)
+                if request in methods.UPLOAD_COMMANDS:
+                    channel.upload = methods.receive_image(channel)
+
+                in_flight.acquire()
+                try:
+                    future = methods.DISPATCHER.submit(request, params, channel, address)
+                    future.add_done_callback(self.multiplexed_reply_sender(channel, in_flight))
+                except Exception:
+                    # No reply callback will free this slot
+                    in_flight.release()
+                    raise
+        finally:
+            # Let outstanding requests answer before the connection is closed,
+            # but don't let a stuck handler hold the connection open forever
+            deadline = time.monotonic() + MUX_DRAIN_TIMEOUT
+            for outstanding in range(MUX_MAX_IN_FLIGHT, 0, -1):
+                if not in_flight.acquire(timeout=max(0, deadline - time.monotonic())):
+                    log.warning("Closing with %d requests still running", outstanding,
+                                extra={"address": format_address(address)})
+                    break
+
+    def multiplexed_reply_sender(self, channel, in_flight):
+        """Returns: callback that sends a finished request's reply and frees its slot"""
+        def send_reply(future):
+            try:
+                self.send_response_to_client(future.result(), channel)
+            except Exception as msg:
+                log.warning("Error sending response: %s", msg)
+            finally:
+                in_flight.release()
+        return send_reply
+
     @staticmethod
     def receive_client_request(client_socket, address):
         """
@@ -95,44 +170,27 @@ class ShoppingServer(object):
             if not request:
                 return None, None
             
-            request_str = request.decode().strip()
-            
-            if not request_str:
-                return None, None
-            
             # Split into command and parameters
-            parts = request_str.split()
-            
-            if len(parts) > 1:
-                return parts[0].upper(), parts[1:]
-            else:
-                return parts[0].upper(), None
-                
+            return methods.parse_request(request)
+
         except socket.error as msg:
-            print(f"Socket error receiving from {address}: {msg}")
+            log.warning("Socket error receiving: %s", msg, extra={"address": format_address(address)})
             return None, None
         except Exception as msg:
-            print(f"Error receiving from {address}: {msg}")
+            log.warning("Error receiving: %s", msg, extra={"address": format_address(address)})
             return None, None
 
     @staticmethod
     def handle_client_request(request, params, client_socket, address):
         """
-        Route request to appropriate method
+        Route request to appropriate method through the dispatcher, which
+        may refuse it right away when the server is busy
         Returns: response string (JSON)
         """
         try:
-            # Get the method from Methods class
-            if hasattr(methods.Methods, request):
-                method = getattr(methods.Methods, request)
-                return method(client_socket, params, address)
-            else:
-                return json.dumps({
-                    "status": "error",
-                    "message": f"Unknown command: {request}"
-                })
+            return methods.DISPATCHER.submit(request, params, client_socket, address).result()
         except Exception as msg:
-            print(f"Error handling request {request}: {msg}")
+            log.exception("Error handling request %s", request, extra={"command": request})
             return json.dumps({
                 "status": "error",
                 "message": f"Server error: {str(msg)}"
@@ -142,25 +200,57 @@ class ShoppingServer(object):
     def send_response_to_client(response, client_socket):
         """Send response to client"""
         try:
-            protocol.Protocol.send(client_socket, response)
+            protocol.Protocol.send(client_socket, serialization.encode_reply(client_socket, response))
+        except ValueError as msg:
+            # Response too large for the connection's framing
+            log.warning("Error sending response: %s", msg)
+            protocol.Protocol.send(client_socket, protocol.oversized_reply(client_socket))
         except socket.error as msg:
-            print(f"Socket error sending response: {msg}")
+            log.warning("Socket error sending response: %s", msg)
         except Exception as msg:
-            print(f"Error sending response: {msg}")
+            log.warning("Error sending response: %s", msg)
 
 
 def main():
-    server = ShoppingServer(IP, PORT)
+    parser = argparse.ArgumentParser(description="Shopping App Server")
+    parser.add_argument("--engine", choices=["threaded", "async"], default="threaded",
+                        help="threaded: one thread per client, async: asyncio event loop")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"],
+                        default=LOG_LEVEL or "OFF", help="minimum level of the JSON log lines on stdout")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics at /metrics on this port (off by default)")
+    parser.add_argument("--session-db", default=SESSION_DB,
+                        help='sqlite file that keeps sessions across restarts ("" for memory only)')
+    parser.add_argument("--image-cache-db", default=IMAGE_CACHE_DB,
+                        help='sqlite file that keeps image analysis results ("" for memory only)')
+    args = parser.parse_args()
+    setup_logging(None if args.log_level == "OFF" else args.log_level)
+    methods.open_stores(args.session_db or None, args.image_cache_db or None)
+
+    if args.engine == "async":
+        from async_server import AsyncShoppingServer
+        server = AsyncShoppingServer(IP, PORT)
+    else:
+        server = ShoppingServer(IP, PORT)
     print("=" * 50)
     print("Shopping App Server")
     print("=" * 50)
     print("Available commands:")
+    print("  - PROTOCOL LEGACY|BINARY [MUX] [STREAM] [COMPRESS] [COLUMNAR|MSGPACK]")
     print("  - LOGIN username password")
     print("  - SEARCH_PRODUCT session_id query")
+    print('  - SEARCH_MANY session_id ["query", ...]')
     print("  - IMAGE_SEARCH session_id (followed by image data)")
     print("  - LOGOUT session_id")
+    print("  - GET_SESSIONS [limit] [cursor]")
+    print("  - CACHE_STATS")
+    print("  - STATS")
     print("  - EXIT")
     print("=" * 50)
+    if args.metrics_port:
+        metrics.serve_http(IP, args.metrics_port, methods.metric_families)
+    # Load the product catalog (local provider) before the first search needs it
+    providers.get_provider()
     server.handle_clients()
 
 
@@ -0,0 +1,263 @@
+"""
+Session storage for logged-in users
+Thread-safe, expiring and optionally persisted to sqlite so a restart does
+not log everyone out
+"""
+import json
+import time
+import uuid
+import zlib
+import bisect
+import sqlite3
+import threading
+
+
+class SessionStore(object):
+    """
+    Maps session IDs to {"username", "login_time", "last_seen", "address"}
+
+    Sessions expire `ttl` seconds after they were last used (sliding window).
+    Expired sessions are dropped when they are looked up and by a reaper that
+    runs lazily at most every `reap_interval` seconds (or in a background
+    thread, see start_reaper).
+
+    Sessions are spread over `shards` dictionaries, each with its own lock,
+    so concurrent logins and lookups rarely contend. Each shard also keeps its
+    session IDs sorted, so page can resume from a cursor without sorting.
+    """
+
+    def __init__(self, ttl=3600, shards=16, db_path=None, reap_interval=60, clock=time.time):
+        self.ttl = ttl
+        self.reap_interval = reap_interval
+        self.clock = clock
+
+        self.shards = [{} for _ in range(shards)]
+        self.ordered = [[] for _ in range(shards)]  # each shard's session IDs, sorted
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+        self.reap_lock = threading.Lock()
+        self.last_reap = clock()
+        self.reaper = None
+
+        self.db_path = None
+        self.db_lock = threading.Lock()
+        self.db = None
+        if db_path:
+            self.open(db_path)
+
+    def open(self, db_path):
+        """
+        Persist sessions to a sqlite file from now on, restoring the unexpired
+        ones it holds (creates the file if needed)
+        """
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, username TEXT NOT NULL, login_time REAL NOT NULL, "
+            "last_seen REAL NOT NULL, address TEXT)"
+        )
+        db.commit()
+        with self.db_lock:
+            self.db_path = db_path
+            self.db = db
+        self._load()
+
+    def create(self, username, address=None):
+        """
+        Start a new session
+        Returns: the new session ID
+        """
+        self._maybe_reap()
+
+        session_id = str(uuid.uuid4())
+        now = self.clock()
+        session = {
+            "username": username,
+            "login_time": now,
+            "last_seen": now,
+            "address": address
+        }
+        index = self._shard(session_id)
+        with self.locks[index]:
+            self.shards[index][session_id] = session
+            bisect.insort(self.ordered[index], session_id)
+
+        self._db_write(
+            "INSERT OR REPLACE INTO sessions (session_id, username, login_time, last_seen, address) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (session_id, username, now, now, json.dumps(address))
+        )
+        return session_id
+
+    def get(self, session_id):
+        """
+        Look up a live session and extend its expiry
+        Returns: copy of the session dict, or None if unknown or expired
+        """
+        index = self._shard(session_id)
+        now = self.clock()
+        with self.locks[index]:
+            session = self.shards[index].get(session_id)
+            if session is None:
+                return None
+            if session["last_seen"] + self.ttl <= now:
+                del self.shards[index][session_id]
+                self._unorder(index, session_id)
+                expired = True
+            else:
+                previous = session["last_seen"]
+                session["last_seen"] = now
+                expired = False
+                result = dict(session)
+
+        if expired:
+            self._db_write("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            return None
+
+        # Persisting every touch would put sqlite on the hot path; a coarse
+        # last_seen is enough to restore sessions after a restart
+        if now - previous > self.ttl / 10:
+            self._db_write("UPDATE sessions SET last_seen = ? WHERE session_id = ?", (now, session_id))
+        return result
+
+    def delete(self, session_id):
+        """
+        End a session
+        Returns: the removed session dict, or None if it did not exist
+        """
+        index = self._shard(session_id)
+        with self.locks[index]:
+            session = self.shards[index].pop(session_id, None)
+            if session is not None:
+                self._unorder(index, session_id)
+
+        if session is not None:
+            self._db_write("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return session
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def __len__(self):
+        self._maybe_reap()
+        return sum(len(shard) for shard in self.shards)
+
+    def page(self, cursor=None, limit=100):
+        """
+        List session IDs in a stable order, `limit` at a time
+        Sessions are listed shard by shard, each shard in ID order; the cursor
+        is a session ID, which names its own shard, so a page costs
+        O(shards + limit) however many sessions there are
+        cursor: last session ID of the previous page (None for the first page)
+        Returns: (session_ids, next_cursor) - next_cursor is None on the last page
+        """
+        self._maybe_reap()
+
+        first = self._shard(cursor) if cursor else 0
+        page = []
+        # One extra ID tells whether there is another page
+        for index in range(first, len(self.shards)):
+            with self.locks[index]:
+                ordered = self.ordered[index]
+                start = bisect.bisect_right(ordered, cursor) if cursor and index == first else 0
+                page.extend(ordered[start:start + limit + 1 - len(page)])
+            if len(page) > limit:
+                return page[:limit], page[limit - 1]
+        return page, None
+
+    def reap(self):
+        """
+        Drop every expired session
+        Returns: number of sessions removed
+        """
+        now = self.clock()
+        expired = []
+        for index, shard in enumerate(self.shards):
+            with self.locks[index]:
+                removed = [session_id for session_id, session in shard.items()
+                           if session["last_seen"] + self.ttl <= now]
+                if removed:
+                    for session_id in removed:
+                        del shard[session_id]
+                    self.ordered[index] = [session_id for session_id in self.ordered[index] if session_id in shard]
+                    expired.extend(removed)
+
+        if expired:
+            self._db_write_many("DELETE FROM sessions WHERE session_id = ?", [(s,) for s in expired])
+        return len(expired)
+
+    def start_reaper(self, interval=None):
+        """Reap expired sessions from a background daemon thread"""
+        interval = interval or self.reap_interval
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.reap()
+
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=run, daemon=True)
+            self.reaper.start()
+
+    def _maybe_reap(self):
+        """Run the reaper if it has not run for reap_interval seconds"""
+        now = self.clock()
+        if now - self.last_reap < self.reap_interval:
+            return
+        if not self.reap_lock.acquire(blocking=False):
+            return  # another thread is already reaping
+        try:
+            self.last_reap = now
+            self.reap()
+        finally:
+            self.reap_lock.release()
+
+    def _shard(self, session_id):
+        # Not hash(): str hashes change between runs, and page cursors
+        # have to name the same shard after a restart
+        return zlib.crc32(session_id.encode()) % len(self.shards)
+
+    def _unorder(self, index, session_id):
+        """Drop a session ID from its shard's sorted list; caller holds the shard lock"""
+        ordered = self.ordered[index]
+        position = bisect.bisect_left(ordered, session_id)
+        if position < len(ordered) and ordered[position] == session_id:
+            del ordered[position]
+
+    def _load(self):
+        """Restore unexpired sessions from sqlite"""
+        cutoff = self.clock() - self.ttl
+        with self.db_lock:
+            self.db.execute("DELETE FROM sessions WHERE last_seen <= ?", (cutoff,))
+            self.db.commit()
+            rows = self.db.execute(
+                "SELECT session_id, username, login_time, last_seen, address FROM sessions"
+            ).fetchall()
+
+        for session_id, username, login_time, last_seen, address in rows:
+            index = self._shard(session_id)
+            # JSON has no tuples; addresses are (host, port) like socket.accept gives
+            address = json.loads(address) if address else None
+            with self.locks[index]:
+                if session_id not in self.shards[index]:
+                    bisect.insort(self.ordered[index], session_id)
+                self.shards[index][session_id] = {
+                    "username": username,
+                    "login_time": login_time,
+                    "last_seen": last_seen,
+                    "address": tuple(address) if isinstance(address, list) else address
+                }
+
+    def _db_write(self, statement, args):
+        if self.db is None:
+            return
+        with self.db_lock:
+            self.db.execute(statement, args)
+            self.db.commit()
+
+    def _db_write_many(self, statement, rows):
+        if self.db is None:
+            return
+        with self.db_lock:
+            self.db.executemany(statement, rows)
+            self.db.commit()
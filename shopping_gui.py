@@ -5,13 +5,25 @@ Provides graphical interface for login, product search, and results display
 import wx
 import wx.lib.scrolledpanel as scrolled
 from client import ShoppingClient
-from constants import IP, PORT, SUPPORTED_IMAGE_FORMATS
+from constants import IP, PORT, SUPPORTED_IMAGE_FORMATS, UPLOAD_MAX_EDGE
 import threading
 import webbrowser
 import os
 from PIL import Image
 
 
+class ImageSearch(object):
+    """
+    State of one image search while its results stream in
+    Each search gets its own, so a slow earlier search can't mark a later
+    one's results as already streamed (or draw into them)
+    """
+
+    def __init__(self):
+        self.streamed = False           # search terms arrived and products are being appended
+        self.products_loading = None    # "Searching for products..." label while it is shown
+
+
 class ShoppingGUI(wx.Frame):
     def __init__(self):
         super(ShoppingGUI, self).__init__(None, title='Shopping App', size=(800, 600))
@@ -19,6 +31,7 @@ class ShoppingGUI(wx.Frame):
         self.client = None
         self.session_id = None
         self.username = None
+        self.current_search = None  # ImageSearch that owns the results area
         
         # Create main panel
         self.main_panel = wx.Panel(self)
@@ -264,8 +277,10 @@ class ShoppingGUI(wx.Frame):
             wx.MessageBox("Please select an image first", "Warning", wx.OK | wx.ICON_WARNING)
             return
         
-        # Clear previous results
+        # Clear previous results; events of an earlier search still running are ignored from now on
         self.results_sizer.Clear(True)
+        search = ImageSearch()
+        self.current_search = search
         
         # Show loading message
         loading = wx.StaticText(self.results_panel, label="Analyzing image and searching...")
@@ -274,15 +289,95 @@ class ShoppingGUI(wx.Frame):
         self.results_sizer.Add(loading, 0, wx.ALIGN_CENTER | wx.ALL, 20)
         self.results_panel.Layout()
         
+        def on_progress(sent, total):
+            if sent < total:
+                label = f"Uploading image... {sent * 100 // total}%"
+            else:
+                label = "Analyzing image and searching..."
+            wx.CallAfter(self.update_loading_label, loading, label)
+
+        # Render search terms and products as they stream in
+        def on_event(event):
+            if event["event"] == "search_terms":
+                wx.CallAfter(self.show_search_terms, search, event.get("search_terms", ""))
+            elif event["event"] == "products":
+                wx.CallAfter(self.add_product_cards, search, event.get("products", []))
+
         # Search in background thread
         def search_thread():
-            products, search_terms = self.client.image_search(self.selected_image_path)
-            wx.CallAfter(self.display_image_results, products, search_terms)
+            products, search_terms = self.client.image_search(
+                self.selected_image_path,
+                max_edge=UPLOAD_MAX_EDGE,
+                progress_callback=on_progress,
+                on_event=on_event
+            )
+            wx.CallAfter(self.display_image_results, search, products, search_terms)
         
         threading.Thread(target=search_thread, daemon=True).start()
     
-    def display_image_results(self, products, search_terms):
+    def update_loading_label(self, loading, label):
+        """Update the loading message while it is still shown"""
+        if loading:
+            loading.SetLabel(label)
+            self.results_panel.Layout()
+
+    def show_search_terms(self, search, search_terms):
+        """Show the streamed search terms while products are still being fetched"""
+        if search is not self.current_search:
+            return
+        self.results_sizer.Clear(True)
+        self.add_search_terms_header(search_terms)
+
+        search.products_loading = wx.StaticText(self.results_panel, label="Searching for products...")
+        loading_font = wx.Font(12, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL)
+        search.products_loading.SetFont(loading_font)
+        self.results_sizer.Add(search.products_loading, 0, wx.ALIGN_CENTER | wx.ALL, 20)
+
+        search.streamed = True
+        self.results_panel.Layout()
+
+    def add_product_cards(self, search, products):
+        """Append a streamed batch of products below the search terms"""
+        if search is not self.current_search or not search.streamed:
+            return
+        self.remove_products_loading(search)
+        for product in products:
+            self.create_product_card(product)
+        self.results_panel.SetupScrolling(scrollToTop=False)
+        self.results_panel.Layout()
+
+    def remove_products_loading(self, search):
+        """Drop the "Searching for products..." line once results arrive"""
+        if search.products_loading:
+            self.results_sizer.Detach(search.products_loading)
+            search.products_loading.Destroy()
+        search.products_loading = None
+
+    def add_search_terms_header(self, search_terms):
+        """Add the detected search terms and a separator to the results area"""
+        terms_label = wx.StaticText(self.results_panel, label=f"AI detected: {search_terms}")
+        terms_font = wx.Font(11, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_ITALIC, wx.FONTWEIGHT_BOLD)
+        terms_label.SetFont(terms_font)
+        terms_label.SetForegroundColour(wx.Colour(33, 150, 243))
+        self.results_sizer.Add(terms_label, 0, wx.ALL, 10)
+        
+        # Add separator
+        line = wx.StaticLine(self.results_panel)
+        self.results_sizer.Add(line, 0, wx.EXPAND | wx.ALL, 10)
+
+    def display_image_results(self, search, products, search_terms):
         """Display search results from image search"""
+        if search is not self.current_search:
+            # A newer search has taken over the results area
+            return
+        self.current_search = None
+        if products and search.streamed:
+            # Products were already rendered as they arrived
+            self.remove_products_loading(search)
+            self.results_panel.SetupScrolling(scrollToTop=False)
+            self.results_panel.Layout()
+            return
+
         # Clear loading message
         self.results_sizer.Clear(True)
         
@@ -298,15 +393,7 @@ class ShoppingGUI(wx.Frame):
             return
         
         # Show extracted search terms
-        terms_label = wx.StaticText(self.results_panel, label=f"AI detected: {search_terms}")
-        terms_font = wx.Font(11, wx.FONTFAMILY_DEFAULT, wx.FONTSTYLE_ITALIC, wx.FONTWEIGHT_BOLD)
-        terms_label.SetFont(terms_font)
-        terms_label.SetForegroundColour(wx.Colour(33, 150, 243))
-        self.results_sizer.Add(terms_label, 0, wx.ALL, 10)
-        
-        # Add separator
-        line = wx.StaticLine(self.results_panel)
-        self.results_sizer.Add(line, 0, wx.EXPAND | wx.ALL, 10)
+        self.add_search_terms_header(search_terms)
         
         if not products or len(products) == 0:
             no_results = wx.StaticText(self.results_panel, label=f"No products found for '{search_terms}'")
@@ -333,8 +420,9 @@ class ShoppingGUI(wx.Frame):
             wx.MessageBox("Please enter a product name", "Warning", wx.OK | wx.ICON_WARNING)
             return
         
-        # Clear previous results
+        # Clear previous results; a running image search no longer draws here
         self.results_sizer.Clear(True)
+        self.current_search = None
         
         # Show loading message
         loading = wx.StaticText(self.results_panel, label="Searching...")
@@ -428,6 +516,7 @@ class ShoppingGUI(wx.Frame):
         self.client = None
         self.session_id = None
         self.username = None
+        self.current_search = None  # its results area is about to go away
         
         wx.MessageBox("You have been logged out", "Logged Out", wx.OK | wx.ICON_INFORMATION)
         self.show_login_screen()
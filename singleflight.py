@@ -0,0 +1,82 @@
+"""
+Request coalescing for slow upstream calls
+Concurrent callers asking for the same key share one in-flight call
+"""
+import threading
+
+
+class _Call(object):
+    """One in-flight call and its outcome"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Thread-safe call coalescer
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it is running wait for it and receive the same result, or
+    the same exception. Nothing is remembered once the call finishes - pair
+    it with a cache for that.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.leaders = 0
+        self.collapsed = 0
+        self.errors = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) unless a call for key is already in flight
+        Returns: the function's result (shared with concurrent callers)
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.collapsed += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Returns: dict with upstream calls made, calls collapsed and calls in flight"""
+        with self.lock:
+            total = self.leaders + self.collapsed
+            return {
+                "upstream_calls": self.leaders,
+                "collapsed": self.collapsed,
+                "collapse_ratio": round(self.collapsed / total, 4) if total else 0.0,
+                "errors": self.errors,
+                "in_flight": len(self.calls)
+            }
@@ -0,0 +1,92 @@
+"""
+Tests for the TTL + LRU result cache
+A fake clock makes every expiry deterministic
+
+Run: python -m pytest test_cache.py
+"""
+from cache import ResultCache, normalize_query
+
+
+class FakeClock(object):
+    """Time that only moves when the test says so"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_normalize_query_ignores_case_and_whitespace():
+    assert normalize_query("  Red   SHOES ") == "red shoes"
+    assert normalize_query("shoes red", sort_words=True) == normalize_query("red shoes", sort_words=True)
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = ResultCache(ttl=10, clock=clock)
+    cache.put("shoes", [1, 2])
+
+    clock.advance(9.9)
+    assert cache.get("shoes") == (True, [1, 2])
+
+    clock.advance(0.1)
+    assert cache.get("shoes") == (False, None)
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2, clock=FakeClock())
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Touching "a" makes "b" the least recently used
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_cap_evicts_until_under_the_limit():
+    cache = ResultCache(max_bytes=10, size_of=len, clock=FakeClock())
+    cache.put("a", "xxxx")
+    cache.put("b", "xxxx")
+    cache.put("c", "xxxx")
+
+    assert cache.get("a") == (False, None)
+    assert cache.stats()["bytes"] == 8
+
+    # A value bigger than the whole cache is not stored and evicts nothing
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") == (False, None)
+    assert cache.stats()["entries"] == 2
+
+
+def test_replacing_a_key_keeps_the_byte_count_right():
+    cache = ResultCache(max_bytes=100, size_of=len, clock=FakeClock())
+    cache.put("a", "x" * 40)
+    cache.put("a", "x" * 10)
+
+    assert cache.stats()["bytes"] == 10
+
+
+def test_stale_entries_are_only_served_by_get_stale():
+    clock = FakeClock()
+    cache = ResultCache(ttl=10, stale_ttl=60, clock=clock)
+    cache.put("shoes", [1])
+
+    clock.advance(30)
+    assert cache.get("shoes") == (False, None)
+    assert cache.get_stale("shoes") == (True, [1])
+    assert cache.stats()["stale_hits"] == 1
+
+    clock.advance(40)
+    assert cache.get_stale("shoes") == (False, None)
+    assert cache.get("shoes") == (False, None)
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,206 @@
+"""
+Tests for the local product catalog (BM25 index) and the product providers
+
+Run: python -m pytest test_catalog.py
+"""
+import csv
+import json
+import pytest
+import providers
+from catalog import Catalog, MappedCatalog, open_catalog, tokenize
+from ratelimit import RateLimiter
+from sessions import SessionStore
+
+PRODUCT_FIELDS = ["id", "name", "price", "source", "link", "product_link", "thumbnail", "rating", "reviews"]
+
+ROWS = [
+    {"name": "Nike Air Zoom running shoes", "brand": "nike", "price": 89.99, "source": "Nike",
+     "link": "https://nike.example.com/1", "rating": 4.6, "reviews": 1200},
+    {"name": "Adidas Ultraboost running shoes", "brand": "adidas", "price": "$120.00", "source": "Adidas"},
+    {"name": "Red leather jacket", "category": "jackets", "price": 150},
+    {"name": "Blue denim jacket with a very long description of pockets, buttons, seams and more",
+     "price": 60},
+    {"name": "Wireless headphones", "description": "noise cancelling, over-ear", "price": "From $99"},
+    {"title": "Leather hiking boots", "price": ""},
+    {"price": 5}
+]
+
+
+def write_jsonl(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+@pytest.fixture
+def catalog_path(tmp_path):
+    path = str(tmp_path / "catalog.jsonl")
+    write_jsonl(path, ROWS)
+    return path
+
+
+def test_tokenize_folds_plurals_and_case():
+    assert tokenize("Running SHOES, dress & glass") == ["running", "shoe", "dress", "glass"]
+    assert tokenize("Bus") == ["bus"]
+
+
+def test_load_jsonl_skips_rows_without_a_name(catalog_path):
+    catalog = Catalog.load(catalog_path)
+
+    assert len(catalog) == 6
+    assert catalog.stats()["products"] == 6
+
+
+def test_products_have_the_serpapi_shape(catalog_path):
+    products = Catalog.load(catalog_path).search("nike shoes")
+
+    assert list(products[0]) == PRODUCT_FIELDS
+    assert products[0] == {
+        "id": 1,
+        "name": "Nike Air Zoom running shoes",
+        "price": "$89.99",
+        "source": "Nike",
+        "link": "https://nike.example.com/1",
+        "product_link": "https://nike.example.com/1",
+        "thumbnail": "",
+        "rating": 4.6,
+        "reviews": 1200
+    }
+
+
+def test_prices_are_formatted(catalog_path):
+    catalog = Catalog.load(catalog_path)
+
+    assert catalog.search("ultraboost")[0]["price"] == "$120.00"
+    assert catalog.search("headphones")[0]["price"] == "From $99"
+    assert catalog.search("hiking boots")[0]["price"] == "Price not available"
+
+
+def test_load_csv(tmp_path):
+    path = str(tmp_path / "catalog.csv")
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["name", "price", "rating", "reviews"])
+        writer.writeheader()
+        writer.writerow({"name": "Steel water bottle", "price": "19.5", "rating": "4.2", "reviews": "17"})
+
+    product = Catalog.load(path).search("bottle")[0]
+
+    assert product["price"] == "$19.50"
+    assert product["rating"] == 4.2
+    assert product["reviews"] == 17
+
+
+def test_rarer_terms_rank_higher(catalog_path):
+    # "nike" is on one product, "running" and "shoe" on two
+    products = Catalog.load(catalog_path).search("nike running shoes")
+
+    assert [product["name"] for product in products] == ["Nike Air Zoom running shoes",
+                                                          "Adidas Ultraboost running shoes"]
+    assert [product["id"] for product in products] == [1, 2]
+
+
+def test_shorter_products_rank_higher(catalog_path):
+    names = [product["name"] for product in Catalog.load(catalog_path).search("jacket")]
+
+    assert names[0] == "Red leather jacket"
+
+
+def test_other_fields_are_searched(catalog_path):
+    catalog = Catalog.load(catalog_path)
+
+    assert catalog.search("cancelling")[0]["name"] == "Wireless headphones"
+    assert catalog.search("adidas")[0]["name"] == "Adidas Ultraboost running shoes"
+
+
+def test_unknown_words_find_nothing(catalog_path):
+    catalog = Catalog.load(catalog_path)
+
+    assert catalog.search("submarine") == []
+    assert catalog.search("") == []
+    assert len(catalog.search("jacket", limit=1)) == 1
+
+
+def test_common_terms_rerank_candidates():
+    catalog = Catalog(candidate_limit=2)
+    for i in range(10):
+        catalog.add({"name": f"shoe {i}", "keywords": f"model{i}" + " padding" * i})
+    catalog.add({"name": "red shoe"})
+    catalog.finish()
+
+    # "shoe" is on 11 products: only the 2 best are scored for it alone
+    assert [product["name"] for product in catalog.search("shoe")] == ["red shoe", "shoe 0"]
+    # With a rarer term, "shoe" re-ranks that term's products
+    assert catalog.search("red shoe")[0]["name"] == "red shoe"
+    assert catalog.search("model7 shoe")[0]["name"] == "shoe 7"
+
+
+def test_mapped_catalog_matches_the_loaded_one(catalog_path, tmp_path):
+    loaded = Catalog.load(catalog_path, candidate_limit=1)
+    path = str(tmp_path / "products.catalog")
+    loaded.save(path)
+
+    mapped = open_catalog(path)
+
+    assert isinstance(mapped, MappedCatalog)
+    assert len(mapped) == 6
+    assert mapped.stats()["products"] == 6
+    assert mapped.candidate_limit == 1
+    for query in ["nike shoes", "jacket", "running shoes", "leather", "hiking boots", "headphones", "submarine", ""]:
+        assert mapped.search(query) == loaded.search(query)
+
+
+def test_mapped_catalog_rejects_other_files(catalog_path):
+    with pytest.raises(ValueError):
+        MappedCatalog(catalog_path)
+
+
+def test_missing_catalog_reports_an_error(tmp_path):
+    provider = providers.LocalCatalogProvider(str(tmp_path / "missing.jsonl"))
+
+    products, error = provider.search("shoes")
+
+    assert products == []
+    assert error.startswith("Product catalog not available")
+    assert "error" in provider.stats()
+
+
+def test_bad_json_line_reports_an_error(tmp_path):
+    path = str(tmp_path / "catalog.jsonl")
+    with open(path, "w") as f:
+        f.write('{"name": "ok"}\n{not json\n')
+
+    products, error = providers.LocalCatalogProvider(path).search("ok")
+
+    assert "line 2" in error
+
+
+def test_provider_opens_a_catalog_file(catalog_path, tmp_path):
+    path = str(tmp_path / "products.catalog")
+    Catalog.load(catalog_path).save(path)
+
+    provider = providers.LocalCatalogProvider(path)
+    products, error = provider.search("leather jacket")
+
+    assert error == ""
+    assert products[0]["name"] == "Red leather jacket"
+    assert provider.stats()["format"] == "mapped"
+
+
+def test_search_product_uses_the_configured_provider(catalog_path, monkeypatch):
+    import methods
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=None, burst=0))
+    monkeypatch.setattr(providers, "_provider", providers.LocalCatalogProvider(catalog_path))
+
+    monkeypatch.setattr(methods, "SESSIONS", SessionStore())
+
+    session_id = methods.SESSIONS.create("catalog-test")
+    reply = json.loads(methods.Methods.SEARCH_PRODUCT(None, [session_id, "leather", "jacket"], None))
+    empty = json.loads(methods.Methods.SEARCH_PRODUCT(None, [session_id, "submarine"], None))
+    stats = json.loads(methods.Methods.STATS(None, [], None))
+
+    assert reply["status"] == "success"
+    assert reply["products"][0]["name"] == "Red leather jacket"
+    assert empty["status"] == "success"
+    assert empty["products"] == []
+    assert stats["provider"]["name"] == "local"
+    assert stats["provider"]["products"] == 6
@@ -0,0 +1,137 @@
+"""
+Tests for admission control in the request dispatcher
+Jobs block on events so the pools are exactly as full as each test needs;
+a fake clock makes the service-time estimate deterministic
+
+Run: python -m pytest test_dispatcher.py
+"""
+import json
+import threading
+import pytest
+from dispatcher import WorkPool, Dispatcher
+
+
+class FakeClock(object):
+    """Time that only moves when the test says so"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def release():
+    """Event the blocking jobs wait on; set at teardown so no worker is left hanging"""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_pool_refuses_jobs_beyond_workers_plus_queue(release):
+    pool = WorkPool("test", workers=1, max_queue=1)
+
+    running = pool.try_submit(release.wait, 5)
+    queued = pool.try_submit(release.wait, 5)
+
+    assert pool.try_submit(release.wait, 5) is None
+    assert pool.stats()["running"] == 1
+    assert pool.stats()["queue_depth"] == 1
+    assert pool.stats()["rejected"] == 1
+
+    release.set()
+    running.result(5)
+    queued.result(5)
+    assert pool.try_submit(lambda: "ok").result(5) == "ok"
+    assert pool.stats()["completed"] == 3
+
+
+def test_retry_after_grows_with_the_queue(release):
+    pool = WorkPool("test", workers=2, max_queue=4, min_retry_after_ms=10)
+
+    for _ in range(2):
+        pool.try_submit(release.wait, 5)
+    # One slot frees up per average service time per worker (0.1s to start with)
+    assert pool.retry_after_ms() == 50
+
+    for _ in range(4):
+        pool.try_submit(release.wait, 5)
+    assert pool.retry_after_ms() == 250
+
+
+def test_retry_after_never_drops_below_the_minimum():
+    pool = WorkPool("test", workers=4, max_queue=4, min_retry_after_ms=100)
+
+    assert pool.retry_after_ms() == 100
+
+
+def test_service_time_tracks_how_long_jobs_run():
+    clock = FakeClock()
+    pool = WorkPool("test", workers=1, max_queue=0, min_retry_after_ms=1, clock=clock)
+
+    pool.try_submit(clock.advance, 0.6).result(5)
+
+    # Moving average: 0.1 + 0.2 * (0.6 - 0.1)
+    assert pool.stats()["service_ms_avg"] == 200.0
+    assert pool.retry_after_ms() == 200
+
+
+class Handlers(object):
+    @staticmethod
+    def STATS(my_socket, params, address):
+        return json.dumps({"status": "success"})
+
+    @staticmethod
+    def SEARCH_PRODUCT(my_socket, params, address):
+        params[0].wait(5)
+        return json.dumps({"status": "success", "products": []})
+
+    @staticmethod
+    def BROKEN(my_socket, params, address):
+        raise RuntimeError("boom")
+
+
+class CommandMetrics(object):
+    def __init__(self):
+        self.recorded = []
+
+    def record(self, command, duration, ok):
+        self.recorded.append((command, ok))
+
+
+@pytest.fixture
+def dispatcher():
+    return Dispatcher(
+        Handlers, ["STATS"],
+        WorkPool("cheap", workers=1, max_queue=4),
+        WorkPool("expensive", workers=1, max_queue=0, min_retry_after_ms=100),
+        command_metrics=CommandMetrics()
+    )
+
+
+def test_full_pool_answers_busy_with_a_retry_hint(dispatcher, release):
+    running = dispatcher.submit("SEARCH_PRODUCT", [release], None, None)
+
+    busy = json.loads(dispatcher.submit("SEARCH_PRODUCT", [release], None, None).result(5))
+
+    assert busy["status"] == "error"
+    assert busy["code"] == "BUSY"
+    assert busy["retry_after_ms"] == 100
+    # Cheap commands have their own pool and still go through
+    assert json.loads(dispatcher.submit("STATS", [], None, None).result(5))["status"] == "success"
+
+    release.set()
+    assert json.loads(running.result(5))["status"] == "success"
+    assert ("SEARCH_PRODUCT", False) in dispatcher.command_metrics.recorded
+
+
+def test_unknown_commands_and_handler_errors_become_error_replies(dispatcher):
+    unknown = json.loads(dispatcher.submit("NOPE", [], None, None).result(5))
+    broken = json.loads(dispatcher.submit("BROKEN", [], None, None).result(5))
+
+    assert unknown == {"status": "error", "message": "Unknown command: NOPE"}
+    assert broken == {"status": "error", "message": "Server error: boom"}
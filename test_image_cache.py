@@ -0,0 +1,83 @@
+"""
+Tests for the two-tier image analysis cache
+Each test gets its own sqlite file; a fake clock drives both tiers' expiry
+
+Run: python -m pytest test_image_cache.py
+"""
+from image_cache import ImageResultCache
+
+
+class FakeClock(object):
+    """Time that only moves when the test says so"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def image_cache(db_path, clock, memory_ttl=60, disk_ttl=3600):
+    result = ImageResultCache(memory_ttl=memory_ttl, db_path=str(db_path), disk_ttl=disk_ttl, clock=clock)
+    result.memory.clock = clock
+    return result
+
+
+def test_memory_only_cache_has_no_disk_tier():
+    results = ImageResultCache()
+    results.put("abc", "red shoe")
+
+    assert results.get("abc") == (True, "red shoe")
+    assert results.get("def") == (False, None)
+    assert results.stats()["disk_path"] is None
+    assert "disk_entries" not in results.stats()
+
+
+def test_disk_hit_is_promoted_into_memory(tmp_path):
+    clock = FakeClock()
+    results = image_cache(tmp_path / "images.db", clock)
+    results.put("abc", "red shoe")
+
+    # Expired from memory, still on disk
+    clock.advance(120)
+    assert results.get("abc") == (True, "red shoe")
+    assert results.stats()["disk_hits"] == 1
+
+    # Served from memory this time
+    assert results.get("abc") == (True, "red shoe")
+    assert results.stats()["disk_hits"] == 1
+    assert results.stats()["memory"]["hits"] == 1
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    clock = FakeClock()
+    image_cache(tmp_path / "images.db", clock).put("abc", "red shoe")
+
+    restarted = image_cache(tmp_path / "images.db", clock)
+
+    assert restarted.get("abc") == (True, "red shoe")
+    assert restarted.stats()["disk_hits"] == 1
+    assert restarted.stats()["disk_entries"] == 1
+
+
+def test_disk_entries_expire_after_disk_ttl(tmp_path):
+    clock = FakeClock()
+    results = image_cache(tmp_path / "images.db", clock)
+    results.put("abc", "red shoe")
+
+    clock.advance(3600)
+    assert results.get("abc") == (False, None)
+    assert results.stats()["disk_entries"] == 0
+
+
+def test_open_attaches_the_disk_tier_later(tmp_path):
+    results = ImageResultCache()
+    results.put("abc", "red shoe")
+    results.open(str(tmp_path / "images.db"))
+    results.put("def", "blue hat")
+
+    assert results.stats()["disk_path"] == str(tmp_path / "images.db")
+    assert results.stats()["disk_entries"] == 1
@@ -0,0 +1,103 @@
+"""
+Tests for perceptual hashing and the Hamming-radius index
+A seeded rng picks the hashes and flipped bits, so failures reproduce
+
+Run: python -m pytest test_image_hash.py
+"""
+import io
+import random
+from PIL import Image, ImageDraw
+from image_hash import dhash, hamming_distance, HammingIndex, NearDuplicateIndex, HASH_BITS
+
+
+def flip(hash_value, rng, bits):
+    """hash_value with `bits` distinct random bits flipped"""
+    for position in rng.sample(range(HASH_BITS), bits):
+        hash_value ^= 1 << position
+    return hash_value
+
+
+def test_lookup_finds_hashes_at_exactly_the_radius():
+    rng = random.Random(7)
+    index = HammingIndex()
+    stored = [rng.getrandbits(HASH_BITS) for _ in range(200)]
+    for i, hash_value in enumerate(stored):
+        index.add(hash_value, i)
+
+    for i, hash_value in enumerate(stored):
+        query = flip(hash_value, rng, 6)
+        assert index.nearest(query, 6) == (6, i)
+
+
+def test_lookup_misses_hashes_just_past_the_radius():
+    rng = random.Random(11)
+    index = HammingIndex()
+    hash_value = rng.getrandbits(HASH_BITS)
+    index.add(hash_value, "shoe")
+
+    for _ in range(50):
+        assert index.nearest(flip(hash_value, rng, 7), 6) == (None, None)
+
+
+def test_lookup_matches_a_linear_scan():
+    rng = random.Random(3)
+    index = HammingIndex()
+    base = rng.getrandbits(HASH_BITS)
+    # Clustered around one hash so plenty of them are within the radius
+    stored = [flip(base, rng, rng.randint(0, 12)) for _ in range(300)]
+    for hash_value in stored:
+        index.add(hash_value, hash_value)
+
+    for _ in range(100):
+        query = flip(base, rng, rng.randint(0, 12))
+        closest = min(hamming_distance(query, hash_value) for hash_value in stored)
+        distance, value = index.nearest(query, 6)
+        if closest <= 6:
+            assert distance == closest == hamming_distance(query, value)
+        else:
+            assert distance is None
+
+
+def test_oldest_hashes_are_dropped_beyond_max_entries():
+    index = HammingIndex(max_entries=2)
+    index.add(1, "a")
+    index.add(2, "b")
+    index.add(1 << 40, "c")
+
+    assert len(index) == 2
+    assert index.nearest(1, 0) == (None, None)
+    assert index.nearest(1 << 40, 0) == (0, "c")
+
+
+def png(draw_shapes, size=(256, 256)):
+    img = Image.new("L", size, 255)
+    draw_shapes(ImageDraw.Draw(img), size)
+    output = io.BytesIO()
+    img.save(output, format="PNG")
+    return img, output.getvalue()
+
+
+def test_dhash_of_a_resized_copy_is_within_the_threshold():
+    def shapes(draw, size):
+        width, height = size
+        draw.rectangle([0, 0, width // 2, height], fill=0)
+        draw.ellipse([width // 2, height // 4, width, height * 3 // 4], fill=128)
+
+    img, original = png(shapes)
+    resized = io.BytesIO()
+    img.resize((640, 640)).convert("RGB").save(resized, format="JPEG", quality=70)
+    _, different = png(lambda draw, size: draw.rectangle([0, 0, size[0], size[1] // 2], fill=0))
+
+    near = NearDuplicateIndex(threshold=6)
+    near.add(near.compute(original), "red shoe")
+
+    assert hamming_distance(dhash(original), dhash(resized.getvalue())) <= 6
+    assert near.lookup(near.compute(resized.getvalue())) == (True, "red shoe")
+    assert near.lookup(near.compute(different)) == (False, None)
+
+
+def test_undecodable_image_has_no_hash():
+    near = NearDuplicateIndex()
+
+    assert near.compute(b"not an image") is None
+    assert near.stats()["hash_errors"] == 1
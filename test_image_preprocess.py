@@ -0,0 +1,45 @@
+"""
+Tests for the image preprocessing pool
+
+Run: python -m pytest test_image_preprocess.py
+"""
+import io
+import os
+import signal
+import pytest
+from PIL import Image
+from image_preprocess import ImagePreprocessor
+
+
+def jpeg(size):
+    output = io.BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+@pytest.fixture
+def preprocessor():
+    preprocessor = ImagePreprocessor(max_edge=64, workers=1)
+    yield preprocessor
+    preprocessor.shutdown()
+
+
+def test_images_are_shrunk_in_a_spawned_worker(preprocessor):
+    output, mime_type, sizes = preprocessor.run(jpeg((1200, 800)))
+
+    assert mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(output)).size == (64, 43)
+    assert sizes["bytes_after"] < sizes["bytes_before"]
+    assert preprocessor.get_pool()._mp_context.get_start_method() == "spawn"
+
+
+def test_dead_worker_is_replaced(preprocessor):
+    preprocessor.run(jpeg((400, 400)))
+    for pid in list(preprocessor.get_pool()._processes):
+        os.kill(pid, signal.SIGKILL)
+
+    output, mime_type, sizes = preprocessor.run(jpeg((400, 400)))
+
+    assert Image.open(io.BytesIO(output)).size == (64, 64)
+    assert preprocessor.stats()["pool_restarts"] == 1
+    assert preprocessor.stats()["failures"] == 0
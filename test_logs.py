@@ -0,0 +1,172 @@
+"""
+Tests for redaction, sampling and the JSON-lines log pipeline
+A scripted rng makes every sampling decision deterministic
+
+Run: python -m pytest test_logs.py
+"""
+import io
+import json
+import logging
+import pytest
+import logs
+from logs import SamplingFilter, redact_params, redact_text, should_log, log_request
+
+
+class FakeRng(object):
+    """Returns the given values in turn, like random.random would"""
+
+    def __init__(self, *values):
+        self.values = list(values)
+
+    def __call__(self):
+        return self.values.pop(0)
+
+
+def test_login_password_is_masked():
+    assert redact_params("LOGIN", ["alice", "hunter2"]) == ["alice", "***"]
+
+
+def test_session_ids_are_shortened():
+    session_id = "0123456789abcdef-0123"
+
+    assert redact_params("SEARCH_PRODUCT", [session_id, "red", "shoes"]) == ["01234567...", "red", "shoes"]
+
+
+def test_long_params_are_cut():
+    (param,) = redact_params("PING", ["x" * 500])
+
+    assert param == "x" * logs.MAX_PARAM_LENGTH + "..."
+
+
+def test_redact_params_leaves_the_callers_list_alone():
+    params = ["alice", "hunter2"]
+    redact_params("LOGIN", params)
+
+    assert params == ["alice", "hunter2"]
+    assert redact_params("LOGIN", None) == []
+
+
+def test_secret_key_value_pairs_are_masked():
+    text = "GET /search.json?q=shoes&api_key=abc123&num=10 password: 'hunter2'"
+
+    assert redact_text(text) == "GET /search.json?q=shoes&api_key=***&num=10 password: '***'"
+    assert redact_text("SEARCH_PRODUCT success") == "SEARCH_PRODUCT success"
+
+
+def record(command, level=logging.INFO):
+    return logging.makeLogRecord({"levelno": level, "command": command})
+
+
+def test_sampling_keeps_the_configured_fraction():
+    sampler = SamplingFilter({"STATS": 0.25}, rng=FakeRng(0.1, 0.3, 0.9, 0.2))
+
+    kept = [sampler.filter(record("STATS")) for _ in range(4)]
+
+    assert kept == [True, False, False, True]
+    assert sampler.dropped == 2
+
+
+def test_kept_sampled_records_carry_their_rate():
+    sampler = SamplingFilter({"STATS": 0.25}, rng=FakeRng(0.1))
+    stats, login = record("STATS"), record("LOGIN")
+
+    assert sampler.filter(stats) and sampler.filter(login)
+    assert stats.sample_rate == 0.25
+    assert not hasattr(login, "sample_rate")
+
+
+def test_warnings_and_unsampled_commands_are_always_kept():
+    # An empty rng: any sampling decision would fail the test
+    sampler = SamplingFilter({"STATS": 0.01}, rng=FakeRng())
+
+    assert sampler.filter(record("STATS", logging.WARNING))
+    assert sampler.filter(record("LOGIN"))
+    assert sampler.filter(record(None))
+    assert sampler.dropped == 0
+
+
+@pytest.fixture
+def pipeline():
+    """Logging at INFO into a StringIO; returns (pipeline, stream, logger)"""
+    stream = io.StringIO()
+    current = logs.setup_logging("INFO", sample_rates={"STATS": 0.5}, stream=stream)
+    yield current, stream, logs.get_logger("test")
+    logs.setup_logging(None)
+
+
+def lines(current, stream):
+    current.stop()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_request_lines_are_redacted_by_the_writer(pipeline):
+    current, stream, log = pipeline
+    params = ["alice", "hunter2"]
+
+    rate = should_log(log, "LOGIN")
+    log_request(log, "LOGIN success", {"command": "LOGIN", "params": params, "address": ("127.0.0.1", 5000)}, rate)
+
+    (line,) = lines(current, stream)
+    assert line["level"] == "INFO"
+    assert line["logger"] == "shopping.test"
+    assert line["msg"] == "LOGIN success"
+    assert line["params"] == ["alice", "***"]
+    assert line["address"] == "127.0.0.1:5000"
+    assert "sample_rate" not in line
+
+
+def test_should_log_samples_before_anything_is_built(pipeline):
+    current, stream, log = pipeline
+    current.sampler.rng = FakeRng(0.9, 0.1)
+
+    assert should_log(log, "STATS") == 0.0
+    rate = should_log(log, "STATS")
+    log_request(log, "STATS success", {"command": "STATS"}, rate)
+
+    (line,) = lines(current, stream)
+    assert line["sample_rate"] == 0.5
+    assert current.stats()["sampled_out"] == 1
+
+
+def test_should_log_is_off_below_info():
+    logs.setup_logging("WARNING", stream=io.StringIO())
+    try:
+        assert should_log(logs.get_logger("test"), "LOGIN") == 0.0
+    finally:
+        logs.setup_logging(None)
+
+    assert should_log(logs.get_logger("test"), "LOGIN") == 0.0
+
+
+def test_ordinary_records_are_redacted_and_keep_their_extras(pipeline):
+    current, stream, log = pipeline
+
+    log.info("Calling %s", "https://serpapi.com/search?api_key=abc123", extra={"command": "SEARCH_PRODUCT"})
+    try:
+        raise ValueError("token=abc123")
+    except ValueError:
+        log.exception("Upstream failed")
+
+    info, error = lines(current, stream)
+    assert info["msg"] == "Calling https://serpapi.com/search?api_key=***"
+    assert info["command"] == "SEARCH_PRODUCT"
+    assert error["level"] == "ERROR"
+    assert "token=***" in error["exc"]
+    assert "abc123" not in error["exc"]
+
+
+def test_setup_leaves_the_global_logging_switches_alone(pipeline):
+    assert logging._srcfile is not None
+    assert logging.logThreads and logging.logProcesses
+
+
+def test_full_queue_drops_and_counts():
+    stream = io.StringIO()
+    current = logs.setup_logging("INFO", stream=stream, queue_size=0)
+    try:
+        log = logs.get_logger("test")
+        log.info("dropped")
+        log_request(log, "dropped too", {})
+        assert current.stats()["dropped_queue_full"] == 2
+    finally:
+        logs.setup_logging(None)
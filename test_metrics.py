@@ -0,0 +1,98 @@
+"""
+Tests for the latency histograms and the Prometheus text output
+
+Run: python -m pytest test_metrics.py
+"""
+import urllib.request
+from metrics import Histogram, CommandMetrics, render, serve_http
+
+
+def test_quantile_is_the_upper_bound_of_its_bucket():
+    histogram = Histogram(bounds=(0.001, 0.01, 0.1, 1.0))
+    for seconds in [0.0005] * 50 + [0.005] * 45 + [0.05] * 4 + [0.5]:
+        histogram.observe(seconds)
+
+    counts, total, largest = histogram.snapshot()
+
+    assert counts == [50, 45, 4, 1, 0]
+    assert histogram.quantile(counts, 0.50, largest) == 0.001
+    assert histogram.quantile(counts, 0.95, largest) == 0.01
+    assert histogram.quantile(counts, 0.99, largest) == 0.1
+    # Capped at the largest value seen rather than the bucket bound
+    assert histogram.quantile(counts, 1.0, largest) == 0.5
+
+
+def test_values_past_the_last_bound_report_the_largest_seen():
+    histogram = Histogram(bounds=(0.001, 0.01))
+    histogram.observe(3.0)
+    counts, total, largest = histogram.snapshot()
+
+    assert counts == [0, 0, 1]
+    assert histogram.quantile(counts, 0.5, largest) == 3.0
+    assert histogram.stats()["p99_ms"] == 3000.0
+
+
+def test_empty_histogram_reports_zeros():
+    stats = Histogram().stats()
+
+    assert stats == {"count": 0, "avg_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+
+def test_samples_are_cumulative_buckets():
+    histogram = Histogram(bounds=(0.001, 0.01))
+    for seconds in (0.0005, 0.005, 0.005, 2.0):
+        histogram.observe(seconds)
+
+    samples = histogram.samples({"command": "STATS"})
+
+    assert [(suffix, labels.get("le"), value) for suffix, labels, value in samples[:3]] == [
+        ("_bucket", "0.001", 1), ("_bucket", "0.01", 3), ("_bucket", "+Inf", 4)
+    ]
+    assert samples[3][0] == "_sum"
+    assert samples[3][2] == 2.0105
+    assert samples[4] == ("_count", {"command": "STATS"}, 4)
+
+
+def test_render_writes_the_prometheus_text_format():
+    text = render([
+        ("shopping_errors_total", "counter", "Errors", [("", {"command": 'say "hi"\n'}, 3)]),
+        ("shopping_up", "gauge", "Up", [("", {}, 1)])
+    ])
+
+    assert text == (
+        "# HELP shopping_errors_total Errors\n"
+        "# TYPE shopping_errors_total counter\n"
+        'shopping_errors_total{command="say \\"hi\\"\\n"} 3\n'
+        "# HELP shopping_up Up\n"
+        "# TYPE shopping_up gauge\n"
+        "shopping_up 1\n"
+    )
+
+
+def test_command_metrics_count_errors_per_command():
+    command_metrics = CommandMetrics()
+    command_metrics.record("SEARCH_PRODUCT", 0.2, True)
+    command_metrics.record("SEARCH_PRODUCT", 0.4, False)
+    command_metrics.record("LOGIN", 0.001, True)
+
+    stats = command_metrics.stats()
+
+    assert list(stats) == ["LOGIN", "SEARCH_PRODUCT"]
+    assert stats["SEARCH_PRODUCT"]["count"] == 2
+    assert stats["SEARCH_PRODUCT"]["errors"] == 1
+    assert stats["LOGIN"]["errors"] == 0
+
+
+def test_serve_http_answers_scrapes_and_survives_a_taken_port():
+    families = [("shopping_up", "gauge", "Up", [("", {}, 1)])]
+    httpd = serve_http("127.0.0.1", 0, lambda: families)
+    try:
+        port = httpd.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert response.read().decode() == render(families)
+
+        # A second server on the same port is skipped rather than raising
+        assert serve_http("127.0.0.1", port, lambda: families) is None
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,218 @@
+"""
+Tests for the socket protocol: framing, negotiation and the replies both
+server engines send over it
+Every test talks over a local socketpair, so no server has to be running
+
+Run: python -m pytest test_protocol.py
+"""
+import json
+import socket
+import asyncio
+import threading
+import pytest
+import protocol
+import serialization
+from protocol import Connection, Protocol
+from server import ShoppingServer
+from sessions import SessionStore
+from ratelimit import RateLimiter
+
+
+@pytest.fixture
+def connections():
+    server_side, client_side = socket.socketpair()
+    server, client = Connection(server_side), Connection(client_side)
+    yield server, client
+    server_side.close()
+    client_side.close()
+
+
+def test_oversized_legacy_reply_suggests_binary_framing(connections):
+    server, client = connections
+
+    ShoppingServer.send_response_to_client(json.dumps({"blob": "x" * 20000}), server)
+
+    reply = json.loads(Protocol.recv(client))
+    assert reply["status"] == "error"
+    assert "PROTOCOL BINARY" in reply["message"]
+
+
+def test_oversized_binary_reply_reports_the_frame_limit(connections, monkeypatch):
+    server, client = connections
+    server.framing = client.framing = protocol.FRAMING_BINARY
+    monkeypatch.setattr(protocol, "MAX_FRAME_SIZE", 1000)
+
+    ShoppingServer.send_response_to_client(json.dumps({"blob": "x" * 2000}), server)
+
+    reply = json.loads(Protocol.recv(client))
+    assert reply["status"] == "error"
+    assert "1000 bytes" in reply["message"]
+    assert "PROTOCOL BINARY" not in reply["message"]
+
+
+@pytest.fixture
+def served(connections):
+    """A client Connection talking to ShoppingServer.handle_single_client in a thread"""
+    server, client = connections
+    shopping_server = ShoppingServer("127.0.0.1", 0)
+    thread = threading.Thread(target=shopping_server.handle_single_client, args=(server, ("127.0.0.1", 0)))
+    thread.start()
+    yield server, client
+    thread.join(5)
+    shopping_server.server_socket.close()
+
+
+def test_multiplexed_connection_refuses_renegotiation(served):
+    server, client = served
+    Protocol.send(client, "PROTOCOL BINARY MUX")
+    assert json.loads(Protocol.recv(client))["status"] == "success"
+    client.framing = protocol.FRAMING_BINARY
+
+    Protocol.send_binary(client, b"PROTOCOL BINARY MUX COMPRESS MSGPACK", request_id=7)
+    request_id, reply = Protocol.recv_frame(client)
+
+    assert request_id == 7
+    assert json.loads(reply)["status"] == "error"
+    assert server.multiplexed
+    assert not server.compression
+    assert server.encoding == serialization.ENCODING_JSON
+
+    # The connection still answers with the settings it negotiated first
+    Protocol.send_binary(client, b"EXIT", request_id=8)
+    request_id, reply = Protocol.recv_frame(client)
+    assert request_id == 8
+    assert json.loads(reply)["message"] == "EXIT"
+
+
+class EchoProvider(object):
+    """Product provider that returns many products named after the query"""
+
+    def search(self, query):
+        return [{"id": i, "name": f"{query} {i}", "price": "$1.00"} for i in range(1, 51)], ""
+
+    def stats(self):
+        return {"name": "echo"}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.parametrize("multiplex", [True, False])
+def test_async_client_round_trip_with_compression(multiplex, monkeypatch):
+    import methods
+    import providers
+    from async_client import AsyncShoppingClient
+    from async_server import AsyncShoppingServer
+    monkeypatch.setattr(methods, "SESSIONS", SessionStore())
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=None, burst=0))
+    monkeypatch.setattr(providers, "_provider", EchoProvider())
+    port = free_port()
+    # Long enough that the request frame is compressed too
+    query = "red shoes " * 200
+
+    async def run():
+        serving = asyncio.create_task(AsyncShoppingServer("127.0.0.1", port).serve())
+        for _ in range(100):
+            try:
+                client = AsyncShoppingClient("127.0.0.1", port, multiplex=multiplex, compress=True)
+                await client.connect()
+                break
+            except OSError:
+                await asyncio.sleep(0.02)
+        try:
+            assert client.connection.compression
+            assert await client.login("admin", "admin123")
+            return await client.search_product(query)
+        finally:
+            await client.close()
+            serving.cancel()
+
+    before = protocol.compression_stats.stats()["frames_compressed"]
+    products = asyncio.run(run())
+
+    assert len(products) == 50
+    assert products[0]["name"] == f"{query.strip()} 1"
+    # The client's request and the server's reply
+    assert protocol.compression_stats.stats()["frames_compressed"] - before == 2
+
+
+def test_search_many_streams_each_result_as_it_completes(served, monkeypatch):
+    import time
+    import methods
+    import providers
+    server, client = served
+    monkeypatch.setattr(methods, "SESSIONS", SessionStore())
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=None, burst=0))
+
+    class SlowProvider(EchoProvider):
+        def search(self, query):
+            if query == "slow":
+                time.sleep(0.3)
+            return EchoProvider.search(self, query)
+
+    monkeypatch.setattr(providers, "_provider", SlowProvider())
+    Protocol.send(client, "PROTOCOL BINARY STREAM")
+    assert json.loads(Protocol.recv(client))["features"] == ["STREAM"]
+    client.framing = protocol.FRAMING_BINARY
+    session_id = methods.SESSIONS.create("stream-test")
+
+    Protocol.send(client, f'SEARCH_MANY {session_id} ["slow", "fast"]')
+    frames = [json.loads(Protocol.recv(client)) for _ in range(3)]
+    Protocol.send(client, "EXIT")
+    Protocol.recv(client)
+
+    assert [frame.get("event") for frame in frames] == ["result", "result", "done"]
+    # The fast query is not held back by the slow one
+    assert [frame["query"] for frame in frames[:2]] == ["fast", "slow"]
+    assert frames[0]["index"] == 1
+    assert len(frames[0]["products"]) == 50
+    assert frames[2] == {"status": "success", "event": "done", "count": 2, "failed": 0}
+
+
+def negotiate_mux(client):
+    Protocol.send(client, "PROTOCOL BINARY MUX")
+    assert json.loads(Protocol.recv(client))["status"] == "success"
+    client.framing = protocol.FRAMING_BINARY
+
+
+def test_failed_submit_frees_its_in_flight_slot(served, monkeypatch):
+    import time
+    import methods
+    import server as server_module
+    server, client = served
+    monkeypatch.setattr(server_module, "MUX_DRAIN_TIMEOUT", 10)
+
+    def submit(request, params, my_socket, address):
+        raise RuntimeError("dispatcher down")
+
+    negotiate_mux(client)
+    monkeypatch.setattr(methods.DISPATCHER, "submit", submit)
+
+    started = time.monotonic()
+    Protocol.send_binary(client, b"STATS", request_id=1)
+
+    # The server gives up on the connection without waiting for a reply that never comes
+    assert Protocol.recv_frame(client) == (None, b"")
+    assert time.monotonic() - started < 5
+
+
+def test_closing_connection_waits_a_bounded_time_for_stuck_requests(served, monkeypatch):
+    import time
+    import methods
+    import server as server_module
+    from concurrent.futures import Future
+    server, client = served
+    monkeypatch.setattr(server_module, "MUX_DRAIN_TIMEOUT", 0.2)
+    stuck = Future()
+    negotiate_mux(client)
+    monkeypatch.setattr(methods.DISPATCHER, "submit", lambda *args: stuck)
+
+    started = time.monotonic()
+    Protocol.send_binary(client, b"STATS", request_id=1)
+    Protocol.send_binary(client, b"EXIT", request_id=2)
+
+    assert Protocol.recv_frame(client) == (None, b"")
+    assert time.monotonic() - started < 5
@@ -0,0 +1,289 @@
+"""
+Tests for the token-bucket rate limiter and how the handlers use it
+A fake clock makes every refill deterministic
+
+Run: python -m pytest test_ratelimit.py
+"""
+import json
+import threading
+import pytest
+from ratelimit import TokenBucket, RateLimiter, RateLimited
+from sessions import SessionStore
+
+
+class FakeClock(object):
+    """Time that only moves when the test says so"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_bucket_allows_burst_then_limits():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2.0, burst=3, clock=clock)
+
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    assert bucket.stats()["allowed"] == 3
+    assert bucket.stats()["limited"] == 1
+
+
+def test_bucket_refills_at_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2.0, burst=3, clock=clock)
+    for _ in range(3):
+        bucket.try_acquire()
+
+    clock.advance(0.25)
+    assert bucket.try_acquire() == pytest.approx(0.25)
+
+    clock.advance(0.25)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+
+def test_bucket_never_holds_more_than_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10.0, burst=2, clock=clock)
+
+    clock.advance(3600)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() > 0
+
+
+def test_multiple_tokens_wait_for_all_of_them():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1.0, burst=5, clock=clock)
+
+    assert bucket.try_acquire(4) == 0.0
+    assert bucket.try_acquire(3) == pytest.approx(2.0)
+    clock.advance(2.0)
+    assert bucket.try_acquire(3) == 0.0
+
+
+def test_disabled_limit_always_allows():
+    bucket = TokenBucket(rate=None, burst=0, clock=FakeClock())
+    limiter = RateLimiter(rate=None, burst=0, clock=FakeClock())
+
+    assert all(bucket.try_acquire() == 0.0 for _ in range(1000))
+    assert all(limiter.try_acquire("alice") == 0.0 for _ in range(1000))
+
+
+def test_acquire_raises_with_retry_after():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=4.0, burst=1, clock=clock)
+    bucket.acquire("SerpAPI")
+
+    with pytest.raises(RateLimited) as info:
+        bucket.acquire("SerpAPI")
+
+    assert info.value.scope == "SerpAPI"
+    assert info.value.retry_after == pytest.approx(0.25)
+    assert info.value.retry_after_ms == 250
+    assert str(info.value) == "SerpAPI rate limit reached, retry after 250 ms"
+
+
+def test_retry_after_ms_rounds_up():
+    assert RateLimited("x", 0.0001).retry_after_ms == 1
+    assert RateLimited("x", 0.2501).retry_after_ms == 251
+
+
+def test_limiter_keys_are_independent():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1.0, burst=2, clock=clock)
+
+    assert limiter.try_acquire("alice") == 0.0
+    assert limiter.try_acquire("alice") == 0.0
+    assert limiter.try_acquire("alice") == pytest.approx(1.0)
+    assert limiter.try_acquire("bob") == 0.0
+
+    stats = limiter.stats()
+    assert stats["keys"] == 2
+    assert stats["allowed"] == 3
+    assert stats["limited"] == 1
+
+
+def test_limiter_prunes_full_buckets_only():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1.0, burst=2, shards=1, max_keys=2, clock=clock)
+
+    limiter.try_acquire("idle")
+    clock.advance(10)
+    limiter.try_acquire("busy")
+    limiter.try_acquire("busy")
+
+    # "idle" has refilled and is dropped; "busy" is still empty and kept
+    limiter.try_acquire("new")
+    assert limiter.stats()["keys"] == 2
+    assert limiter.try_acquire("busy") == pytest.approx(1.0)
+
+
+def test_wait_borrows_from_the_refill_in_call_order():
+    clock = FakeClock()
+    slept = []
+    limiter = RateLimiter(rate=2.0, burst=1, clock=clock, sleep=slept.append)
+
+    for _ in range(4):
+        limiter.wait("alice", "Request", max_wait=1.5)
+
+    # The first token is there, the others are due 0.5s apart
+    assert slept == [0.5, 1.0, 1.5]
+    assert limiter.stats()["allowed"] == 4
+    # Until the borrowed tokens are repaid everyone else waits behind them
+    assert limiter.try_acquire("alice") == pytest.approx(2.0)
+
+
+def test_wait_raises_when_the_tokens_would_come_too_late():
+    clock = FakeClock()
+    slept = []
+    limiter = RateLimiter(rate=1.0, burst=1, clock=clock, sleep=slept.append)
+    limiter.wait("alice", "Request", max_wait=0)
+
+    with pytest.raises(RateLimited) as raised:
+        limiter.wait("alice", "Request", max_wait=0.5)
+
+    assert raised.value.retry_after_ms == 1000
+    assert slept == []
+    # Nothing was taken by the refused wait
+    clock.advance(1)
+    assert limiter.try_acquire("alice") == 0.0
+
+
+def test_concurrent_acquires_never_exceed_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1.0, burst=50, clock=clock)
+    limiter = RateLimiter(rate=1.0, burst=50, clock=clock)
+    granted = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(100):
+            ok = bucket.try_acquire() == 0.0 and limiter.try_acquire("shared") == 0.0
+            with lock:
+                granted.append(ok)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bucket.stats()["allowed"] == 50
+    assert sum(granted) <= 50
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    """Methods with fake-clock limits and a counting stand-in for SerpAPI"""
+    import methods
+    import google_search
+
+    clock = FakeClock()
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=1.0, burst=2, clock=clock, sleep=clock.advance))
+    monkeypatch.setattr(google_search, "serpapi_limit", TokenBucket(rate=1.0, burst=1, clock=clock))
+    monkeypatch.setattr(google_search, "search_cache", google_search.cache.ResultCache(ttl=60, clock=clock))
+
+    calls = []
+
+    def fake_search(product_name):
+        calls.append(product_name)
+        return [{"id": 1, "name": product_name}], ""
+
+    monkeypatch.setattr(google_search, "google_search_for_product", fake_search)
+    monkeypatch.setattr(methods, "SESSIONS", SessionStore())
+    session_id = methods.SESSIONS.create("ratelimit-test")
+    return methods, clock, calls, session_id
+
+
+def search(methods, session_id, query):
+    return json.loads(methods.Methods.SEARCH_PRODUCT(None, [session_id, query], None))
+
+
+def test_user_limit_rejects_with_retry_after(handlers):
+    methods, clock, calls, session_id = handlers
+
+    assert search(methods, session_id, "shoes")["status"] == "success"
+    assert search(methods, session_id, "shoes")["status"] == "success"
+
+    reply = search(methods, session_id, "shoes")
+    assert reply["status"] == "error"
+    assert reply["code"] == "RATE_LIMITED"
+    assert reply["retry_after_ms"] == 1000
+
+    clock.advance(1.0)
+    assert search(methods, session_id, "shoes")["status"] == "success"
+
+
+def test_upstream_limit_only_counts_cache_misses(handlers, monkeypatch):
+    methods, clock, calls, session_id = handlers
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=None, burst=0))
+
+    assert search(methods, session_id, "shoes")["status"] == "success"
+    # Cached: served although the SerpAPI bucket has no tokens left
+    assert search(methods, session_id, "shoes")["status"] == "success"
+    assert calls == ["shoes"]
+
+    clock.advance(0.5)
+    reply = search(methods, session_id, "hats")
+    assert reply["code"] == "RATE_LIMITED"
+    assert reply["message"].startswith("SerpAPI rate limit reached")
+    assert reply["retry_after_ms"] == 500
+    assert calls == ["shoes"]
+
+    clock.advance(0.5)
+    assert search(methods, session_id, "hats")["status"] == "success"
+    assert calls == ["shoes", "hats"]
+
+
+def test_search_many_waits_for_the_users_rate_limit(handlers, monkeypatch):
+    methods, clock, calls, session_id = handlers
+    monkeypatch.setattr(methods.google_search, "serpapi_limit", TokenBucket(rate=None, burst=0))
+
+    reply = json.loads(methods.Methods.SEARCH_MANY(None, [session_id, '["a",', '"b",', '"c"]'], None))
+
+    # Two tokens for three queries: the third waits a second for its token
+    assert reply["status"] == "success"
+    assert reply["failed"] == 0
+    assert len(calls) == 3
+    assert clock.now == 1001.0
+    assert methods.USER_LIMITS.stats()["allowed"] == 3
+
+    # The batch used up the user's bucket
+    assert search(methods, session_id, "d")["code"] == "RATE_LIMITED"
+
+
+def test_search_many_limits_queries_that_would_wait_too_long(handlers, monkeypatch):
+    methods, clock, calls, session_id = handlers
+    monkeypatch.setattr(methods.google_search, "serpapi_limit", TokenBucket(rate=None, burst=0))
+
+    results = methods.search_many(["a", "b", "c", "d"], username="ratelimit-test", max_wait=1.5)
+
+    # Two tokens up front and one more within 1.5 seconds
+    limited = [result for result in results if result["status"] == "error"]
+    assert len(limited) == 1
+    assert limited[0]["code"] == "RATE_LIMITED"
+    assert limited[0]["message"].startswith("Request rate limit reached")
+    assert len(calls) == 3
+
+
+def test_search_many_reports_upstream_limited_queries_individually(handlers, monkeypatch):
+    methods, clock, calls, session_id = handlers
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=None, burst=0))
+
+    reply = json.loads(methods.Methods.SEARCH_MANY(None, [session_id, '["a",', '"b"]'], None))
+
+    # One SerpAPI token: whichever query gets it succeeds, the other is limited
+    assert reply["status"] == "success"
+    assert reply["failed"] == 1
+    limited = [result for result in reply["results"] if result["status"] == "error"]
+    assert limited[0]["code"] == "RATE_LIMITED"
+    assert limited[0]["message"].startswith("SerpAPI rate limit reached")
+    assert limited[0]["retry_after_ms"] == 1000
+    assert len(calls) == 1
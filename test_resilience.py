@@ -0,0 +1,342 @@
+"""
+Tests for the upstream circuit breakers and retries
+Unit tests use a fake clock; the SerpAPI tests run the real client against a
+local fault-injecting stub (bench/stub_upstreams.py)
+
+Run: python -m pytest test_resilience.py
+"""
+import os
+import sys
+import json
+import pytest
+import requests
+from ratelimit import TokenBucket, RateLimiter
+from sessions import SessionStore
+from resilience import CircuitBreaker, CircuitOpen, RetryPolicy, Upstream, TransientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench"))
+
+from stub_upstreams import StubSerpApi  # noqa: E402
+
+
+class FakeClock(object):
+    """Time that only moves when the test says so (or a fake sleep does)"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def fail(n, error=TransientError("HTTP 503")):
+    """Returns: a function that raises error n times, then returns "ok", and its call log"""
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= n:
+            raise error
+        return "ok"
+    return fn, calls
+
+
+def test_breaker_opens_after_threshold_and_fails_fast():
+    clock = FakeClock()
+    breaker = CircuitBreaker("Test", failure_threshold=3, reset_timeout=10, clock=clock)
+
+    for _ in range(3):
+        breaker.allow()
+        breaker.record_failure()
+
+    with pytest.raises(CircuitOpen) as info:
+        breaker.allow()
+    assert info.value.retry_after_ms == 10000
+    assert info.value.code == "UPSTREAM_UNAVAILABLE"
+
+    stats = breaker.stats()
+    assert stats["state"] == "open"
+    assert stats["opened"] == 1
+    assert stats["rejected"] == 1
+    assert stats["transitions"][-1]["to"] == "open"
+
+
+def test_success_resets_consecutive_failures():
+    breaker = CircuitBreaker("Test", failure_threshold=2, clock=FakeClock())
+
+    for _ in range(5):
+        breaker.allow()
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_success()
+
+    assert breaker.stats()["state"] == "closed"
+
+
+def test_half_open_allows_one_trial():
+    clock = FakeClock()
+    breaker = CircuitBreaker("Test", failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.allow()
+    breaker.record_failure()
+
+    clock.advance(10)
+    breaker.allow()
+    assert breaker.stats()["state"] == "half_open"
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+
+    breaker.record_success()
+    assert breaker.stats()["state"] == "closed"
+    breaker.allow()
+
+
+def test_failed_trial_reopens():
+    clock = FakeClock()
+    breaker = CircuitBreaker("Test", failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.allow()
+    breaker.record_failure()
+
+    clock.advance(10)
+    breaker.allow()
+    breaker.record_failure()
+
+    with pytest.raises(CircuitOpen):
+        breaker.allow()
+    assert [t["to"] for t in breaker.stats()["transitions"]] == ["open", "half_open", "open"]
+    assert breaker.stats()["opened"] == 2
+
+
+def test_check_does_not_claim_the_trial():
+    clock = FakeClock()
+    breaker = CircuitBreaker("Test", failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.allow()
+    breaker.record_failure()
+
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+    clock.advance(10)
+    breaker.check()
+    breaker.allow()
+
+
+def test_retry_delays_are_jittered_and_capped():
+    policy = RetryPolicy(retries=5, base_delay=0.5, max_delay=2.0, rng=lambda: 1.0)
+    assert [policy.delay(n) for n in range(1, 6)] == [0.5, 1.0, 2.0, 2.0, 2.0]
+
+    policy = RetryPolicy(retries=5, base_delay=0.5, max_delay=2.0, rng=lambda: 0.25)
+    assert policy.delay(2) == 0.25
+
+
+def make_upstream(clock, retries=2, threshold=5, deadline=None, failures=(TransientError,)):
+    return Upstream(
+        "Test",
+        failures=failures,
+        breaker=CircuitBreaker("Test", failure_threshold=threshold, reset_timeout=30, clock=clock),
+        retry=RetryPolicy(retries=retries, base_delay=0.1, max_delay=1.0, deadline=deadline, rng=lambda: 1.0),
+        clock=clock,
+        sleep=clock.sleep
+    )
+
+
+def test_upstream_retries_transient_failures():
+    clock = FakeClock()
+    upstream = make_upstream(clock, retries=2)
+    fn, calls = fail(2)
+
+    assert upstream.call(fn) == "ok"
+    assert len(calls) == 3
+    assert clock.sleeps == [0.1, 0.2]
+    assert upstream.stats()["retries"] == 2
+
+
+def test_upstream_gives_up_after_retries():
+    clock = FakeClock()
+    upstream = make_upstream(clock, retries=2)
+    fn, calls = fail(10)
+
+    with pytest.raises(TransientError):
+        upstream.call(fn)
+    assert len(calls) == 3
+    assert upstream.stats()["breaker"]["failures"] == 3
+
+
+def test_upstream_respects_deadline():
+    clock = FakeClock()
+    upstream = make_upstream(clock, retries=5, deadline=0.25)
+    fn, calls = fail(10)
+
+    with pytest.raises(TransientError):
+        upstream.call(fn)
+    # 0.1 + 0.2 would pass the deadline, so only the first retry is made
+    assert len(calls) == 2
+
+
+def test_other_errors_are_not_retried_or_counted():
+    clock = FakeClock()
+    upstream = make_upstream(clock, retries=2, threshold=1)
+    fn, calls = fail(1, ValueError("bad JSON"))
+
+    with pytest.raises(ValueError):
+        upstream.call(fn)
+    assert len(calls) == 1
+    assert upstream.stats()["breaker"]["state"] == "closed"
+
+
+def test_open_breaker_stops_retries():
+    clock = FakeClock()
+    upstream = make_upstream(clock, retries=5, threshold=2)
+    fn, calls = fail(10)
+
+    with pytest.raises(CircuitOpen):
+        upstream.call(fn)
+    assert len(calls) == 2
+
+
+@pytest.fixture
+def stub():
+    stub = StubSerpApi(hang=1.0).start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def serpapi(stub, monkeypatch):
+    """google_search wired to the stub, with a fake clock and short timeouts"""
+    import google_search
+    import upstream_clients
+
+    clock = FakeClock()
+    client = upstream_clients.SerpApiClient(url=stub.url + "/search", connect_timeout=1, timeout=0.2)
+    upstream = Upstream(
+        "SerpAPI",
+        failures=(requests.ConnectionError, requests.Timeout, TransientError),
+        breaker=CircuitBreaker("SerpAPI", failure_threshold=3, reset_timeout=30, clock=clock),
+        retry=RetryPolicy(retries=2, base_delay=0.1, max_delay=1.0),
+        clock=clock,
+        sleep=clock.sleep
+    )
+    monkeypatch.setattr(google_search, "SERPAPI_KEY", "test")
+    monkeypatch.setattr(google_search, "get_serpapi_client", lambda: client)
+    monkeypatch.setattr(google_search, "serpapi_upstream", upstream)
+    monkeypatch.setattr(google_search, "serpapi_limit", TokenBucket(rate=None, burst=0))
+    monkeypatch.setattr(google_search, "search_cache",
+                        google_search.cache.ResultCache(ttl=60, clock=clock, stale_ttl=600))
+    yield google_search, clock
+    client.close()
+
+
+def test_search_retries_5xx_from_stub(stub, serpapi):
+    google_search, clock = serpapi
+    stub.faults = [503, 502]
+
+    products, error = google_search.google_search_for_product("shoes")
+
+    assert error == ""
+    assert len(products) == 10
+    assert stub.requests == 3
+    assert len(clock.sleeps) == 2
+
+
+@pytest.mark.parametrize("fault", ["hang", "disconnect"])
+def test_search_retries_timeouts_and_disconnects(stub, serpapi, fault):
+    google_search, clock = serpapi
+    stub.faults = [fault]
+
+    products, error = google_search.google_search_for_product("shoes")
+
+    assert error == ""
+    assert google_search.serpapi_upstream.stats()["retries"] == 1
+
+
+def test_client_errors_do_not_trip_the_breaker(stub, serpapi):
+    google_search, clock = serpapi
+    stub.fault = 400
+
+    for _ in range(5):
+        products, error = google_search.google_search_for_product("shoes")
+        assert error == "No shopping results found."
+
+    assert stub.requests == 5
+    assert google_search.serpapi_upstream.stats()["breaker"]["state"] == "closed"
+
+
+def test_breaker_opens_and_fails_fast(stub, serpapi):
+    google_search, clock = serpapi
+    stub.fault = 503
+
+    products, error = google_search.google_search_for_product("shoes")
+    assert error.startswith("Search error: SerpAPI returned HTTP 503")
+    assert stub.requests == 3
+
+    with pytest.raises(CircuitOpen):
+        google_search.google_search_for_product("shoes")
+    assert stub.requests == 3
+
+    stats = google_search.serpapi_upstream.stats()["breaker"]
+    assert stats["state"] == "open"
+    assert stats["rejected"] == 1
+
+
+def test_breaker_recovers_after_reset_timeout(stub, serpapi):
+    google_search, clock = serpapi
+    stub.fault = 503
+    google_search.google_search_for_product("shoes")
+
+    stub.fault = None
+    clock.advance(30)
+    products, error = google_search.google_search_for_product("shoes")
+
+    assert error == ""
+    stats = google_search.serpapi_upstream.stats()["breaker"]
+    assert [t["to"] for t in stats["transitions"]] == ["open", "half_open", "closed"]
+
+
+def test_open_breaker_serves_stale_results(stub, serpapi):
+    google_search, clock = serpapi
+
+    fresh, error = google_search.cached_google_search_for_product("shoes")
+    assert error == ""
+
+    clock.advance(61)
+    stub.fault = 503
+    google_search.cached_google_search_for_product("hats")
+    assert google_search.serpapi_upstream.stats()["breaker"]["state"] == "open"
+    requests_before = stub.requests
+
+    # Expired, but within the stale window: served without calling SerpAPI
+    products, error = google_search.cached_google_search_for_product("shoes")
+    assert products == fresh
+    assert error == ""
+    assert stub.requests == requests_before
+    assert google_search.search_cache.stats()["stale_hits"] == 1
+
+    # Nothing cached at all: fail fast
+    with pytest.raises(CircuitOpen):
+        google_search.cached_google_search_for_product("socks")
+
+
+def test_handler_reports_unavailable_upstream(stub, serpapi, monkeypatch):
+    import methods
+    google_search, clock = serpapi
+    monkeypatch.setattr(methods, "USER_LIMITS", RateLimiter(rate=None, burst=0))
+    stub.fault = 503
+    google_search.cached_google_search_for_product("hats")
+
+    monkeypatch.setattr(methods, "SESSIONS", SessionStore())
+
+    session_id = methods.SESSIONS.create("resilience-test")
+    reply = json.loads(methods.Methods.SEARCH_PRODUCT(None, [session_id, "socks"], None))
+    stats = json.loads(methods.Methods.CACHE_STATS(None, [], None))
+
+    assert reply["status"] == "error"
+    assert reply["code"] == "UPSTREAM_UNAVAILABLE"
+    assert reply["retry_after_ms"] == 30000
+    assert stats["upstreams"]["serpapi"]["breaker"]["state"] == "open"
@@ -0,0 +1,96 @@
+"""
+Tests for the negotiated reply encodings
+
+Run: python -m pytest test_serialization.py
+"""
+import json
+import pytest
+import serialization
+from serialization import to_columns, from_columns, encode, decode, encode_reply, COLUMNS, ROWS
+
+
+PRODUCTS = [
+    {"id": 1, "name": "red shoe", "price": "$10.00", "tags": ["shoe", "red"]},
+    {"id": 2, "name": "blue shoe", "price": "$12.00", "tags": []}
+]
+
+REPLY = {"status": "success", "query": "shoe", "products": PRODUCTS}
+
+
+def test_records_with_the_same_fields_become_one_table():
+    columnar = to_columns(REPLY)
+
+    assert columnar["status"] == "success"
+    assert columnar["products"] == {
+        COLUMNS: ["id", "name", "price", "tags"],
+        ROWS: [[1, "red shoe", "$10.00", ["shoe", "red"]], [2, "blue shoe", "$12.00", []]]
+    }
+    assert from_columns(columnar) == REPLY
+
+
+def test_lists_that_are_not_tables_are_left_alone():
+    reply = {
+        "mixed": [{"a": 1}, {"b": 2}],
+        "extra_field": [{"a": 1}, {"a": 2, "b": 3}],
+        "scalars": [1, "two", None],
+        "empty": []
+    }
+
+    assert to_columns(reply) == reply
+    assert from_columns(to_columns(reply)) == reply
+
+
+def test_nested_tables_round_trip():
+    reply = {"results": [
+        {"query": "shoe", "products": PRODUCTS},
+        {"query": "hat", "products": [{"id": 3, "name": "hat", "price": "$5.00", "tags": ["hat"]}]}
+    ]}
+
+    columnar = to_columns(reply)
+
+    assert columnar["results"][COLUMNS] == ["query", "products"]
+    assert columnar["results"][ROWS][0][1][COLUMNS] == ["id", "name", "price", "tags"]
+    assert from_columns(columnar) == reply
+
+
+def test_columnar_is_smaller_than_json():
+    products = [dict(PRODUCTS[0], id=i) for i in range(50)]
+
+    assert len(encode({"products": products}, serialization.ENCODING_COLUMNAR)) < \
+        len(encode({"products": products}))
+
+
+@pytest.mark.parametrize("encoding", serialization.SUPPORTED_ENCODINGS)
+def test_every_supported_encoding_round_trips(encoding):
+    assert decode(encode(REPLY, encoding), encoding) == REPLY
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    payload = encode(REPLY, serialization.ENCODING_MSGPACK)
+
+    assert payload[:1] != b"{"
+    assert decode(payload, serialization.ENCODING_MSGPACK) == REPLY
+    # Plain JSON errors are still understood on a MSGPACK connection
+    assert decode(b'{"status": "error"}', serialization.ENCODING_MSGPACK) == {"status": "error"}
+
+
+def test_invalid_msgpack_reply_raises_value_error():
+    pytest.importorskip("msgpack")
+
+    with pytest.raises(ValueError):
+        decode(b"\xc1", serialization.ENCODING_MSGPACK)
+
+
+class FakeConnection(object):
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+
+def test_encode_reply_uses_the_connections_encoding():
+    response = json.dumps(REPLY)
+
+    assert encode_reply(object(), response) is response
+    assert encode_reply(FakeConnection(serialization.ENCODING_JSON), response) is response
+    columnar = encode_reply(FakeConnection(serialization.ENCODING_COLUMNAR), response)
+    assert decode(columnar, serialization.ENCODING_COLUMNAR) == REPLY
@@ -0,0 +1,134 @@
+"""
+Tests for the session store: expiry, reaping, paging and sqlite restore
+A fake clock makes every expiry deterministic
+
+Run: python -m pytest test_sessions.py
+"""
+from sessions import SessionStore
+
+
+class FakeClock(object):
+    """Time that only moves when the test says so"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def test_use_slides_the_expiry_forward():
+    clock = FakeClock()
+    sessions = SessionStore(ttl=100, clock=clock)
+    session_id = sessions.create("alice", ("127.0.0.1", 5000))
+
+    for _ in range(5):
+        clock.advance(90)
+        assert sessions.get(session_id)["username"] == "alice"
+
+    clock.advance(100)
+    assert sessions.get(session_id) is None
+    assert session_id not in sessions
+
+
+def test_reaper_drops_idle_sessions_only():
+    clock = FakeClock()
+    sessions = SessionStore(ttl=100, reap_interval=10, clock=clock)
+    idle = sessions.create("alice")
+    active = sessions.create("bob")
+
+    clock.advance(60)
+    sessions.get(active)
+    clock.advance(60)
+
+    assert sessions.reap() == 1
+    assert sessions.get(idle) is None
+    assert sessions.get(active)["username"] == "bob"
+
+
+def test_len_reaps_lazily_after_the_interval():
+    clock = FakeClock()
+    sessions = SessionStore(ttl=100, reap_interval=500, clock=clock)
+    for _ in range(3):
+        sessions.create("alice")
+
+    clock.advance(200)
+    assert len(sessions) == 3
+
+    clock.advance(300)
+    assert len(sessions) == 0
+
+
+def test_pages_list_every_session_once():
+    sessions = SessionStore(shards=4, clock=FakeClock())
+    created = {sessions.create(f"user{i}") for i in range(23)}
+
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = sessions.page(cursor, limit=5)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    assert sorted(sum(pages, [])) == sorted(created)
+
+
+def test_paging_survives_sessions_ending_between_pages():
+    sessions = SessionStore(shards=4, clock=FakeClock())
+    created = {sessions.create(f"user{i}") for i in range(10)}
+
+    first, cursor = sessions.page(None, limit=4)
+    # The cursor session itself goes away
+    sessions.delete(cursor)
+    rest, cursor = sessions.page(cursor, limit=100)
+
+    assert cursor is None
+    assert not set(first) & set(rest)
+    assert set(first) | set(rest) == created
+
+
+def test_exactly_full_last_page_has_no_next_cursor():
+    sessions = SessionStore(shards=2, clock=FakeClock())
+    for i in range(4):
+        sessions.create(f"user{i}")
+
+    page, cursor = sessions.page(None, limit=4)
+
+    assert len(page) == 4
+    assert cursor is None
+
+
+def test_sessions_are_restored_from_sqlite(tmp_path):
+    clock = FakeClock()
+    db_path = str(tmp_path / "sessions.db")
+    sessions = SessionStore(ttl=100, db_path=db_path, clock=clock)
+    kept = sessions.create("alice", ("127.0.0.1", 5000))
+    expired = sessions.create("bob")
+    ended = sessions.create("carol")
+    sessions.delete(ended)
+
+    clock.advance(60)
+    sessions.get(kept)
+    clock.advance(60)
+    restarted = SessionStore(ttl=100, db_path=db_path, clock=clock)
+
+    assert restarted.get(expired) is None
+    assert restarted.get(ended) is None
+    session = restarted.get(kept)
+    assert session["username"] == "alice"
+    assert session["address"] == ("127.0.0.1", 5000)
+    assert restarted.page() == ([kept], None)
+
+
+def test_open_attaches_sqlite_to_a_running_store(tmp_path):
+    db_path = str(tmp_path / "sessions.db")
+    sessions = SessionStore(clock=FakeClock())
+    sessions.open(db_path)
+    session_id = sessions.create("alice")
+
+    assert SessionStore(db_path=db_path, clock=FakeClock()).get(session_id)["username"] == "alice"
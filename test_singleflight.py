@@ -0,0 +1,109 @@
+"""
+Tests for request coalescing
+Events hold the leader's call open so the waiters are sure to join it
+
+Run: python -m pytest test_singleflight.py
+"""
+import time
+import threading
+import pytest
+from singleflight import SingleFlight
+
+
+def callers(flight, key, fn, count):
+    """
+    Threads that each call flight.do(key, fn), not yet started
+    Returns: (threads, outcomes) where outcomes collects ("ok"|"error", value)
+    """
+    outcomes = []
+    outcomes_lock = threading.Lock()
+
+    def call():
+        try:
+            value = ("ok", flight.do(key, fn))
+        except Exception as e:
+            value = ("error", e)
+        with outcomes_lock:
+            outcomes.append(value)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    return threads, outcomes
+
+
+def wait_for_waiters(flight, count):
+    """Spin until count callers have joined the in-flight call"""
+    deadline = time.monotonic() + 5
+    while flight.stats()["collapsed"] < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ["shoe"]
+
+    threads, outcomes = callers(flight, "shoes", fetch, 5)
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Every waiter has joined the leader's call before it is released
+    wait_for_waiters(flight, 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert outcomes == [("ok", ["shoe"])] * 5
+    assert flight.stats()["upstream_calls"] == 1
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_error_is_raised_to_every_waiter():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    threads, outcomes = callers(flight, "shoes", fetch, 3)
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    wait_for_waiters(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(outcomes) == 3
+    assert all(kind == "error" and str(error) == "upstream down" for kind, error in outcomes)
+    assert flight.stats()["errors"] == 1
+
+
+def test_nothing_is_remembered_after_the_call():
+    flight = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return len(calls)
+
+    assert flight.do("shoes", fetch) == 1
+    assert flight.do("shoes", fetch) == 2
+    assert flight.stats()["collapsed"] == 0
+
+    with pytest.raises(ValueError):
+        flight.do("shoes", int, "not a number")
+    # A failed call does not leave the key stuck in flight
+    assert flight.do("shoes", fetch) == 3
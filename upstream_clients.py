@@ -0,0 +1,130 @@
+"""
+Long-lived HTTP clients for the upstream APIs (SerpAPI and Azure OpenAI)
+Each client is created lazily on first use and shared by every server
+thread, so requests reuse pooled keep-alive connections instead of paying
+for a new TCP/TLS handshake every time
+"""
+import os
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from openai import AzureOpenAI
+from dotenv import load_dotenv
+from resilience import TransientError
+from constants import UPSTREAM_POOL_SIZE, SERPAPI_CONNECT_TIMEOUT, SERPAPI_TIMEOUT
+from constants import AZURE_OPENAI_CONNECT_TIMEOUT, AZURE_OPENAI_TIMEOUT, AZURE_OPENAI_MAX_RETRIES
+
+load_dotenv()
+
+SERPAPI_URL = os.getenv("SERPAPI_URL", "https://serpapi.com/search")
+
+# HTTP statuses that mean "try again later" rather than "bad request"
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+class SerpApiClient(object):
+    """
+    SerpAPI search over a pooled requests.Session
+    requests.Session is safe to share between threads for plain GET requests
+    """
+
+    def __init__(self, url=SERPAPI_URL, pool_size=UPSTREAM_POOL_SIZE,
+                 connect_timeout=SERPAPI_CONNECT_TIMEOUT, timeout=SERPAPI_TIMEOUT):
+        self.url = url
+        self.timeout = (connect_timeout, timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def search(self, params):
+        """
+        Run one search
+        Returns: the decoded JSON response (same shape as GoogleSearch.get_dict)
+        Raises: TransientError for HTTP 429/5xx, requests exceptions for timeouts and connection errors
+        """
+        response = self.session.get(self.url, params=dict(params, output="json"), timeout=self.timeout)
+        if response.status_code in TRANSIENT_STATUSES:
+            raise TransientError(f"SerpAPI returned HTTP {response.status_code}")
+        try:
+            return response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise
+
+    def close(self):
+        self.session.close()
+
+
+class AzureVisionClient(object):
+    """
+    AzureOpenAI client configured once from the environment, sharing one
+    httpx connection pool between threads
+    """
+
+    def __init__(self, pool_size=UPSTREAM_POOL_SIZE, connect_timeout=AZURE_OPENAI_CONNECT_TIMEOUT,
+                 timeout=AZURE_OPENAI_TIMEOUT, max_retries=AZURE_OPENAI_MAX_RETRIES):
+        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+        self.api_key = os.getenv("AZURE_OPENAI_API_KEY")
+        self.api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+        self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")
+
+        self.error = None
+        self.client = None
+        if not self.endpoint:
+            self.error = "AZURE_OPENAI_ENDPOINT not found in environment variables. Please add it to .env file"
+        elif not self.api_key:
+            self.error = "AZURE_OPENAI_API_KEY not found in environment variables. Please add it to .env file"
+        else:
+            self.http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(timeout, connect=connect_timeout)
+            )
+            self.client = AzureOpenAI(
+                azure_endpoint=self.endpoint,
+                api_key=self.api_key,
+                api_version=self.api_version,
+                http_client=self.http_client,
+                max_retries=max_retries
+            )
+
+    def close(self):
+        if self.client is not None:
+            self.http_client.close()
+
+
+_lock = threading.Lock()
+_serpapi_client = None
+_azure_client = None
+
+
+def get_serpapi_client():
+    """Returns: the process-wide SerpApiClient, created on first use"""
+    global _serpapi_client
+    if _serpapi_client is None:
+        with _lock:
+            if _serpapi_client is None:
+                _serpapi_client = SerpApiClient()
+    return _serpapi_client
+
+
+def get_azure_client():
+    """Returns: the process-wide AzureVisionClient, created on first use"""
+    global _azure_client
+    if _azure_client is None:
+        with _lock:
+            if _azure_client is None:
+                _azure_client = AzureVisionClient()
+    return _azure_client
+
+
+def reset_clients():
+    """Close the shared clients so the next call recreates them (e.g. after changing .env)"""
+    global _serpapi_client, _azure_client
+    with _lock:
+        for client in (_serpapi_client, _azure_client):
+            if client is not None:
+                client.close()
+        _serpapi_client = None
+        _azure_client = None